@@ -1,16 +1,28 @@
 import os
 import re
-import threading
 import json
 import sys
+import hmac
 import apphelpers
 import dispatchhelper
 import importlib.util
-from appstate import progress_state
-from flask import Flask, render_template, send_from_directory, jsonify, request, abort
+import appstate
+import runqueue
+import runlog
+import queue
+from datetime import datetime
+from eventbus import bus, format_sse
+from flask import Flask, Response, render_template, send_from_directory, jsonify, request, abort, stream_with_context
 import apphelpers, test_runner
+import registrywatcher
+import retention
+import reportrender
+import imagepipeline
+import stepcache
+import artifacts
 from dbhelper import ReportDB
 db = ReportDB()
+test_runner.db = db
 from appstate import build_nav, nav
 
 
@@ -27,6 +39,20 @@ TESTLIST_ROOT = "/testsrc/sourcedir"
 TESTSRC_HELPERDIR = "/testsrc/pyhelpers"
 TESTSRC_TESTLISTDIR = "/testsrc/mytests"
 DB_PATH = os.path.join(BASE_DIR, "report.sqlite")
+# background registry watcher: "" (off), "auto", "inotify" or "poll"
+REGISTRY_WATCH = os.environ.get("TESTRUNNER_REGISTRY_WATCH", "")
+REGISTRY_POLL_INTERVAL = float(os.environ.get("TESTRUNNER_REGISTRY_POLL", "5"))
+# seconds between keepalive comments on idle sse streams
+SSE_KEEPALIVE = 15
+# number of testlists run concurrently by the run queue
+RUN_WORKERS = int(os.environ.get("TESTRUNNER_WORKERS", "4"))
+# largest scratch dir upload accepted from a remote worker, packed and unpacked
+WORKER_UPLOAD_MAX_MB = int(os.environ.get("TESTRUNNER_WORKER_UPLOAD_MB", "1024"))
+# shared secret remote workers send in X-Worker-Token, the /api/worker routes are off without it
+WORKER_TOKEN = os.environ.get("TESTRUNNER_WORKER_TOKEN", "")
+# report history page size, and the most a client can ask for
+REPORTS_PAGE_SIZE = 25
+REPORTS_PAGE_MAX = 200
 #######################################
 if TESTSRC_TESTLISTDIR not in sys.path:
     sys.path.insert(0, TESTSRC_TESTLISTDIR)
@@ -135,14 +161,13 @@ def index():
     if not os.path.exists(REPORT_DIR):
         os.makedirs(REPORT_DIR)
 
-    db = ReportDB()
-    summaries = db.get_all_reports_summary()
+    # report history is paged in by the page itself from /api/reports
     latest_summary = db.get_latest_report_summary()
 
     return render_template(
         "index.html",
-        summaries=summaries,
-        latest_summary=latest_summary
+        latest_summary=latest_summary,
+        page_size=REPORTS_PAGE_SIZE
     )
 
 
@@ -219,48 +244,347 @@ def testfile_list():
     return jsonify(result)
 
 
+@app.route("/registry/version")
+def registry_version():
+    # clients compare this to decide whether to refetch /testfile_list
+    return jsonify(registrywatcher.status())
+
+
 @app.route("/run/<path:testname>")
 def run_named_tests(testname):
-    if progress_state.testname:
-        print("ERROR ALREADY RUNNING")
-        return "Error: test already running", 400
+    test_runner.reload_tests()
+    if testname not in apphelpers.testfile_registry:
+        return f"Error: {testname} not found", 404
 
     print(f"run {testname} called")
-    progress_state.step = "0/0"
-    progress_state.testname = testname
+    batch_id, run_ids = get_run_queue().submit([testname])
+    return jsonify({"status": "Started", "run_id": run_ids[0], "batch_id": batch_id})
+
+
+@app.route("/runs", methods=["GET", "POST"])
+def runs():
+    if request.method == "GET":
+        batch_id = request.args.get("batch_id", type=int)
+        status = request.args.get("status")
+        result = []
+        for run in db.get_runs(batch_id=batch_id, status=status):
+            state = appstate.get_run_state(run["id"])
+            if state is not None and run["status"] == "running":
+                run["progress"] = state.as_dict()
+            result.append(run)
+        return jsonify(result)
+
+    # POST {"modules": [...]} or {"filter": {"system": .., "platform": .., "testtype": ..}}
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return jsonify({"status": "error", "message": "Expected a JSON object"}), 400
+    modules = data.get("modules")
+    filters = data.get("filter")
+    if modules is not None and not (isinstance(modules, list) and all(isinstance(m, str) for m in modules)):
+        return jsonify({"status": "error", "message": "modules must be a list of strings"}), 400
+    if filters is None:
+        filters = {}
+    if not isinstance(filters, dict) or not all(isinstance(v, str) or v is None for v in filters.values()):
+        return jsonify({"status": "error", "message": "filter must be an object of strings"}), 400
+    test_runner.reload_tests()
+
+    if modules is None:
+        modules = select_testfiles(filters)
+    missing = [m for m in modules if m not in apphelpers.testfile_registry]
+    if missing:
+        return jsonify({"status": "error", "message": "Unknown testlists", "modules": missing}), 400
+    if not modules:
+        return jsonify({"status": "error", "message": "No testlists matched"}), 400
+
+    batch_id, run_ids = get_run_queue().submit(modules, request=data)
+    batch = db.get_batch(batch_id)
+    return jsonify({"status": "queued", "batch_id": batch_id, "run_ids": run_ids, "modules": modules,
+                    "predicted_finish": batch["predicted_finish"], "workers": batch["workers"]})
+
+
+@app.route("/runs/<int:run_id>")
+def run_info(run_id):
+    run = db.get_run(run_id)
+    if run is None:
+        return jsonify({"status": "error", "message": "Unknown run"}), 404
+    state = appstate.get_run_state(run_id)
+    if state is not None:
+        run["progress"] = state.as_dict()
+    return jsonify(run)
+
+
+@app.route("/runs/<int:run_id>/cancel", methods=["POST"])
+def cancel_run(run_id):
+    status = get_run_queue().cancel(run_id)
+    if status is None:
+        return jsonify({"status": "error", "message": "Unknown run"}), 404
+    return jsonify({"run_id": run_id, "status": status})
+
+
+@app.route("/runs/<int:run_id>/log")
+def run_log(run_id):
+    # in-memory tail while the run is live, ?full=1 for the whole spilled log file
+    log = runlog.get_log(run_id)
+    if log is None:
+        return "No log for this run", 404
+    if request.args.get("full") and os.path.isfile(log.path):
+        directory, filename = os.path.split(log.path)
+        return send_from_directory(directory, filename, mimetype="text/plain")
+    return Response(log.tail(), mimetype="text/plain")
+
+
+@app.route("/runs/<int:run_id>/log/stream")
+def run_log_stream(run_id):
+    log = runlog.get_log(run_id)
+    if log is None:
+        return "No log for this run", 404
+
+    def generate():
+        seq = 0
+        while True:
+            chunks, closed = log.read_since(seq, timeout=SSE_KEEPALIVE)
+            if chunks:
+                seq = chunks[-1][0]
+                yield format_sse("log", {"text": "".join(text for _, text in chunks)})
+            elif closed:
+                yield format_sse("end", {"run_id": run_id})
+                return
+            else:
+                yield ": keepalive\n\n"
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
-    def run():
-        print(f"Thread started for {testname}")
-        res = test_runner.run_testfile(testname, progress_state)
-        print(f"Thread finished for {testname}. Results found: {len(res)}")
-        progress_state.step = "Done"
-        progress_state.testname = None
 
-    threading.Thread(target=run, daemon=True).start()
-    return "Started"
+@app.route("/cancel/<int:run_id>", methods=["POST"])
+def cancel(run_id):
+    return cancel_run(run_id)
+
+
+@app.route("/runs/batch/<int:batch_id>")
+def batch_info(batch_id):
+    # predicted vs actual completion, per run estimate vs duration
+    batch = get_run_queue().batch_status(batch_id)
+    if batch is None:
+        return jsonify({"status": "error", "message": "Unknown batch"}), 404
+    return jsonify(batch)
+
+
+@app.route("/runs/batch/<int:batch_id>/cancel", methods=["POST"])
+def cancel_batch(batch_id):
+    run_queue = get_run_queue()
+    cancelled = {}
+    for run in db.get_runs(batch_id=batch_id):
+        if run["status"] in ("queued", "running"):
+            cancelled[run["id"]] = run_queue.cancel(run["id"])
+    return jsonify({"batch_id": batch_id, "runs": cancelled})
+
+
+# remote workers, see remoteworker.py. a worker claims a run, posts heartbeats with its
+# progress while it runs, then uploads the scratch dir and the RunResult
+@app.before_request
+def check_worker_token():
+    if not request.path.startswith("/api/worker/"):
+        return None
+    if not WORKER_TOKEN:
+        return jsonify({"status": "error", "message": "remote workers are off, set TESTRUNNER_WORKER_TOKEN"}), 403
+    if not hmac.compare_digest(request.headers.get("X-Worker-Token", ""), WORKER_TOKEN):
+        return jsonify({"status": "error", "message": "bad worker token"}), 403
+    return None
+
+
+@app.route("/api/worker/claim", methods=["POST"])
+def worker_claim():
+    # {"worker": name, "shard": i, "shards": n}, 204 when nothing is queued
+    data = request.get_json(silent=True) or {}
+    worker = data.get("worker")
+    if not worker:
+        return jsonify({"status": "error", "message": "worker name required"}), 400
+    try:
+        shard, shards = int(data.get("shard", 0)), max(1, int(data.get("shards", 1)))
+    except (TypeError, ValueError):
+        return jsonify({"status": "error", "message": "bad shard"}), 400
+    job = get_run_queue().claim_remote(worker, shard, shards)
+    if job is None:
+        return "", 204
+    return jsonify(job)
+
+
+@app.route("/api/worker/runs/<int:run_id>/heartbeat", methods=["POST"])
+def worker_heartbeat(run_id):
+    data = request.get_json(silent=True) or {}
+    cancel = get_run_queue().remote_progress(run_id, data.get("worker"), data.get("messages") or [])
+    if cancel is None:
+        return jsonify({"status": "error", "message": "run is not claimed by this worker"}), 409
+    return jsonify({"run_id": run_id, "cancel": cancel})
+
+
+@app.route("/api/worker/runs/<int:run_id>/artifacts", methods=["POST"])
+def worker_artifacts(run_id):
+    # body is the run's scratch dir as a tar.gz, ?worker=name
+    max_bytes = WORKER_UPLOAD_MAX_MB * 1024 * 1024
+    if (request.content_length or 0) > max_bytes:
+        return jsonify({"status": "error", "message": "upload too large"}), 413
+    try:
+        count = get_run_queue().remote_artifacts(run_id, request.args.get("worker"), request.stream, max_bytes)
+    except artifacts.UploadTooLarge as e:
+        return jsonify({"status": "error", "message": str(e)}), 413
+    except Exception as e:
+        return jsonify({"status": "error", "message": f"bad upload: {e}"}), 400
+    if count is None:
+        return jsonify({"status": "error", "message": "run is not claimed by this worker"}), 409
+    return jsonify({"run_id": run_id, "files": count})
+
+
+@app.route("/api/worker/runs/<int:run_id>/result", methods=["POST"])
+def worker_result(run_id):
+    # {"worker": name, "run": RunResult.as_dict() or null, "error": message or null}
+    data = request.get_json(silent=True) or {}
+    status = get_run_queue().remote_finish(run_id, data.get("worker"), data.get("run"), data.get("error"))
+    if status is None:
+        return jsonify({"status": "error", "message": "run is not claimed by this worker"}), 409
+    return jsonify({"run_id": run_id, "status": status})
 
 
 @app.route("/progress")
 def progress():
+    # legacy single-run fields mirror the newest active run, "runs" has every active run
+    active = appstate.list_run_states(active_only=True)
+    running = [s for s in active if s.status == "running"] or active
+
+    if running:
+        current = running[-1].as_dict()
+    else:
+        current = appstate.ProgressState().as_dict()
+        current["step"] = "Done" if appstate.run_states else "Idle"
+
     return jsonify({
-        "step": progress_state.step,
-        "testname": progress_state.testname,
-        "testid": progress_state.testid,
-        "testtype": progress_state.testtype,
-        "step_name": progress_state.step_name
+        "step": current["step"],
+        "testname": current["testname"],
+        "testid": current["testid"],
+        "testtype": current["testtype"],
+        "step_name": current["step_name"],
+        "run_id": current["run_id"],
+        "runs": [s.as_dict() for s in active]
     })
 
 
+@app.route("/progress/stream")
+def progress_stream():
+    # server-sent events: a snapshot of the active runs, then every run/step event
+    subscription = bus.subscribe()
+
+    def active_count():
+        return len(appstate.list_run_states(active_only=True))
+
+    def generate():
+        try:
+            runs = [s.summary() for s in appstate.list_run_states(active_only=True)]
+            yield format_sse("snapshot", {"runs": runs, "active": len(runs)})
+            while True:
+                try:
+                    event = subscription.get(timeout=SSE_KEEPALIVE)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                data = dict(event["data"], active=active_count())
+                yield format_sse(event["type"], data)
+        finally:
+            bus.unsubscribe(subscription)
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@app.route("/progress/<int:run_id>")
+def run_progress(run_id):
+    state = appstate.get_run_state(run_id)
+    if state is None:
+        return jsonify({"status": "error", "message": "Unknown run"}), 404
+    return jsonify(state.as_dict())
+
+
 @app.route("/reports/<path:filepath>")
 def view_report(filepath):
     # filepath could be "timestamp/filename.html" or "filename.html"
     full_path = os.path.join(REPORT_DIR, filepath)
     if not os.path.isfile(full_path):
-        return "File not found", 404
+        # runs recorded with TESTRUNNER_REPORT_MODE=db, or whose html was pruned, render from the db
+        report = db.get_report_by_path(filepath) if filepath.endswith(".html") else None
+        if report is None:
+            return "File not found", 404
+        return Response(stream_with_context(reportrender.render_from_db(db, report)), mimetype="text/html")
     directory, filename = os.path.split(full_path)
     return send_from_directory(directory, filename)
 
 
+@app.route("/api/reports")
+def api_reports():
+    # ?after=<last id of previous page>&limit=&test_id=&status=&type=&since=&until=&name=
+    # since/until take epoch seconds or an iso date
+    try:
+        since = parse_time_arg(request.args.get("since"))
+        until = parse_time_arg(request.args.get("until"))
+    except ValueError as e:
+        return jsonify({"status": "error", "message": str(e)}), 400
+
+    limit = request.args.get("limit", REPORTS_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, REPORTS_PAGE_MAX))
+    reports, next_after = db.get_reports_page(
+        after=request.args.get("after", type=int),
+        limit=limit,
+        testparentname=request.args.get("test_id"),
+        status=request.args.get("status"),
+        test_type=request.args.get("type"),
+        since=since,
+        until=until,
+        name=request.args.get("name"),
+    )
+    return jsonify({"reports": reports, "next_after": next_after})
+
+
+@app.route("/api/results/<int:result_id>/<any(output, stdout):field>")
+def step_output(result_id, field):
+    # full step output, listings only carry the tail of large ones
+    text = db.get_step_output(result_id, field)
+    if text is None:
+        return "Unknown step result", 404
+    return Response(text, mimetype="text/plain")
+
+
+@app.route("/retention")
+def retention_plan():
+    # dry run: what the next pass would delete, compact and sweep
+    result = retention.plan(db, retention.get_pruner(db).policy)
+    summary = retention.summarize(result, limit=request.args.get("limit", 200, type=int))
+    pruner = retention.get_pruner(db)
+    summary["running"] = pruner.running
+    summary["last_run"] = pruner.last_run
+    summary["storage"] = db.storage_stats()
+    summary["step_cache"] = stepcache.stats()
+    return jsonify(summary)
+
+
+@app.route("/retention/run", methods=["POST"])
+def retention_run():
+    if not retention.get_pruner(db).run_now():
+        return jsonify({"status": "error", "message": "Retention pass already running"}), 409
+    return jsonify({"status": "started"}), 202
+
+
+@app.route("/retention/vacuum", methods=["POST"])
+def retention_vacuum():
+    # ?full=1 rewrites the whole db, otherwise incremental_vacuum of up to ?pages= pages
+    full = request.args.get("full") in ("1", "true")
+    return jsonify(db.vacuum(full=full, pages=request.args.get("pages", 0, type=int)))
+
+
 @app.route('/module_path')
 def module_path():
     import importlib
@@ -328,7 +652,6 @@ def clone_as_new():
 def test_details(test_id):
     report_name = request.args.get("report_name")
     test_runner.reload_tests()
-    all_summaries = db.get_all_reports_summary(test_parent_name=test_id)
 
     # test status for buttons
     # returns testparentname, testtype, status
@@ -374,33 +697,52 @@ def test_details(test_id):
     failure_logs = db.get_failed_steps_log(test_id)
     print("failurelogsdebug: ", test_id, "LOGS", failure_logs)
 
-    reports = []
-    for r in all_summaries:
-        filename = os.path.basename(r[0])
-        if report_name is None or report_name in filename:
-            reports.append({
-                "filename": filename,
-                "filepath": r[0],
-                "duration": r[1],
-                "status": r[2],
-                "timestamp": r[3]
-            })
-
-    # sort & return only the most recent 5 results
-    reports.sort(key=lambda r: r["timestamp"], reverse=True)
-    reports = reports[:5]
-
     return render_template(
         "test_detail.html",
         testname=test_id,
         test_info=matching_tests,
-        reports=reports,
         internal_id=test_id,
         latest_summary=latest_summary,
-        failure_logs=failure_logs
+        failure_logs=failure_logs,
+        report_name=report_name or ""
     )
 
 
+def get_run_queue():
+    return runqueue.get_run_queue(db, RUN_WORKERS)
+
+
+def parse_time_arg(value):
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        raise ValueError(f"bad timestamp: {value}")
+
+
+def select_testfiles(filters):
+    # match registry entries on system / platform / testtype, all optional
+    system = filters.get("system")
+    platform = filters.get("platform")
+    testtype = filters.get("testtype")
+
+    modules = []
+    for modname, info in sorted(apphelpers.testfile_registry.items()):
+        if system and (info.get("system") or "").upper() != system.upper():
+            continue
+        if platform and info.get("platform") != platform:
+            continue
+        if testtype and testtype not in (info.get("types") or {}):
+            continue
+        modules.append(modname)
+    return modules
+
+
 def get_dynamic_action_schema(output_data):
     action_schema = {}
     
@@ -516,6 +858,16 @@ if __name__ == "__main__":
 
 
     if not os.path.exists(DB_PATH):
-        test_runner.db.init_report_db(DB_PATH)
+        db.init_report_db(DB_PATH)
+
+    # only the reloader child serves requests, don't watch or resume runs from the parent too
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        if REGISTRY_WATCH:
+            registrywatcher.start(TESTLIST_ROOT, TESTSRC_HELPERDIR,
+                                  mode=REGISTRY_WATCH, poll_interval=REGISTRY_POLL_INTERVAL)
+        # picks up batches left queued or running by a previous process
+        get_run_queue()
+        retention.start(db)
+        imagepipeline.start()
     app.run(host="0.0.0.0", port=8080, debug=True)
 
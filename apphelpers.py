@@ -6,6 +6,8 @@ _step_counter = 0
 
 testfile_registry = {}
 registry_map = {}
+# bumped whenever testfile_registry or the step dispatch changes
+registry_version = 0
 
 
 helperdir = "/testsrc/pyhelpers"
@@ -16,6 +18,12 @@ def clear_registries():
     testfile_registry.clear()
 
 
+def bump_registry_version():
+    global registry_version
+    registry_version += 1
+    return registry_version
+
+
 def _add_to_registry(registry, description, func):
     func.test_description = description
     if func not in registry:
@@ -83,6 +91,10 @@ def init_test_env(config, module_name):
         paths["linker"] = os.path.join(paths["projdir"], folder + "_linker.cfg")
         
     paths["cmain_abs"] = os.path.join(paths["src"], config["cmainfile"] + ".c")
+    # the run's own dir for logs, screenshots and dumps, see artifacts.py. outside a run
+    # (registry scans) it falls back to the project output dir
+    from artifacts import SCRATCH_ENV
+    paths["scratch"] = os.environ.get(SCRATCH_ENV) or paths["out"]
 
     register_testfile(
         #id=folder,
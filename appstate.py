@@ -1,14 +1,117 @@
 # this is in its own file so it can be imported easily
+import time
+import threading
+import itertools
+
+from eventbus import bus
+
+MAX_FINISHED_RUNS = 200
+
 
 class ProgressState:
-    def __init__(self):
+    # progress record for a single run, one per run_id
+    def __init__(self, run_id=None, testname=""):
+        self.run_id = run_id
+        self.status = "queued" # queued / running / done / failed / cancelled
         self.step = "Idle"
-        self.testname = "" # dot path old
+        self.testname = testname # dot path old
         self.testid = "" # new - name with spaces included
         self.testtype = "" # info like build test or test1 test type - for button label
         self.step_name = ""
+        self.result = None
+        self.report_path = None
+        self.scratch_dir = None # scratch dir of the running worker, see artifacts.py
+        self.steps = [] # finished step summaries, logs stay in the db
+        self.batch_id = None
+        self.estimate = None # expected seconds from past runs, see sharding.py
+        self.batch_eta = None # when the batch was predicted to finish
+        self.queued_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    def summary(self):
+        # as_dict without the step list, sent with every progress event
+        data = self.as_dict()
+        data.pop("steps")
+        return data
+
+    def as_dict(self):
+        return {
+            "run_id": self.run_id,
+            "status": self.status,
+            "step": self.step,
+            "testname": self.testname,
+            "testid": self.testid,
+            "testtype": self.testtype,
+            "step_name": self.step_name,
+            "result": self.result,
+            "report_path": self.report_path,
+            "steps": self.steps,
+            "batch_id": self.batch_id,
+            "estimate": self.estimate,
+            "batch_eta": self.batch_eta,
+            "queued_at": self.queued_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+    def set_status(self, status, step=None):
+        self.status = status
+        if step is not None:
+            self.step = step
+        if status == "running" and self.started_at is None:
+            self.started_at = time.time()
+        elif status not in ("queued", "running"):
+            self.finished_at = time.time()
+        bus.publish("run", {"run": self.summary()})
+
+    def step_started(self, index, total, name):
+        self.step = f"{index}/{total}"
+        self.step_name = name
+        bus.publish("step_start", {"run": self.summary(), "index": index, "name": name})
+
+    def step_finished(self, index, result):
+        # result is a results.StepResult, output stays out of the progress events
+        step = dict(result.as_dict(), index=index)
+        self.steps.append(step)
+        bus.publish("step_finish", dict(step, run=self.summary()))
+
+    def steps_done(self):
+        # the runnerpool.PipeReporter counterpart tells the pool the step loop is over
+        pass
+
+
+# per-run progress, keyed by run_id
+run_states = {}
+_run_states_lock = threading.Lock()
+_run_ids = itertools.count(1)
+
+
+def new_run_state(testname, run_id=None):
+    with _run_states_lock:
+        if run_id is None:
+            run_id = next(_run_ids)
+        state = ProgressState(run_id, testname)
+        run_states[run_id] = state
+
+        finished = [s for s in run_states.values() if s.status not in ("queued", "running")]
+        if len(finished) > MAX_FINISHED_RUNS:
+            finished.sort(key=lambda s: s.finished_at or 0)
+            for s in finished[:len(finished) - MAX_FINISHED_RUNS]:
+                run_states.pop(s.run_id, None)
+        return state
+
+
+def get_run_state(run_id):
+    return run_states.get(run_id)
+
 
-progress_state = ProgressState()
+def list_run_states(active_only=False):
+    with _run_states_lock:
+        states = list(run_states.values())
+    if active_only:
+        states = [s for s in states if s.status in ("queued", "running")]
+    return sorted(states, key=lambda s: s.run_id)
 
 # nav bar button builder
 def build_nav(app):
@@ -23,4 +126,4 @@ def nav(label):
     def decorator(f):
         f.nav_label = label
         return f
-    return decorator
\ No newline at end of file
+    return decorator
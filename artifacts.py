@@ -0,0 +1,282 @@
+import os
+import re
+import time
+import shutil
+import hashlib
+import tarfile
+import tempfile
+from contextlib import contextmanager
+
+from dbhelper import REPORT_DIR
+from imagepipeline import SCREENSHOT_RE, convert_screenshot, thumb_name
+
+
+# every run works in its own dir under here, cwd included. compile logs, screenshots and
+# dumps the steps leave in it are moved under the report once the run is recorded
+SCRATCH_DIR = os.path.join(REPORT_DIR, "_scratch")
+# tools spawned by a step find it here, dispatch functions in context["scratch_dir"]
+# and testlists in paths["scratch"]
+SCRATCH_ENV = "TESTRUNNER_SCRATCH_DIR"
+# what is left of the scratch dir after collection: "failed" keeps it as <report dir>/scratch
+# for failed runs, "always" for every run, "never" drops it
+KEEP_SCRATCH = os.environ.get("TESTRUNNER_KEEP_SCRATCH", "failed")
+KEPT_SCRATCH_NAME = "scratch"
+# files under this subdir of the scratch dir are collected whatever their name
+ARTIFACT_SUBDIR = "artifacts"
+# mtime granularity when tying a file to the step that wrote it
+MTIME_SLACK = 1.0
+
+LOG_EXTS = (".log", ".txt", ".lst", ".map", ".lbl", ".err")
+DUMP_EXTS = (".vsf", ".bin", ".dmp", ".dump", ".mem")
+# screenshot-vice1-6-1.png and screenshot-vice2-6.png belong to step 6, so does step6_mem.bin
+STEP_RE = re.compile(r"(?:screenshot-[^-]+-|step)(\d+)(?=[-._])")
+
+
+class Artifact:
+    # one file collected from a run, name is relative to the report dir
+    __slots__ = ("name", "kind", "size", "hash", "step_index")
+
+    def __init__(self, name, kind, size=None, hash=None, step_index=None):
+        self.name = name
+        self.kind = kind
+        self.size = size
+        self.hash = hash
+        self.step_index = step_index
+
+    def as_dict(self):
+        return {
+            "name": self.name,
+            "kind": self.kind,
+            "size": self.size,
+            "hash": self.hash,
+            "step_index": self.step_index,
+        }
+
+    def __repr__(self):
+        return f"Artifact({self.name!r}, {self.kind}, step {self.step_index})"
+
+
+def classify(fname):
+    # "screenshot" | "log" | "dump", None for build intermediates that stay in the scratch dir
+    if SCREENSHOT_RE.match(fname):
+        return "screenshot"
+    if fname.lower().endswith(LOG_EXTS):
+        return "log"
+    if fname.lower().endswith(DUMP_EXTS):
+        return "dump"
+    return None
+
+
+def is_image(name):
+    return name.lower().endswith((".png", ".gif"))
+
+
+def open_scratch_dir():
+    os.makedirs(SCRATCH_DIR, exist_ok=True)
+    return tempfile.mkdtemp(prefix=time.strftime("%Y%m%d_%H%M%S_"), dir=SCRATCH_DIR)
+
+
+def remove_scratch_dir(scratch_dir):
+    if scratch_dir:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+
+@contextmanager
+def scratch_env(scratch_dir):
+    # the run's scratch dir as cwd and in the environment of everything the steps start.
+    # only for runner workers, they run one testlist at a time
+    cwd = os.getcwd()
+    previous = os.environ.get(SCRATCH_ENV)
+    os.environ[SCRATCH_ENV] = scratch_dir
+    os.chdir(scratch_dir)
+    try:
+        yield scratch_dir
+    finally:
+        os.chdir(cwd)
+        if previous is None:
+            os.environ.pop(SCRATCH_ENV, None)
+        else:
+            os.environ[SCRATCH_ENV] = previous
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _owning_step(fname, mtime, steps):
+    # the index in the name wins, otherwise the step that was running when the file was written
+    m = STEP_RE.search(fname)
+    if m and 1 <= int(m.group(1)) <= len(steps):
+        return int(m.group(1))
+    best, best_gap = None, MTIME_SLACK
+    for idx, step in enumerate(steps, start=1):
+        gap = max(step.start_time - mtime, mtime - step.stop_time, 0.0)
+        if gap == 0.0:
+            return idx
+        if gap <= best_gap:
+            best, best_gap = idx, gap
+    return best
+
+
+def _sources(scratch_dir):
+    # (path, name in the report dir, kind) for every file of the scratch dir worth keeping
+    for root, _, files in os.walk(scratch_dir):
+        rel_root = os.path.relpath(root, scratch_dir)
+        forced = rel_root.split(os.sep)[0] == ARTIFACT_SUBDIR
+        for fname in sorted(files):
+            kind = classify(fname) or ("file" if forced else None)
+            if kind is None:
+                continue
+            path = os.path.join(root, fname)
+            name = os.path.relpath(path, scratch_dir)
+            if forced:
+                name = os.path.relpath(name, ARTIFACT_SUBDIR)
+            yield path, name, kind
+
+
+def _free_name(subdir_path, name):
+    dest = os.path.join(subdir_path, name)
+    stem, ext = os.path.splitext(name)
+    n = 1
+    while os.path.exists(dest):
+        n += 1
+        dest = os.path.join(subdir_path, f"{stem}_{n}{ext}")
+    return dest
+
+
+def collect(run, subdir_path, scratch_dir=None):
+    # one pass over the run's scratch dir: artifacts are moved under subdir_path, hashed and tied
+    # to their step. sets run.artifacts to the manifest and each step's artifacts to its screenshots
+    manifest = []
+    if scratch_dir and os.path.isdir(scratch_dir):
+        for src, name, kind in _sources(scratch_dir):
+            ppm = kind == "screenshot" and name.lower().endswith(".ppm")
+            dest = _free_name(subdir_path, os.path.splitext(name)[0] + ".png" if ppm else name)
+            try:
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                if ppm:
+                    # converted here rather than by the image pipeline, the manifest has to
+                    # name and hash the png the report will actually link
+                    ppm_dest = os.path.splitext(dest)[0] + ".ppm"
+                    shutil.move(src, ppm_dest)
+                    mtime = os.stat(ppm_dest).st_mtime
+                    try:
+                        dest = convert_screenshot(ppm_dest, os.path.join(subdir_path, thumb_name(
+                            os.path.relpath(dest, subdir_path))))
+                        # keeps tying it to the step that wrote the ppm
+                        os.utime(dest, (mtime, mtime))
+                    except (OSError, ValueError) as e:
+                        print(f"[artifacts] {src}: kept as ppm, {e}")
+                        dest = ppm_dest
+                else:
+                    shutil.move(src, dest)
+                st = os.stat(dest)
+                digest = _sha256(dest)
+            except OSError as e:
+                print(f"[artifacts] {src}: {e}")
+                continue
+            rel = os.path.relpath(dest, subdir_path).replace(os.sep, "/")
+            manifest.append(Artifact(rel, kind, st.st_size, digest,
+                                     _owning_step(os.path.basename(rel), st.st_mtime, run.steps)))
+
+    for idx, step in enumerate(run.steps, start=1):
+        step.artifacts = [a.name for a in manifest
+                          if a.step_index == idx and a.kind == "screenshot" and is_image(a.name)]
+    run.artifacts = manifest
+
+    _release_scratch(run, subdir_path, scratch_dir)
+    return manifest
+
+
+def _release_scratch(run, subdir_path, scratch_dir):
+    if not scratch_dir or not os.path.isdir(scratch_dir):
+        return
+    keep = KEEP_SCRATCH == "always" or (KEEP_SCRATCH == "failed" and (run.failed or not run.steps))
+    if keep and any(files for _, _, files in os.walk(scratch_dir)):
+        # lives and dies with the report, retention removes both together
+        kept = os.path.join(subdir_path, KEPT_SCRATCH_NAME)
+        try:
+            shutil.move(scratch_dir, kept)
+            print(f"[artifacts] kept scratch dir as {kept}")
+            return
+        except OSError as e:
+            print(f"[artifacts] could not keep {scratch_dir}: {e}")
+    remove_scratch_dir(scratch_dir)
+
+
+def pack(scratch_dir, fileobj):
+    # the scratch dir of a run on a remote worker as a tar.gz, mtimes included so the
+    # server can still tie files to steps
+    with tarfile.open(fileobj=fileobj, mode="w|gz") as tar:
+        for name in sorted(os.listdir(scratch_dir)):
+            tar.add(os.path.join(scratch_dir, name), arcname=name)
+
+
+# the "data" filter where this python has it (3.11.4+), the checks in unpack cover older ones
+_EXTRACT_ARGS = {"filter": "data"} if hasattr(tarfile, "data_filter") else {}
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+class _LimitedReader:
+    # counts what is read from a request body, chunked uploads have no content length to check
+    def __init__(self, fileobj, max_bytes):
+        self.fileobj = fileobj
+        self.max_bytes = max_bytes
+        self.read_bytes = 0
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.read_bytes += len(data)
+        if self.read_bytes > self.max_bytes:
+            raise UploadTooLarge(f"upload over {self.max_bytes} bytes")
+        return data
+
+
+def unpack(fileobj, scratch_dir, max_bytes=None):
+    # a worker's upload into a scratch dir of this host, regular files and dirs only and
+    # nothing that would land outside scratch_dir. returns the number of files. max_bytes
+    # caps the upload and what it unpacks to, UploadTooLarge once either goes over
+    count = 0
+    size = 0
+    root = os.path.realpath(scratch_dir)
+    if max_bytes is not None:
+        fileobj = _LimitedReader(fileobj, max_bytes)
+    with tarfile.open(fileobj=fileobj, mode="r|gz") as tar:
+        for member in tar:
+            size += member.size
+            if max_bytes is not None and size > max_bytes:
+                raise UploadTooLarge(f"upload unpacks to over {max_bytes} bytes")
+            dest = os.path.realpath(os.path.join(root, member.name))
+            if not (member.isfile() or member.isdir()) or not dest.startswith(root + os.sep):
+                print(f"[artifacts] skipped {member.name!r} in upload")
+                continue
+            # keep the mtime, not the worker's owner or permissions
+            member.mode = 0o755 if member.isdir() else 0o644
+            member.uid, member.gid, member.uname, member.gname = os.getuid(), os.getgid(), "", ""
+            tar.extract(member, root, **_EXTRACT_ARGS)
+            count += member.isfile()
+    return count
+
+
+def sweep_scratch(max_age):
+    # scratch dirs of runs that died before they were recorded
+    removed = 0
+    if not os.path.isdir(SCRATCH_DIR):
+        return removed
+    now = time.time()
+    for name in os.listdir(SCRATCH_DIR):
+        path = os.path.join(SCRATCH_DIR, name)
+        try:
+            if now - os.path.getmtime(path) > max_age:
+                shutil.rmtree(path, ignore_errors=True)
+                removed += 1
+        except OSError:
+            continue
+    return removed
@@ -0,0 +1,74 @@
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+from dbhelper import ReportDB
+from results import Status, StepResult, RunResult
+
+
+# times ReportDB.populate_sqlite on a throwaway db: one big run, then many small ones
+# usage: python bench_populate.py [--steps 10000] [--runs 200] [--repeat 3]
+
+
+def make_run(steps):
+    now = time.time()
+    run = RunResult("bench.list", "bench", "build", started_at=now)
+    for i in range(1, steps + 1):
+        run.steps.append(StepResult(
+            f"{i}_step", Status.FAIL if i % 500 == 0 else Status.PASS,
+            f"output of step {i}\n" * 3, f"stdout {i}", 0.01, start_time=now + i * 0.01
+        ))
+    return run
+
+
+def bench(label, fn, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print(f"{label:>8}: {best:.3f}s (best of {repeat})")
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="populate_sqlite benchmark")
+    parser.add_argument("--steps", type=int, default=10000, help="steps of the big run")
+    parser.add_argument("--runs", type=int, default=200, help="number of small runs")
+    parser.add_argument("--small-steps", type=int, default=20, help="steps per small run")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_populate_")
+    try:
+        db = ReportDB(os.path.join(workdir, "bench.sqlite"))
+        report_path = os.path.join(workdir, "run", "bench.html")
+        os.makedirs(os.path.dirname(report_path))
+
+        big = make_run(args.steps)
+        best = bench("big", lambda: db.populate_sqlite(big, report_path), args.repeat)
+        print(f"{'':>8}  {args.steps} steps, {args.steps / best:.0f} steps/s")
+
+        small = make_run(args.small_steps)
+
+        def populate_small():
+            for _ in range(args.runs):
+                db.populate_sqlite(small, report_path)
+
+        best = bench("small", populate_small, args.repeat)
+        print(f"{'':>8}  {args.runs} runs of {args.small_steps} steps, {best / args.runs * 1000:.2f}ms per run")
+
+        # everything above went in as reports
+        reports, _ = db.get_reports_page(limit=1)
+        assert reports and reports[0]["steps"] == args.small_steps, reports
+        db.close()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,7 +1,18 @@
 import os
+import json
+import time
+import zlib
+import hashlib
 import sqlite3
-from collections import defaultdict
-import re
+import threading
+from contextlib import contextmanager
+
+from results import FAILED_STATUSES as FAILED_STEP_STATUSES
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 
 #######################################
@@ -11,24 +22,381 @@ REPORT_DIR = os.path.join(BASE_DIR, "reports")
 FLASKRUNNER_HELPERDIR = "/testrunnerapp/helpers"
 TESTSRC_HELPERDIR = "/testsrc/helpers"
 DB_PATH = os.path.join(BASE_DIR, "report.sqlite")
+# seconds a writer waits on a locked db before giving up
+DB_BUSY_TIMEOUT = 30
+# negative = KiB, so roughly 32MB of page cache per connection
+DB_CACHE_SIZE = -32000
+# step output/stdout longer than this (chars) moves to the compressed blob table
+BLOB_THRESHOLD = int(os.environ.get("TESTRUNNER_BLOB_THRESHOLD", "4096"))
+# tail of a moved output kept inline so listings still show where it ended
+BLOB_PREVIEW_CHARS = 1000
 #######################################
 
+# statuses that count a step, and so its test, as failed, as a tuple for sql IN clauses
+FAILED_STATUSES = tuple(sorted(s.value for s in FAILED_STEP_STATUSES))
+
+
+def _column_names(cur, table):
+    return {r[1] for r in cur.execute(f"PRAGMA table_info({table})").fetchall()}
+
+
+def _migration_report_total_duration(cur):
+    # used to be attempted with ALTER TABLE inside every populate_sqlite call
+    if "total_duration" not in _column_names(cur, "report"):
+        cur.execute("ALTER TABLE report ADD COLUMN total_duration REAL")
+
+
+def _migration_result_indexes(cur):
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_test_result_parent_types_report ON test_result (testparentname, test_types, report_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_test_result_report_index ON test_result (report_id, test_index)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_test_result_test_id ON test_result (test_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_test_result_status ON test_result (status)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_run_queue_status ON run_queue (status, id)")
+
+
+def _latest_status_values(statuses, names, durations):
+    # aggregate one report's steps into (status, total duration, failing step names as json)
+    failed = [n for n, st in zip(names, statuses) if (st or "").upper() in FAILED_STATUSES]
+    if failed:
+        status = "FAIL"
+    elif any((st or "").upper() in ("PASS", "CACHED") for st in statuses):
+        status = "PASS"
+    else:
+        status = None
+    total = round(sum(d or 0 for d in durations), 2)
+    return status, total, json.dumps(failed)
+
+
+def _upsert_latest_status(cur, testparentname, test_types, test_id, report_id, step_count, values):
+    status, total, failed = values
+    # report ids only grow, the guard keeps a backfill or replay from moving a row backwards
+    cur.execute("""
+        INSERT INTO latest_status
+        (testparentname, test_types, test_id, report_id, status, total_duration, step_count, failed_steps, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (testparentname, test_types) DO UPDATE SET
+            test_id = excluded.test_id,
+            report_id = excluded.report_id,
+            status = excluded.status,
+            total_duration = excluded.total_duration,
+            step_count = excluded.step_count,
+            failed_steps = excluded.failed_steps,
+            updated_at = excluded.updated_at
+        WHERE excluded.report_id >= latest_status.report_id
+    """, (testparentname, test_types, test_id, report_id, status, total, step_count, failed, time.time()))
+
+
+def _migration_latest_status(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS latest_status (
+            testparentname TEXT NOT NULL,
+            test_types TEXT NOT NULL,
+            test_id TEXT,
+            report_id INTEGER NOT NULL,
+            status TEXT,
+            total_duration REAL,
+            step_count INTEGER,
+            failed_steps TEXT,
+            updated_at REAL,
+            PRIMARY KEY (testparentname, test_types)
+        )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_latest_status_report ON latest_status (report_id)")
+
+    # backfill from the existing history, one pass over the latest report of each test/type
+    latest = cur.execute("""
+        SELECT testparentname, test_types, MAX(report_id)
+        FROM test_result
+        WHERE testparentname IS NOT NULL AND test_types IS NOT NULL
+        GROUP BY testparentname, test_types
+    """).fetchall()
+    for testparentname, test_types, report_id in latest:
+        rows = cur.execute("""
+            SELECT test_id, name, status, duration FROM test_result
+            WHERE report_id = ? AND testparentname = ? AND test_types = ?
+            ORDER BY test_index
+        """, (report_id, testparentname, test_types)).fetchall()
+        values = _latest_status_values([r[2] for r in rows], [r[1] for r in rows], [r[3] for r in rows])
+        _upsert_latest_status(cur, testparentname, test_types, rows[0][0], report_id, len(rows), values)
+
+
+def _migration_report_summary_columns(cur):
+    # per-report summary kept on the report row so history pages never join test_result
+    columns = _column_names(cur, "report")
+    for name, decl in (("test_id", "TEXT"), ("testparentname", "TEXT"), ("test_types", "TEXT"),
+                       ("status", "TEXT"), ("started_at", "REAL"), ("step_count", "INTEGER")):
+        if name not in columns:
+            cur.execute(f"ALTER TABLE report ADD COLUMN {name} {decl}")
+
+    # correlated subqueries rather than UPDATE ... FROM, which needs sqlite 3.33
+    cur.execute(f"""
+        UPDATE report SET
+            test_id = (SELECT MAX(test_id) FROM test_result WHERE report_id = report.id),
+            testparentname = (SELECT MAX(testparentname) FROM test_result WHERE report_id = report.id),
+            test_types = (SELECT MAX(test_types) FROM test_result WHERE report_id = report.id),
+            status = (
+                SELECT CASE WHEN MAX(status IN {FAILED_STATUSES}) = 1 THEN 'FAIL' ELSE 'PASS' END
+                FROM test_result WHERE report_id = report.id
+            ),
+            started_at = (SELECT MIN(start_time) FROM test_result WHERE report_id = report.id),
+            step_count = (SELECT COUNT(*) FROM test_result WHERE report_id = report.id)
+        WHERE status IS NULL
+    """)
+
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_report_parent ON report (testparentname, id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_report_status ON report (status, id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_report_started ON report (started_at)")
+
+
+def _migration_report_compacted(cur):
+    # set by retention once old passing output has been stripped from a report
+    if "compacted" not in _column_names(cur, "report"):
+        cur.execute("ALTER TABLE report ADD COLUMN compacted INTEGER NOT NULL DEFAULT 0")
+
+
+def _compress(data):
+    if zstandard is not None:
+        return "zstd", zstandard.ZstdCompressor(level=9).compress(data)
+    return "zlib", zlib.compress(data, 6)
+
+
+def _decompress(codec, payload):
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("output stored with zstd but the zstandard module is not installed")
+        return zstandard.ZstdDecompressor().decompress(payload)
+    if codec == "zlib":
+        return zlib.decompress(payload)
+    return payload
+
+
+def _split_output(cur, text):
+    # (inline text, blob hash): large text is stored once, compressed, keyed by its sha256
+    if not text or len(text) <= BLOB_THRESHOLD:
+        return text, None
+    data = text.encode("utf-8", errors="replace")
+    digest = hashlib.sha256(data).hexdigest()
+    # identical logs from earlier runs are already there
+    if cur.execute("SELECT 1 FROM blob WHERE hash = ?", (digest,)).fetchone() is None:
+        codec, payload = _compress(data)
+        cur.execute(
+            "INSERT OR IGNORE INTO blob (hash, codec, size, data) VALUES (?, ?, ?, ?)",
+            (digest, codec, len(data), payload)
+        )
+    return text[-BLOB_PREVIEW_CHARS:], digest
+
+
+def _gc_blobs(cur, hashes):
+    # drops the given blobs once no step references them any more
+    hashes = [h for h in set(hashes) if h]
+    for i in range(0, len(hashes), 500):
+        batch = hashes[i:i + 500]
+        marks = ",".join("?" * len(batch))
+        cur.execute(f"""
+            DELETE FROM blob WHERE hash IN ({marks})
+            AND NOT EXISTS (SELECT 1 FROM test_result WHERE output_blob = blob.hash)
+            AND NOT EXISTS (SELECT 1 FROM test_result WHERE stdout_blob = blob.hash)
+        """, batch)
+
+
+def _migration_output_blobs(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS blob (
+            hash TEXT PRIMARY KEY,
+            codec TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            data BLOB NOT NULL
+        )
+    """)
+    columns = _column_names(cur, "test_result")
+    for name in ("output_blob", "stdout_blob"):
+        if name not in columns:
+            cur.execute(f"ALTER TABLE test_result ADD COLUMN {name} TEXT")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_test_result_output_blob ON test_result (output_blob)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_test_result_stdout_blob ON test_result (stdout_blob)")
+
+    # move existing large outputs out of row, a chunk of rows at a time
+    last_id = 0
+    while True:
+        rows = cur.execute("""
+            SELECT id, output, stdout FROM test_result
+            WHERE id > ? AND (length(output) > ? OR length(stdout) > ?)
+            ORDER BY id LIMIT 200
+        """, (last_id, BLOB_THRESHOLD, BLOB_THRESHOLD)).fetchall()
+        if not rows:
+            break
+        for result_id, output, stdout in rows:
+            output, output_blob = _split_output(cur, output)
+            stdout, stdout_blob = _split_output(cur, stdout)
+            cur.execute(
+                "UPDATE test_result SET output = ?, output_blob = ?, stdout = ?, stdout_blob = ? WHERE id = ?",
+                (output, output_blob, stdout, stdout_blob, result_id)
+            )
+        last_id = rows[-1][0]
+
+
+def _migration_step_metrics(cur):
+    # per-step resource usage as json, see results.usage_delta
+    if "metrics" not in _column_names(cur, "test_result"):
+        cur.execute("ALTER TABLE test_result ADD COLUMN metrics TEXT")
+
+
+def _migration_report_path_index(cur):
+    # reports rendered on demand are looked up by the path in their url
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_report_path ON report (path)")
+
+
+def _migration_artifacts(cur):
+    # files collected from a run, see artifacts.collect
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS artifact (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            report_id INTEGER NOT NULL,
+            test_index INTEGER,
+            name TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            size INTEGER,
+            hash TEXT
+        )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_artifact_report ON artifact (report_id, test_index)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_artifact_hash ON artifact (hash)")
+
+    # older reports only know their screenshots, by name
+    last_id = 0
+    while True:
+        rows = cur.execute("""
+            SELECT id, report_id, test_index, screenshot FROM test_result
+            WHERE id > ? AND screenshot IS NOT NULL AND screenshot != ''
+            ORDER BY id LIMIT 500
+        """, (last_id,)).fetchall()
+        if not rows:
+            break
+        cur.executemany(
+            "INSERT INTO artifact (report_id, test_index, name, kind) VALUES (?, ?, ?, 'screenshot')",
+            [(report_id, test_index, name) for _, report_id, test_index, names in rows
+             for name in names.split(",") if name]
+        )
+        last_id = rows[-1][0]
+
+
+def _migration_run_queue_worker(cur):
+    # runs claimed by a remote worker (remoteworker.py) and when it last reported in
+    columns = _column_names(cur, "run_queue")
+    for name, decl in (("worker", "TEXT"), ("heartbeat_at", "REAL")):
+        if name not in columns:
+            cur.execute(f"ALTER TABLE run_queue ADD COLUMN {name} {decl}")
+
+
+def _migration_run_estimates(cur):
+    # expected duration of each queued run and when its batch was predicted to finish,
+    # see sharding.py
+    if "estimate" not in _column_names(cur, "run_queue"):
+        cur.execute("ALTER TABLE run_queue ADD COLUMN estimate REAL")
+    columns = _column_names(cur, "run_batch")
+    for name, decl in (("predicted_finish", "REAL"), ("workers", "INTEGER")):
+        if name not in columns:
+            cur.execute(f"ALTER TABLE run_batch ADD COLUMN {name} {decl}")
+
+
+# (version, description, function(cursor)), append only - never edit an applied migration
+MIGRATIONS = [
+    (1, "report.total_duration column", _migration_report_total_duration),
+    (2, "test_result and run_queue indexes", _migration_result_indexes),
+    (3, "latest_status table", _migration_latest_status),
+    (4, "report summary columns", _migration_report_summary_columns),
+    (5, "report.compacted column", _migration_report_compacted),
+    (6, "compressed output blobs", _migration_output_blobs),
+    (7, "test_result.metrics column", _migration_step_metrics),
+    (8, "report.path index", _migration_report_path_index),
+    (9, "artifact table", _migration_artifacts),
+    (10, "run_queue worker columns", _migration_run_queue_worker),
+    (11, "run estimates and batch predictions", _migration_run_estimates),
+]
+
+
 class ReportDB:
-    def __init__(self):
-        self.DB_PATH = DB_PATH
-        db_dir = os.path.dirname(DB_PATH)
+    # schema setup runs once per db file per process, not per instance
+    _initialized_paths = set()
+    _init_lock = threading.Lock()
+
+    def __init__(self, db_path=DB_PATH):
+        self.DB_PATH = db_path
+        self._local = threading.local()
+        db_dir = os.path.dirname(self.DB_PATH)
         if db_dir and not os.path.exists(db_dir):
             os.makedirs(db_dir, exist_ok=True)
         self._init_db()
 
 
     def _connect(self):
-        return sqlite3.connect(self.DB_PATH)
+        # one cached connection per thread, reopened after a fork
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+
+        conn = sqlite3.connect(self.DB_PATH, timeout=DB_BUSY_TIMEOUT)
+        # only sticks on a new file, and has to come before the switch to wal.
+        # existing dbs pick it up from vacuum(full=True)
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA cache_size={DB_CACHE_SIZE}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
 
 
-    def _init_db(self):
+    @contextmanager
+    def _transaction(self, immediate=False):
+        # commit on success, roll back on error so the cached connection is never left mid-transaction
         conn = self._connect()
-        cur = conn.cursor()
+        if immediate:
+            conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn.cursor()
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and self._local.pid == os.getpid():
+            conn.close()
+        self._local.conn = None
+
+
+    def _init_db(self, force=False):
+        with ReportDB._init_lock:
+            if self.DB_PATH in ReportDB._initialized_paths and not force:
+                return
+            with self._transaction() as cur:
+                self._create_tables(cur)
+            self._migrate()
+            ReportDB._initialized_paths.add(self.DB_PATH)
+
+
+    def schema_version(self):
+        return self._connect().execute("PRAGMA user_version").fetchone()[0]
+
+
+    def _migrate(self):
+        # PRAGMA user_version holds the last applied migration
+        for version, description, migration in MIGRATIONS:
+            with self._transaction(immediate=True) as cur:
+                # re-read inside the write lock, another process may have migrated already
+                current = cur.execute("PRAGMA user_version").fetchone()[0]
+                if version <= current:
+                    continue
+                print(f"[dbhelper] migrating {os.path.basename(self.DB_PATH)} to v{version}: {description}")
+                migration(cur)
+                cur.execute(f"PRAGMA user_version = {version}")
+
+
+    def _create_tables(self, cur):
 
         cur.execute("""
             CREATE TABLE IF NOT EXISTS report (
@@ -57,50 +425,82 @@ class ReportDB:
             )
         """)
 
-        conn.commit()
-        conn.close()
+        self._create_run_queue_tables(cur)
+
+
+    def _create_run_queue_tables(self, cur):
+        # persistent run queue, rows go queued -> running -> done/failed/cancelled
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS run_batch (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                created_at REAL,
+                request TEXT
+            )
+        """)
+
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS run_queue (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                batch_id INTEGER,
+                module_name TEXT,
+                status TEXT,
+                created_at REAL,
+                started_at REAL,
+                finished_at REAL,
+                cancel_requested INTEGER DEFAULT 0,
+                result TEXT
+            )
+        """)
 
 
     def fetch_results_for_report(self, report_id):
-        conn = self._connect()
-        cur = conn.cursor()
+        cur = self._connect().cursor()
+        cur.row_factory = sqlite3.Row
         cur.execute(
             "SELECT * FROM test_result WHERE report_id = ? ORDER BY test_index",
             (report_id,)
         )
         rows = cur.fetchall()
-        conn.close()
         return rows
 
 
+    def get_report_by_path(self, rel_path):
+        cur = self._connect().cursor()
+        cur.row_factory = sqlite3.Row
+        row = cur.execute("SELECT * FROM report WHERE path = ? ORDER BY id DESC LIMIT 1", (rel_path,)).fetchone()
+        return dict(row) if row else None
+
+
     def get_latest_report_summary(self, target_id=None):
-        conn = self._connect()
-        conn.row_factory = sqlite3.Row
-        cur = conn.cursor()
-        cur.execute("SELECT id FROM report ORDER BY id DESC LIMIT 1")
+        # target_id is a test_id (the module name), the newest report overall when not given
+        cur = self._connect().cursor()
+        cur.row_factory = sqlite3.Row
+        if target_id:
+            cur.execute(
+                "SELECT report_id FROM latest_status WHERE test_id = ? ORDER BY report_id DESC LIMIT 1",
+                (target_id,)
+            )
+        else:
+            cur.execute("SELECT report_id FROM latest_status ORDER BY report_id DESC LIMIT 1")
         row = cur.fetchone()
         if not row:
-            conn.close()
             return []
 
-        latest_report_id = row["id"]
-        cur.execute("SELECT * FROM test_result WHERE report_id = ?", (latest_report_id,))
+        cur.execute("SELECT * FROM test_result WHERE report_id = ? ORDER BY test_index", (row["report_id"],))
         rows = cur.fetchall()
-        conn.close()
 
         summary = []
         for r in rows:
-            if target_id and r["test_id"] != target_id:
-                continue
-
             step_name = r["name"] or "Unnamed Step"
             status_raw = r["status"].upper() if r["status"] else "SKIP"
             duration_val = f"{r['duration']:.2f}" if r["duration"] is not None else "0.00"
 
-            if "PASS" in status_raw:
+            if "PASS" in status_raw or status_raw == "CACHED":
                 status = "PASS"
             elif "FAIL" in status_raw:
                 status = "FAIL"
+            elif status_raw in ("TIMEOUT", "CANCELLED"):
+                status = status_raw
             else:
                 status = "SKIP"
 
@@ -116,15 +516,14 @@ class ReportDB:
 
 
     def get_failed_steps_log(self, testparentname, test_types="*"):
-        conn = self._connect()
-        cur = conn.cursor()
+        cur = self._connect().cursor()
         # name = name of test step
         # test_types = build/run test type
         # testparentname = primary key to find a test
         # testparentname + test_type = find a specific test
 
 
-        sql = "SELECT MAX(report_id) FROM test_result WHERE testparentname = ?"
+        sql = "SELECT MAX(report_id) FROM latest_status WHERE testparentname = ?"
         params = [testparentname]
 
         if test_types != "*":
@@ -135,29 +534,31 @@ class ReportDB:
         res = cur.fetchone()
 
         if not res or res[0] is None:
-            conn.close()
             return []
 
         latest_id_for_test = res[0]
 
-        cur.execute("""
-            SELECT testparentname, test_types, name, output
+        marks = ",".join("?" * len(FAILED_STATUSES))
+        cur.execute(f"""
+            SELECT testparentname, test_types, name, output, id, output_blob
             FROM test_result
             WHERE report_id = ?
-            AND status IN ('FAIL', 'ERROR')
+            AND status IN ({marks})
             ORDER BY test_index ASC
-        """, (latest_id_for_test,))
+        """, (latest_id_for_test, *FAILED_STATUSES))
 
 
         rows = cur.fetchall()
-        conn.close()
 
         results = [
             {
                 "testparentname": r[0],
                 "test_type": r[1],
                 "name": r[2],
-                "output": r[3]
+                "output": r[3],
+                "result_id": r[4],
+                # output is only the tail, the full text comes from get_step_output
+                "truncated": r[5] is not None
             }
             for r in rows
         ]
@@ -165,140 +566,257 @@ class ReportDB:
 
 
     def get_all_reports_summary(self, test_parent_name=None):
-        conn = self._connect()
-        cur = conn.cursor()
-        
-        # match fail & error and return fail
+        # every report as (path, duration, status, start time), newest first. kept for old
+        # callers, walks get_reports_page
+        summary = []
+        after = None
+        while True:
+            reports, after = self.get_reports_page(after=after, limit=500, testparentname=test_parent_name)
+            summary.extend((r["filepath"], r["duration"], r["status"].upper(), r["timestamp"]) for r in reports)
+            if after is None:
+                return summary
+
+
+    def get_reports_page(self, after=None, limit=25, testparentname=None, status=None,
+                         test_type=None, since=None, until=None, name=None):
+        # keyset pagination, newest first: pass the last id of a page as after= for the next one
         query = """
-            SELECT 
-                r.path,
-                SUM(tr.duration) as total_duration,
-                CASE 
-                    WHEN MIN(tr.status) IN ('FAIL', 'ERROR') THEN 'FAIL' 
-                    ELSE 'PASS' 
-                END as overall_status,
-                MIN(tr.start_time) as report_start
-            FROM report r
-            LEFT JOIN test_result tr ON r.id = tr.report_id
+            SELECT id, path, total_duration, test_id, testparentname, test_types, status, started_at, step_count
+            FROM report
         """
-        
+        where = []
         params = []
-        if test_parent_name:
-            query += " WHERE tr.testparentname = ?"
-            params.append(test_parent_name)
-            
-        query += """
-            GROUP BY r.id, r.path
-            ORDER BY r.id DESC
-        """
-        
-        cur.execute(query, params)
-        rows = cur.fetchall()
-        conn.close()
-        
-        return [(r[0], f"{r[1]:.2f}" if r[1] is not None else "0.00", r[2].upper() if r[2] else "", r[3]) for r in rows]
-
-
-    def init_report_db(self):
-        db_dir = os.path.dirname(DB_PATH)
-        if db_dir and not os.path.exists(db_dir):
-            os.makedirs(db_dir, exist_ok=True)
+        if after:
+            where.append("id < ?")
+            params.append(after)
+        if testparentname:
+            where.append("testparentname = ?")
+            params.append(testparentname)
+        if status:
+            where.append("status = ?")
+            params.append(status.upper())
+        if test_type:
+            # test_types is stored as a comma separated list
+            where.append("instr(', ' || test_types || ', ', ', ' || ? || ', ') > 0")
+            params.append(test_type)
+        if since is not None:
+            where.append("started_at >= ?")
+            params.append(since)
+        if until is not None:
+            where.append("started_at < ?")
+            params.append(until)
+        if name:
+            where.append("instr(path, ?) > 0")
+            params.append(name)
 
-        conn = self._connect()
-        cur = conn.cursor()
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        # one extra row tells us whether there is a next page
+        query += " ORDER BY id DESC LIMIT ?"
+        params.append(limit + 1)
 
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS report (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                path TEXT
-            )
-        """)
+        cur = self._connect().cursor()
+        cur.row_factory = sqlite3.Row
+        rows = cur.execute(query, params).fetchall()
 
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS test_result (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                report_id INTEGER,
-                test_index INTEGER,
-                test_id TEXT,
-                testparentname TEXT,
-                test_types TEXT,
-                name TEXT,
-                status TEXT,
-                color TEXT,
-                output TEXT,
-                stdout TEXT,
-                duration REAL,
-                start_time REAL,
-                stop_time REAL,
-                screenshot TEXT
-            )
-        """)
+        reports = [
+            {
+                "id": r["id"],
+                "filepath": r["path"],
+                "filename": os.path.basename(r["path"]),
+                "duration": f"{r['total_duration']:.2f}" if r["total_duration"] is not None else "0.00",
+                "status": r["status"] or "",
+                "timestamp": r["started_at"],
+                "test_id": r["test_id"],
+                "testparentname": r["testparentname"],
+                "types": r["test_types"],
+                "steps": r["step_count"],
+            }
+            for r in rows[:limit]
+        ]
+        next_after = reports[-1]["id"] if len(rows) > limit else None
+        return reports, next_after
 
-        conn.commit()
-        conn.close()
 
+    def init_report_db(self, db_path=None):
+        self._init_db(force=True)
 
-    def populate_sqlite(self, test_id, testparentname, test_types, results, html_report_path, total_duration=0.00, get_start=None, get_stop=None):
-        subdir_path = os.path.dirname(html_report_path)
-        screenshot_map = defaultdict(list)
-        for fname in os.listdir(subdir_path):
-            if fname.endswith((".png", ".gif")):
-                m = re.match(r"screenshot-[^-]+-(\d+)(?:-\d+)?\.(png|gif)$", fname)
-                if m:
-                    step_num = int(m.group(1))
-                    screenshot_map[step_num].append(fname)
 
-        conn = self._connect()
-        cur = conn.cursor()
+    def populate_sqlite(self, run, html_report_path):
+        # run is a results.RunResult, step artifacts are the screenshot file names
+        # and run.artifacts the manifest from artifacts.collect
+        with self._transaction() as cur:
+            self._insert_report(cur, run, html_report_path)
 
-        try:
-            cur.execute("ALTER TABLE report ADD COLUMN total_duration REAL")
-        except sqlite3.OperationalError:
-            pass
 
+    def _insert_report(self, cur, run, html_report_path):
         rel_path = os.path.relpath(html_report_path, REPORT_DIR)
+        steps = run.steps
+        test_id, testparentname, test_types = run.module_name, run.testparentname, run.test_types
+        values = _latest_status_values(
+            [s.status for s in steps], [s.name for s in steps], [s.duration for s in steps]
+        )
+        started_at = min((s.start_time for s in steps), default=None)
         cur.execute(
-            "INSERT INTO report (path, total_duration) VALUES (?, ?)",
-            (rel_path, round(total_duration, 2))
+            """
+            INSERT INTO report
+            (path, total_duration, test_id, testparentname, test_types, status, started_at, step_count)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (rel_path, run.duration, test_id, testparentname, test_types,
+             run.status.value, started_at or run.started_at or time.time(), len(steps))
         )
 
         report_id = cur.lastrowid
 
-        for idx, (name, status, color, output, stdout, duration) in enumerate(results, start=1):
-            start_ts = get_start(name) if get_start else None
-            stop_ts = get_stop(name) if get_stop else None
-            screenshots = ",".join(screenshot_map.get(idx, []))
-            cur.execute(
-                """
-                INSERT INTO test_result
-                (report_id, test_index, test_id, testparentname, test_types, name, status, color, output, stdout, duration, start_time, stop_time, screenshot)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                """,
-                (
-                    report_id,
-                    idx,
-                    test_id,
-                    testparentname,
-                    test_types,
-                    name,
-                    status,
-                    color,
-                    output,
-                    stdout,
-                    duration,
-                    start_ts,
-                    stop_ts,
-                    screenshots
-                )
+        rows = []
+        for idx, step in enumerate(steps, start=1):
+            output, output_blob = _split_output(cur, step.output)
+            stdout, stdout_blob = _split_output(cur, step.stdout)
+            rows.append((
+                report_id, idx, test_id, testparentname, test_types, step.name, step.status.value, step.color,
+                output, stdout, step.duration, step.start_time, step.stop_time,
+                ",".join(step.artifacts), output_blob, stdout_blob,
+                json.dumps(step.metrics) if step.metrics else None
+            ))
+
+        # one statement for the whole run, thousands of steps included
+        cur.executemany(
+            """
+            INSERT INTO test_result
+            (report_id, test_index, test_id, testparentname, test_types, name, status, color, output, stdout, duration, start_time, stop_time, screenshot, output_blob, stdout_blob, metrics)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            rows
+        )
+
+        if run.artifacts:
+            cur.executemany(
+                "INSERT INTO artifact (report_id, test_index, name, kind, size, hash) VALUES (?, ?, ?, ?, ?, ?)",
+                [(report_id, a.step_index, a.name, a.kind, a.size, a.hash) for a in run.artifacts]
             )
 
-        conn.commit()
-        conn.close()
+        # keep the per test/type summary in step with the history, same transaction
+        _upsert_latest_status(cur, testparentname, test_types, test_id, report_id, len(steps), values)
 
 
-    def get_reports_by_test_id(self, test_id):
+    def get_artifacts(self, report_id):
+        # manifest of a report, run level files (no step) first
+        cur = self._connect().cursor()
+        cur.row_factory = sqlite3.Row
+        cur.execute("""
+            SELECT test_index, name, kind, size, hash FROM artifact
+            WHERE report_id = ?
+            ORDER BY test_index IS NOT NULL, test_index, name
+        """, (report_id,))
+        return [dict(r) for r in cur.fetchall()]
+
+
+    def get_step_output(self, result_id, field="output"):
+        # full output or stdout of one step, None for an unknown step
+        if field not in ("output", "stdout"):
+            raise ValueError(f"unknown output field: {field}")
+        cur = self._connect().cursor()
+        row = cur.execute(
+            f"SELECT {field}, {field}_blob FROM test_result WHERE id = ?", (result_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        text, digest = row
+        if digest is None:
+            return text or ""
+        blob = cur.execute("SELECT codec, data FROM blob WHERE hash = ?", (digest,)).fetchone()
+        if blob is None:
+            return text or ""
+        return _decompress(blob[0], blob[1]).decode("utf-8", errors="replace")
+
+
+    def get_report_index(self):
+        # one light row per report, newest first, for retention planning
+        cur = self._connect().cursor()
+        cur.row_factory = sqlite3.Row
+        cur.execute("""
+            SELECT id, path, testparentname, test_types, status, started_at, compacted
+            FROM report
+            ORDER BY id DESC
+        """)
+        return [dict(r) for r in cur.fetchall()]
+
+
+    def delete_reports(self, report_ids):
+        # drops the reports and their step rows, returns the paths of the removed reports
+        if not report_ids:
+            return []
+        marks = ",".join("?" * len(report_ids))
+        with self._transaction(immediate=True) as cur:
+            paths = [r[0] for r in cur.execute(f"SELECT path FROM report WHERE id IN ({marks})", report_ids)]
+            blobs = [h for row in cur.execute(
+                f"SELECT output_blob, stdout_blob FROM test_result WHERE report_id IN ({marks})", report_ids
+            ) for h in row]
+            cur.execute(f"DELETE FROM test_result WHERE report_id IN ({marks})", report_ids)
+            _gc_blobs(cur, blobs)
+            cur.execute(f"DELETE FROM artifact WHERE report_id IN ({marks})", report_ids)
+            cur.execute(f"DELETE FROM latest_status WHERE report_id IN ({marks})", report_ids)
+            cur.execute(f"DELETE FROM report WHERE id IN ({marks})", report_ids)
+        return paths
+
+
+    def compact_reports(self, report_ids):
+        # strips output/stdout from passing steps, failures keep theirs
+        if not report_ids:
+            return 0
+        marks = ",".join("?" * len(report_ids))
+        with self._transaction(immediate=True) as cur:
+            blobs = [h for row in cur.execute(
+                f"SELECT output_blob, stdout_blob FROM test_result WHERE report_id IN ({marks}) AND status IN ('PASS', 'CACHED')",
+                report_ids
+            ) for h in row]
+            cur.execute(f"""
+                UPDATE test_result SET output = '', stdout = '', output_blob = NULL, stdout_blob = NULL
+                WHERE report_id IN ({marks}) AND status IN ('PASS', 'CACHED')
+                AND (output != '' OR stdout != '' OR output_blob IS NOT NULL OR stdout_blob IS NOT NULL)
+            """, report_ids)
+            stripped = cur.rowcount
+            _gc_blobs(cur, blobs)
+            cur.execute(f"UPDATE report SET compacted = 1 WHERE id IN ({marks})", report_ids)
+        return stripped
+
+
+    def storage_stats(self):
         conn = self._connect()
-        cur = conn.cursor()
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        blobs, blob_bytes, raw_bytes = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(length(data)), 0), COALESCE(SUM(size), 0) FROM blob"
+        ).fetchone()
+        return {
+            "auto_vacuum": {0: "none", 1: "full", 2: "incremental"}[conn.execute("PRAGMA auto_vacuum").fetchone()[0]],
+            "blobs": blobs,
+            "blob_bytes": blob_bytes,
+            "blob_raw_bytes": raw_bytes,
+            "size_bytes": conn.execute("PRAGMA page_count").fetchone()[0] * page_size,
+            "free_bytes": conn.execute("PRAGMA freelist_count").fetchone()[0] * page_size,
+        }
+
+
+    def vacuum(self, full=False, pages=0):
+        # full rewrites the file (and switches it to incremental auto_vacuum),
+        # otherwise hand back up to pages free pages, 0 for all of them
+        conn = self._connect()
+        before = self.storage_stats()
+        if full:
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("VACUUM")
+        elif before["auto_vacuum"] == "incremental":
+            # the pragma frees one page per step, fetchall runs it to completion
+            conn.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+            conn.commit()
+        after = self.storage_stats()
+        return {"full": full, "before": before, "after": after,
+                "freed_bytes": before["size_bytes"] - after["size_bytes"]}
+
+
+    def get_reports_by_test_id(self, test_id):
+        cur = self._connect().cursor()
         cur.execute("""
             SELECT DISTINCT r.id,
                             r.path
@@ -308,7 +826,6 @@ class ReportDB:
             ORDER BY r.id DESC
         """, (test_id,))
         rows = cur.fetchall()
-        conn.close()
 
         reports = []
         for r in rows:
@@ -325,50 +842,221 @@ class ReportDB:
         #each testparaentname might have multiple test_types
         #so parentname + test_type = unique test key
         #each unique test run of that combo has its own reportid 
-        conn = self._connect()
-        conn.row_factory = sqlite3.Row
-        cur = conn.cursor()
+        cur = self._connect().cursor()
+        cur.row_factory = sqlite3.Row
 
-        query = """
-        SELECT t1.testparentname, t1.test_id, t1.test_types, t1.status 
-        FROM test_result t1
-        WHERE t1.report_id = (
-            SELECT MAX(t2.report_id) 
-            FROM test_result t2 
-            WHERE t2.testparentname = t1.testparentname 
-            AND t2.test_types = t1.test_types
-        )
-        """
+        query = "SELECT testparentname, test_id, test_types, status FROM latest_status"
         params = []
-
         if testparentname:
-            query += " AND t1.testparentname = ?"
+            query += " WHERE testparentname = ?"
             params.append(testparentname)
 
+        cur.execute(query, params)
+        return [
+            {
+                "testparentname": r["testparentname"],
+                "test_id": r["test_id"],
+                "types": r["test_types"],
+                "status": r["status"] or "None"
+            }
+            for r in cur.fetchall()
+        ]
+
+
+    def create_run_batch(self, module_names, request=None, estimates=None, predicted_finish=None, workers=None):
+        # estimates is {module_name: seconds}, predicted_finish when the whole batch should be done
+        now = time.time()
+        estimates = estimates or {}
+        with self._transaction() as cur:
+            cur.execute(
+                "INSERT INTO run_batch (created_at, request, predicted_finish, workers) VALUES (?, ?, ?, ?)",
+                (now, json.dumps(request) if request is not None else None, predicted_finish, workers)
+            )
+            batch_id = cur.lastrowid
+            run_ids = []
+            for module_name in module_names:
+                cur.execute(
+                    "INSERT INTO run_queue (batch_id, module_name, status, created_at, estimate) VALUES (?, ?, 'queued', ?, ?)",
+                    (batch_id, module_name, now, estimates.get(module_name))
+                )
+                run_ids.append(cur.lastrowid)
+        return batch_id, run_ids
+
+
+    def claim_next_run(self, worker=None, choose=None):
+        # atomically move a queued run to running, the oldest one unless choose(rows) picks
+        # another from the queued rows. worker names the remote worker that takes it
+        with self._transaction(immediate=True) as cur:
+            if choose is None:
+                cur.execute("SELECT id, batch_id, module_name FROM run_queue WHERE status = 'queued' ORDER BY id LIMIT 1")
+                row = cur.fetchone()
+            else:
+                cur.execute("SELECT id, batch_id, module_name, estimate FROM run_queue WHERE status = 'queued' ORDER BY id")
+                rows = [{"id": r[0], "batch_id": r[1], "module_name": r[2], "estimate": r[3]} for r in cur.fetchall()]
+                picked = choose(rows) if rows else None
+                row = (picked["id"], picked["batch_id"], picked["module_name"]) if picked else None
+            if row:
+                now = time.time()
+                cur.execute(
+                    "UPDATE run_queue SET status = 'running', started_at = ?, worker = ?, heartbeat_at = ? WHERE id = ?",
+                    (now, worker, now if worker else None, row[0])
+                )
+
+        if not row:
+            return None
+        return {"id": row[0], "batch_id": row[1], "module_name": row[2]}
+
+
+    def touch_remote_run(self, run_id, worker):
+        # heartbeat from the worker running it. returns cancel_requested, None once the run
+        # is no longer that worker's (finished, cancelled while queued or requeued as stale)
+        with self._transaction() as cur:
+            cur.execute(
+                "UPDATE run_queue SET heartbeat_at = ? WHERE id = ? AND status = 'running' AND worker = ?",
+                (time.time(), run_id, worker)
+            )
+            if not cur.rowcount:
+                return None
+            cur.execute("SELECT cancel_requested FROM run_queue WHERE id = ?", (run_id,))
+            return bool(cur.fetchone()[0])
+
+
+    def requeue_stale_runs(self, cutoff):
+        # remote runs whose worker went quiet before cutoff go back in the queue, returns their ids
+        with self._transaction(immediate=True) as cur:
+            cur.execute(
+                "SELECT id FROM run_queue WHERE status = 'running' AND worker IS NOT NULL AND heartbeat_at < ?",
+                (cutoff,)
+            )
+            run_ids = [r[0] for r in cur.fetchall()]
+            cur.executemany(
+                "UPDATE run_queue SET status = 'queued', started_at = NULL, worker = NULL, heartbeat_at = NULL WHERE id = ?",
+                [(run_id,) for run_id in run_ids]
+            )
+        return run_ids
+
+
+    def get_duration_history(self, test_ids, limit=5):
+        # {test_id: [seconds, newest first]} over its last limit reports that weren't cancelled.
+        # wall time of the run, steps of a depends_on graph overlap, sum of the steps as fallback
+        cur = self._connect().cursor()
+        history = {}
+        for test_id in set(test_ids):
+            cur.execute("""
+                SELECT COALESCE(MAX(stop_time) - MIN(start_time), SUM(duration))
+                FROM test_result
+                WHERE test_id = ?
+                GROUP BY report_id
+                HAVING SUM(status = 'CANCELLED') = 0
+                ORDER BY report_id DESC
+                LIMIT ?
+            """, (test_id, limit))
+            history[test_id] = [r[0] for r in cur.fetchall() if r[0] is not None]
+        return history
+
+
+    def finish_run(self, run_id, status, result=None):
+        with self._transaction() as cur:
+            cur.execute(
+                "UPDATE run_queue SET status = ?, finished_at = ?, result = ? WHERE id = ?",
+                (status, time.time(), json.dumps(result) if result is not None else None, run_id)
+            )
+
+
+    def cancel_run(self, run_id):
+        # queued runs are cancelled outright, running ones are flagged for the runner
+        with self._transaction(immediate=True) as cur:
+            cur.execute("SELECT status FROM run_queue WHERE id = ?", (run_id,))
+            row = cur.fetchone()
+            if not row:
+                return None
+
+            status = row[0]
+            if status == "queued":
+                cur.execute(
+                    "UPDATE run_queue SET status = 'cancelled', finished_at = ? WHERE id = ?",
+                    (time.time(), run_id)
+                )
+                status = "cancelled"
+            elif status == "running":
+                cur.execute("UPDATE run_queue SET cancel_requested = 1 WHERE id = ?", (run_id,))
+        return status
+
+
+    def requeue_interrupted_runs(self):
+        # local runs still marked running belonged to a process that died, remote workers
+        # carry on and are only requeued once their heartbeats stop (requeue_stale_runs).
+        # a run that was being cancelled when its process died stays cancelled
+        with self._transaction() as cur:
+            cur.execute(
+                "UPDATE run_queue SET status = 'cancelled', finished_at = ? "
+                "WHERE status = 'running' AND worker IS NULL AND cancel_requested = 1",
+                (time.time(),)
+            )
+            cur.execute(
+                "UPDATE run_queue SET status = 'queued', started_at = NULL "
+                "WHERE status = 'running' AND worker IS NULL AND cancel_requested = 0"
+            )
+            count = cur.rowcount
+        return count
+
+
+    def get_runs(self, batch_id=None, status=None, limit=500):
+        cur = self._connect().cursor()
+        cur.row_factory = sqlite3.Row
+
+        query = "SELECT * FROM run_queue WHERE 1 = 1"
+        params = []
+        if batch_id is not None:
+            query += " AND batch_id = ?"
+            params.append(batch_id)
+        if status:
+            query += " AND status = ?"
+            params.append(status)
+        query += " ORDER BY id DESC LIMIT ?"
+        params.append(limit)
+
         cur.execute(query, params)
         rows = cur.fetchall()
-        conn.close()
 
-        results = {}
-        for r in rows:
-            test_id = r["test_id"]
-            types = r["test_types"]
-            parent_name = r["testparentname"]
-            status_raw = r["status"].upper() if r["status"] else "None"
-
-            dict_key = (test_id, types)
-
-            if dict_key not in results:
-                results[dict_key] = {
-                    "testparentname": parent_name,
-                    "test_id": test_id,
-                    "types": types,
-                    "status": "None"
-                }
-
-            if status_raw == "FAIL" or status_raw == "ERROR":
-                results[dict_key]["status"] = "FAIL"
-            elif status_raw == "PASS" and results[dict_key]["status"] != "FAIL":
-                results[dict_key]["status"] = "PASS"
-
-        return list(results.values())
+        return [self._run_row_to_dict(r) for r in rows]
+
+
+    def get_run(self, run_id):
+        cur = self._connect().cursor()
+        cur.row_factory = sqlite3.Row
+        cur.execute("SELECT * FROM run_queue WHERE id = ?", (run_id,))
+        row = cur.fetchone()
+        if not row:
+            return None
+        return self._run_row_to_dict(row)
+
+
+    def get_batch(self, batch_id):
+        # the run_batch row plus how far its runs got. finished_at stays None until none of
+        # them is queued or running
+        cur = self._connect().cursor()
+        cur.row_factory = sqlite3.Row
+        cur.execute("SELECT id, created_at, predicted_finish, workers FROM run_batch WHERE id = ?", (batch_id,))
+        row = cur.fetchone()
+        if not row:
+            return None
+        batch = dict(row)
+        cur.execute("""
+            SELECT COUNT(*) AS runs,
+                   SUM(status IN ('queued', 'running')) AS pending,
+                   MAX(finished_at) AS last_finished
+            FROM run_queue WHERE batch_id = ?
+        """, (batch_id,))
+        counts = cur.fetchone()
+        batch["runs"] = counts["runs"]
+        batch["pending"] = counts["pending"] or 0
+        batch["finished_at"] = counts["last_finished"] if counts["runs"] and not batch["pending"] else None
+        return batch
+
+
+    def _run_row_to_dict(self, row):
+        run = dict(row)
+        run["cancel_requested"] = bool(run["cancel_requested"])
+        run["result"] = json.loads(run["result"]) if run["result"] else None
+        return run
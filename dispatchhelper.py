@@ -13,6 +13,34 @@ PROJECT_STEP_DISPATCH = {}
 PROJECT_STEP_SCHEMAS = {}
 
 
+def cacheable(func=None, inputs=()):
+    # marks a dispatch function as a pure function of its params and the files in inputs,
+    # the runner then memoizes its passing results (stepcache.memo_cache). inputs are
+    # param names holding paths, or paths that may use the init_test_env keys, "{src}/main.c"
+    #   @teststep
+    #   @cacheable(inputs=["file"])
+    #   def check_size(file="", max_bytes=0, context=None, config=None, **kwargs):
+    def mark(f):
+        f._cacheable = {"inputs": tuple(inputs)}
+        return f
+    return mark(func) if func is not None else mark
+
+
+def memo_inputs(func, params, paths=None):
+    # the input paths a cacheable function declared, resolved against this step's params
+    resolved = []
+    for item in func._cacheable["inputs"]:
+        if item in params:
+            value = params[item]
+            resolved.extend(value if isinstance(value, (list, tuple)) else [value])
+        else:
+            try:
+                resolved.append(item.format(**paths) if paths else item)
+            except (KeyError, IndexError):
+                resolved.append(item)
+    return [str(p) for p in resolved if p]
+
+
 def _build_arg_schema(func):
     import inspect
     sig = inspect.signature(func)
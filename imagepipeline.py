@@ -0,0 +1,266 @@
+import os
+import re
+import zlib
+import queue
+import struct
+import hashlib
+import threading
+
+from dbhelper import REPORT_DIR
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+# thumbnails go to <report dir>/thumbs/<stem>.png, reports show those and link the full image
+THUMB_DIR_NAME = "thumbs"
+THUMB_WIDTH = int(os.environ.get("TESTRUNNER_THUMB_WIDTH", "192"))
+# identical frames across runs are hardlinked to one copy in the store
+IMAGE_DEDUP = os.environ.get("TESTRUNNER_IMAGE_DEDUP", "1") == "1"
+STORE_DIR = os.path.join(REPORT_DIR, "_images")
+
+SCREENSHOT_RE = re.compile(r"(screenshot-.*|test\d+)\.(png|gif|ppm)$")
+
+
+def thumb_name(image_name):
+    return f"{THUMB_DIR_NAME}/{os.path.splitext(image_name)[0]}.png"
+
+
+def _read_ppm(path):
+    # (width, height, rgb bytes) for binary P6 and ascii P3 files
+    with open(path, "rb") as f:
+        data = f.read()
+
+    tokens = []
+    pos = 0
+    while len(tokens) < 4:
+        while data[pos:pos + 1].isspace():
+            pos += 1
+        if data[pos:pos + 1] == b"#":
+            pos = data.index(b"\n", pos) + 1
+            continue
+        start = pos
+        while not data[pos:pos + 1].isspace():
+            pos += 1
+        tokens.append(data[start:pos])
+    magic, width, height, maxval = tokens[0], int(tokens[1]), int(tokens[2]), int(tokens[3])
+
+    if magic == b"P6":
+        if maxval > 255:
+            raise ValueError(f"{path}: 16 bit ppm not supported")
+        pixels = data[pos + 1:pos + 1 + width * height * 3]
+    elif magic == b"P3":
+        pixels = bytes(int(v) for v in data[pos:].split()[:width * height * 3])
+    else:
+        raise ValueError(f"{path}: not a ppm file")
+    if maxval != 255:
+        pixels = bytes(v * 255 // maxval for v in pixels)
+    return width, height, pixels
+
+
+def _png_bytes(width, height, pixels):
+    # minimal 8 bit rgb png, every row with filter type 0
+    def chunk(tag, body):
+        return struct.pack(">I", len(body)) + tag + body + struct.pack(">I", zlib.crc32(tag + body) & 0xffffffff)
+
+    stride = width * 3
+    raw = b"".join(b"\x00" + pixels[y * stride:(y + 1) * stride] for y in range(height))
+    return (b"\x89PNG\r\n\x1a\n"
+            + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(raw, 9))
+            + chunk(b"IEND", b""))
+
+
+def _scale_rgb(width, height, pixels, new_width):
+    # nearest neighbour, fine for emulator frames
+    new_height = max(1, height * new_width // width)
+    stride = width * 3
+    rows = []
+    for y in range(new_height):
+        start = (y * height // new_height) * stride
+        row = pixels[start:start + stride]
+        rows.append(b"".join(row[i:i + 3] for i in ((x * width // new_width) * 3 for x in range(new_width))))
+    return new_width, new_height, b"".join(rows)
+
+
+def convert_ppm(path):
+    # writes <stem>.png next to the ppm and removes the ppm, returns the png path
+    png_path = os.path.splitext(path)[0] + ".png"
+    if Image is not None:
+        with Image.open(path) as img:
+            img.save(png_path, optimize=True)
+    else:
+        width, height, pixels = _read_ppm(path)
+        with open(png_path, "wb") as f:
+            f.write(_png_bytes(width, height, pixels))
+    os.remove(path)
+    return png_path
+
+
+def convert_screenshot(path, thumb_path):
+    # convert_ppm, plus the thumbnail when only the ppm can be decoded (no PIL)
+    ppm_source = _read_ppm(path) if Image is None else None
+    png_path = convert_ppm(path)
+    if ppm_source is not None and not os.path.exists(thumb_path):
+        make_thumbnail(png_path, thumb_path, ppm_source)
+    return png_path
+
+
+def make_thumbnail(path, thumb_path, ppm_source=None):
+    # False when the image can't be decoded without PIL, the report then shows the full image
+    os.makedirs(os.path.dirname(thumb_path), exist_ok=True)
+    if Image is not None:
+        with Image.open(path) as img:
+            img = img.convert("RGB")
+            if img.width > THUMB_WIDTH:
+                img = img.resize((THUMB_WIDTH, max(1, img.height * THUMB_WIDTH // img.width)), Image.LANCZOS)
+            img.save(thumb_path, optimize=True)
+        return True
+    if ppm_source is None:
+        return False
+    width, height, pixels = ppm_source
+    if width > THUMB_WIDTH:
+        width, height, pixels = _scale_rgb(width, height, pixels, THUMB_WIDTH)
+    with open(thumb_path, "wb") as f:
+        f.write(_png_bytes(width, height, pixels))
+    return True
+
+
+def dedup(path):
+    # swaps path for a hardlink to the stored copy of the same bytes
+    if not IMAGE_DEDUP or os.stat(path).st_nlink > 1:
+        return False
+    with open(path, "rb") as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    stored = os.path.join(STORE_DIR, digest[:2], digest + os.path.splitext(path)[1])
+    try:
+        os.makedirs(os.path.dirname(stored), exist_ok=True)
+        if os.path.exists(stored):
+            tmp = path + ".dedup"
+            os.link(stored, tmp)
+            os.replace(tmp, path)
+            return True
+        os.link(path, stored)
+    except OSError:
+        # store on another filesystem or links not supported, keep the plain file
+        pass
+    return False
+
+
+def process_dir(subdir_path):
+    # converts, thumbnails and dedups every screenshot in one report dir, safe to rerun
+    stats = {"converted": 0, "thumbs": 0, "deduped": 0}
+    if not os.path.isdir(subdir_path):
+        return stats
+
+    for fname in sorted(os.listdir(subdir_path)):
+        if not SCREENSHOT_RE.match(fname):
+            continue
+        path = os.path.join(subdir_path, fname)
+        thumb_path = os.path.join(subdir_path, thumb_name(fname))
+        try:
+            if fname.endswith(".ppm"):
+                # artifacts.collect converts them already, this is for older report dirs
+                had_thumb = os.path.exists(thumb_path)
+                path = convert_screenshot(path, thumb_path)
+                stats["converted"] += 1
+                if not had_thumb and os.path.exists(thumb_path):
+                    stats["thumbs"] += 1
+
+            if not os.path.exists(thumb_path) and make_thumbnail(path, thumb_path):
+                stats["thumbs"] += 1
+
+            for p in (path, thumb_path):
+                if os.path.exists(p) and dedup(p):
+                    stats["deduped"] += 1
+        except (OSError, ValueError) as e:
+            print(f"[imagepipeline] {path}: {e}")
+    return stats
+
+
+def gc_store():
+    # stored images only the store still links to belong to no report any more
+    removed = 0
+    if not os.path.isdir(STORE_DIR):
+        return removed
+    for root, _, files in os.walk(STORE_DIR):
+        for fname in files:
+            path = os.path.join(root, fname)
+            try:
+                if os.stat(path).st_nlink == 1:
+                    os.remove(path)
+                    removed += 1
+            except OSError:
+                continue
+    return removed
+
+
+class ImagePipeline:
+    # processes report dirs in a background thread as runs finish
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._thread = None
+
+    def start(self, backlog=True):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="imagepipeline", daemon=True)
+            self._thread.start()
+            if backlog:
+                self._queue_backlog()
+        return self
+
+    def stop(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def submit(self, subdir_path):
+        self._queue.put(subdir_path)
+
+    def _queue_backlog(self):
+        # report dirs from before the pipeline ran, or from a previous process, have no thumbs dir
+        if not os.path.isdir(REPORT_DIR):
+            return
+        for name in sorted(os.listdir(REPORT_DIR)):
+            path = os.path.join(REPORT_DIR, name)
+            if name.startswith("_") or not os.path.isdir(path):
+                continue
+            if os.path.isdir(os.path.join(path, THUMB_DIR_NAME)):
+                continue
+            if any(SCREENSHOT_RE.match(f) for f in os.listdir(path)):
+                self.submit(path)
+
+    def _loop(self):
+        while True:
+            subdir_path = self._queue.get()
+            if subdir_path is None:
+                return
+            stats = process_dir(subdir_path)
+            if any(stats.values()):
+                print(f"[imagepipeline] {os.path.basename(subdir_path)}: {stats}")
+
+
+_pipeline = None
+
+
+def start():
+    global _pipeline
+    if _pipeline is None:
+        _pipeline = ImagePipeline().start()
+    return _pipeline
+
+
+def stop():
+    global _pipeline
+    if _pipeline is not None:
+        _pipeline.stop()
+        _pipeline = None
+
+
+def submit(subdir_path):
+    # no-op unless the pipeline was started, reports then just show full size images
+    if _pipeline is not None and subdir_path:
+        _pipeline.submit(subdir_path)
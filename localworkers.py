@@ -0,0 +1,87 @@
+import os
+import sys
+import time
+import secrets
+import argparse
+import threading
+import subprocess
+
+from werkzeug.serving import make_server
+
+import apphelpers
+import test_runner
+import runqueue
+import app as webapp
+
+
+# runs one batch on remote workers on this host: serves the app on a free port with no local
+# workers, starts --workers worker processes that shard the queue between them, waits for them
+# and checks that every run was finished by one of them. reports land in the usual db
+# usage: python localworkers.py [--workers 2] [--timeout 600] [module ...]
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def start_server():
+    webapp.WORKER_TOKEN = secrets.token_hex(16)
+    run_queue = runqueue.get_run_queue(webapp.db, 0)
+    server = make_server("127.0.0.1", 0, webapp.app, threaded=True)
+    threading.Thread(target=server.serve_forever, name="localworkers-http", daemon=True).start()
+    return server, run_queue
+
+
+def start_workers(url, count):
+    env = dict(os.environ, TESTRUNNER_WORKER_TOKEN=webapp.WORKER_TOKEN)
+    return [
+        subprocess.Popen(
+            [sys.executable, os.path.join(BASE_DIR, "test_runner.py"), "--worker", "--server", url,
+             "--name", f"local{i}", "--shard", str(i), "--shards", str(count), "--once", "--poll", "0.5"],
+            cwd=BASE_DIR, env=env,
+        )
+        for i in range(count)
+    ]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("modules", nargs="*", help="testlists to run (default: all of them)")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--timeout", type=float, default=600, help="seconds to wait for the workers")
+    args = parser.parse_args(argv)
+
+    server, run_queue = start_server()
+    url = f"http://127.0.0.1:{server.server_port}"
+    test_runner.reload_tests()
+    modules = args.modules or sorted(apphelpers.testfile_registry)
+    batch_id, run_ids = run_queue.submit(modules)
+    print(f"[localworkers] batch {batch_id}: {len(run_ids)} run(s) on {args.workers} worker(s) via {url}")
+
+    started = time.time()
+    workers = start_workers(url, args.workers)
+    try:
+        for proc in workers:
+            proc.wait(timeout=max(1.0, args.timeout - (time.time() - started)))
+    except subprocess.TimeoutExpired:
+        print(f"[localworkers] workers still busy after {args.timeout}s")
+    finally:
+        for proc in workers:
+            if proc.poll() is None:
+                proc.kill()
+                proc.wait()
+        server.shutdown()
+
+    runs = sorted(webapp.db.get_runs(batch_id=batch_id), key=lambda r: r["id"])
+    for run in runs:
+        print(f"  run {run['id']:>4}  {run['status']:<9} {run['worker'] or '-':<8} {run['module_name']}")
+    unfinished = [r["id"] for r in runs if r["status"] in ("queued", "running") or not r["worker"]]
+    used = sorted({r["worker"] for r in runs if r["worker"]})
+    batch = run_queue.batch_status(batch_id) or {}
+    print(f"[localworkers] {len(runs) - len(unfinished)}/{len(runs)} finished by {', '.join(used) or 'no worker'} "
+          f"in {time.time() - started:.1f}s, predicted {batch.get('predicted_duration') or 0:.1f}s")
+    if unfinished:
+        print(f"[localworkers] not finished by a worker: {unfinished}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,237 @@
+import os
+import sys
+import time
+import struct
+import select
+import threading
+import ctypes
+import ctypes.util
+
+import apphelpers
+import dispatchhelper
+import test_runner
+
+
+# inotify event masks, see inotify(7)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+
+_EVENT_HEADER = struct.Struct("iIII")
+
+
+def _load_libc():
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+class RegistryWatcher:
+    # keeps apphelpers.testfile_registry and dispatchhelper.PROJECT_STEP_DISPATCH
+    # current in the background so flask routes only read memory
+    def __init__(self, testsrc_root, helper_dir, mode="auto", poll_interval=5.0, debounce=0.5):
+        self.testsrc_root = os.path.abspath(testsrc_root)
+        self.helper_dir = helper_dir
+        self.dispatch_file = os.path.abspath(os.path.join(helper_dir, "dispatch_functions.py"))
+        self.requested_mode = mode
+        self.mode = None
+        self.poll_interval = poll_interval
+        self.debounce = debounce
+        self._stop = threading.Event()
+        self._thread = None
+        self._libc = None
+        self._fd = None
+        self._wd_dirs = {}
+        self._dispatch_sig = None
+
+    def start(self):
+        if self._thread:
+            return self
+
+        test_runner.rescan_tests()
+        dispatchhelper.load_step_dispatch(self.helper_dir, force_reload=True)
+        self._dispatch_sig = test_runner._stat_signature(self.dispatch_file)
+
+        if self.requested_mode in ("auto", "inotify"):
+            self._libc = _load_libc()
+            if self._libc is not None and self._init_inotify():
+                self.mode = "inotify"
+        if self.mode is None:
+            if self.requested_mode == "inotify":
+                print("[registrywatcher] inotify unavailable, falling back to polling")
+            self.mode = "poll"
+
+        test_runner.discovery_watched = True
+        target = self._run_inotify if self.mode == "inotify" else self._run_poll
+        self._thread = threading.Thread(target=target, name="registrywatcher", daemon=True)
+        self._thread.start()
+        print(f"[registrywatcher] watching {self.testsrc_root} ({self.mode})")
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=self.poll_interval + 1)
+        self._thread = None
+        test_runner.discovery_watched = False
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    # inotify
+
+    def _init_inotify(self):
+        fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            return False
+        self._fd = fd
+        self._add_tree(self.testsrc_root)
+        if os.path.isdir(self.helper_dir):
+            self._add_watch(self.helper_dir)
+        return True
+
+    def _add_watch(self, path):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            print(f"[registrywatcher] cannot watch {path}: {os.strerror(err)}")
+            return
+        self._wd_dirs[wd] = path
+
+    def _add_tree(self, root):
+        # inotify is not recursive, one watch per directory
+        found = []
+        for dirpath, dirnames, filenames in os.walk(root):
+            self._add_watch(dirpath)
+            found.extend(os.path.join(dirpath, f) for f in filenames)
+        return found
+
+    def _read_events(self):
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            events.append((wd, mask, os.fsdecode(name)))
+        return events
+
+    def _run_inotify(self):
+        while not self._stop.is_set():
+            ready, _, _ = select.select([self._fd], [], [], 1.0)
+            if not ready:
+                continue
+
+            # collect a burst of events (editors write, rename and chmod) before refreshing
+            events = self._read_events()
+            deadline = time.time() + self.debounce
+            while time.time() < deadline:
+                ready, _, _ = select.select([self._fd], [], [], max(0.0, deadline - time.time()))
+                if ready:
+                    events.extend(self._read_events())
+
+            changed = set()
+            rescan = False
+            for wd, mask, name in events:
+                if mask & IN_Q_OVERFLOW:
+                    rescan = True
+                    continue
+                if mask & IN_IGNORED:
+                    self._wd_dirs.pop(wd, None)
+                    continue
+                parent = self._wd_dirs.get(wd)
+                if parent is None:
+                    continue
+                path = os.path.join(parent, name) if name else parent
+
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        changed.update(self._add_tree(path))
+                    elif mask & IN_MOVED_FROM:
+                        # files moved away with their directory never get their own events
+                        rescan = True
+                    continue
+                if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                    if path == self.testsrc_root:
+                        rescan = True
+                    continue
+                changed.add(path)
+
+            try:
+                self._apply(changed, rescan)
+            except Exception as e:
+                print(f"[registrywatcher] inotify error: {e}")
+
+    # polling fallback
+
+    def _run_poll(self):
+        while not self._stop.wait(self.poll_interval):
+            try:
+                self._apply(set(), rescan=True)
+            except Exception as e:
+                print(f"[registrywatcher] poll error: {e}")
+
+    def _apply(self, changed, rescan=False):
+        dispatch_sig = test_runner._stat_signature(self.dispatch_file)
+        if dispatch_sig != self._dispatch_sig:
+            self._dispatch_sig = dispatch_sig
+            dispatchhelper.load_step_dispatch(self.helper_dir, force_reload=True)
+            apphelpers.bump_registry_version()
+            print("[registrywatcher] reloaded step dispatch")
+
+        if rescan:
+            test_runner.rescan_tests()
+            return
+
+        testlists = [p for p in changed if p.startswith(self.testsrc_root + os.sep)]
+        if testlists:
+            test_runner.refresh_testlist_paths(testlists)
+
+
+_watcher = None
+
+
+def start(testsrc_root, helper_dir, mode="auto", poll_interval=5.0):
+    global _watcher
+    if _watcher is None:
+        _watcher = RegistryWatcher(testsrc_root, helper_dir, mode=mode, poll_interval=poll_interval).start()
+    return _watcher
+
+
+def stop():
+    global _watcher
+    if _watcher is not None:
+        _watcher.stop()
+        _watcher = None
+
+
+def status():
+    return {
+        "version": apphelpers.registry_version,
+        "watcher": _watcher.mode if _watcher else None,
+    }
@@ -0,0 +1,260 @@
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import argparse
+import tempfile
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+
+import apphelpers
+import artifacts
+
+
+# remote worker: pulls queued runs from the web app, runs them here with run_testfile and
+# uploads the results and the scratch dir so the server files them in its ReportDB.
+#   python test_runner.py --worker --server http://buildhost:8080 --shard 0 --shards 2
+# start the server with TESTRUNNER_WORKERS=0 to leave every run to the remote workers, both
+# sides need the same TESTRUNNER_WORKER_TOKEN
+SERVER = os.environ.get("TESTRUNNER_SERVER", "http://127.0.0.1:8080")
+# seconds between claims while the queue is empty
+POLL_INTERVAL = float(os.environ.get("TESTRUNNER_WORKER_POLL", "2"))
+# seconds between heartbeats during a run, keep well under the server's TESTRUNNER_REMOTE_TIMEOUT
+HEARTBEAT_INTERVAL = float(os.environ.get("TESTRUNNER_WORKER_HEARTBEAT", "2"))
+HTTP_TIMEOUT = 60
+# the server's TESTRUNNER_WORKER_TOKEN
+TOKEN = os.environ.get("TESTRUNNER_WORKER_TOKEN", "")
+
+
+class RemoteReporter:
+    # stands in for an appstate.ProgressState like runnerpool.PipeReporter, the messages
+    # wait for the next heartbeat instead of going down a pipe
+    LOCAL_ONLY = ("scratch_dir", "report_path", "step_deadline")
+
+    def __init__(self):
+        object.__setattr__(self, "_values", {})
+        object.__setattr__(self, "_pending", [])
+        object.__setattr__(self, "_lock", threading.Lock())
+
+    def __setattr__(self, name, value):
+        self._values[name] = value
+        if name not in self.LOCAL_ONLY:
+            self._queue(("progress", name, value))
+
+    def __getattr__(self, name):
+        try:
+            return self._values[name]
+        except KeyError:
+            return ""
+
+    def _queue(self, message):
+        with self._lock:
+            self._pending.append(message)
+
+    def step_started(self, index, total, name):
+        self._values["step"] = f"{index}/{total}"
+        self._values["step_name"] = name
+        self._queue(("step_start", index, total, name))
+
+    def step_finished(self, index, result):
+        self._queue(("step", index, result.as_dict(with_output=True)))
+
+    def steps_done(self):
+        # no pool watching this process, only the ProgressState interface
+        self._values["step_deadline"] = None
+
+    def drain(self):
+        with self._lock:
+            messages = self._pending[:]
+            self._pending.clear()
+        return messages
+
+    def requeue(self, messages):
+        # a heartbeat that didn't get through, sent again with the next one
+        with self._lock:
+            self._pending[:0] = messages
+
+
+class Client:
+    def __init__(self, server, name, token=TOKEN):
+        self.server = server.rstrip("/")
+        self.name = name
+        self.token = token
+
+    def post(self, path, data=None, body=None, params=None):
+        # (http status, decoded json or None). raises OSError when the server can't be reached
+        url = self.server + path
+        if params:
+            url += "?" + urllib.parse.urlencode(params)
+        if body is None:
+            body = json.dumps(dict(data or {}, worker=self.name)).encode()
+            content_type = "application/json"
+        else:
+            content_type = "application/gzip"
+        req = urllib.request.Request(url, data=body, method="POST",
+                                     headers={"Content-Type": content_type, "X-Worker-Token": self.token})
+        try:
+            with urllib.request.urlopen(req, timeout=HTTP_TIMEOUT) as resp:
+                payload = resp.read()
+                return resp.status, json.loads(payload) if payload else None
+        except urllib.error.HTTPError as e:
+            try:
+                payload = json.loads(e.read() or b"null")
+            except ValueError:
+                payload = None
+            return e.code, payload
+
+
+class Heartbeat(threading.Thread):
+    # sends the reporter's messages every HEARTBEAT_INTERVAL. a cancel from the server, or
+    # losing the run to a requeue, interrupts the run the same way a local cancel does
+    def __init__(self, client, run_id, reporter):
+        super().__init__(name=f"heartbeat-{run_id}", daemon=True)
+        self.client = client
+        self.run_id = run_id
+        self.reporter = reporter
+        self.lost = False
+        self.cancelled = False
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(HEARTBEAT_INTERVAL):
+            self.beat()
+
+    def beat(self, final=False):
+        messages = self.reporter.drain()
+        try:
+            status, body = self.client.post(f"/api/worker/runs/{self.run_id}/heartbeat", {"messages": messages})
+        except OSError as e:
+            print(f"[remoteworker] heartbeat for run {self.run_id} failed: {e}")
+            self.reporter.requeue(messages)
+            return
+        if status == 409:
+            self.lost = True
+        elif status != 200:
+            print(f"[remoteworker] heartbeat for run {self.run_id}: http {status} {body}")
+            return
+        if not final and not self.cancelled and (self.lost or (body or {}).get("cancel")):
+            self.cancelled = True
+            print(f"[remoteworker] run {self.run_id} {'lost to another worker' if self.lost else 'cancelled'}")
+            os.kill(os.getpid(), signal.SIGUSR1)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.beat(final=True)
+
+
+def _resolve(module_name, meta):
+    # the testlist from this host's registry, the same checkout as the server's is expected
+    import test_runner
+
+    if module_name not in apphelpers.testfile_registry:
+        test_runner.reload_tests()
+    if module_name not in apphelpers.testfile_registry and os.path.isfile(meta.get("__full_path__", "")):
+        apphelpers.testfile_registry[module_name] = dict(meta)
+    return module_name in apphelpers.testfile_registry
+
+
+def _upload_scratch(client, run_id, scratch_dir):
+    with tempfile.TemporaryFile() as f:
+        artifacts.pack(scratch_dir, f)
+        f.seek(0)
+        status, body = client.post(f"/api/worker/runs/{run_id}/artifacts", body=f.read(),
+                                   params={"worker": client.name})
+    if status != 200:
+        print(f"[remoteworker] artifact upload for run {run_id}: http {status} {body}")
+
+
+def run_job(client, job):
+    import test_runner
+
+    run_id, module_name = job["run_id"], job["module_name"]
+    print(f"[remoteworker] run {run_id}: {module_name}")
+    test_runner.cancel_requested = False
+    reporter = RemoteReporter()
+    heartbeat = Heartbeat(client, run_id, reporter)
+    heartbeat.start()
+
+    run, error = None, None
+    try:
+        if _resolve(module_name, job.get("meta") or {}):
+            run = test_runner.run_testfile(module_name, reporter, record=False)
+        else:
+            error = f"{module_name} not found on {client.name}"
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    finally:
+        heartbeat.stop()
+
+    scratch_dir = reporter.scratch_dir
+    try:
+        if heartbeat.lost:
+            # requeued while it ran, whatever it produced is somebody else's now
+            return None
+        if run is not None and run.started_at is not None and scratch_dir and os.path.isdir(scratch_dir):
+            _upload_scratch(client, run_id, scratch_dir)
+        status, body = client.post(f"/api/worker/runs/{run_id}/result",
+                                   {"run": run.as_dict() if run is not None else None, "error": error})
+        print(f"[remoteworker] run {run_id} finished: http {status} {body}")
+        return body
+    finally:
+        artifacts.remove_scratch_dir(scratch_dir)
+
+
+def serve(server, name, shard=0, shards=1, once=False, poll_interval=POLL_INTERVAL, token=TOKEN):
+    import test_runner
+
+    client = Client(server, name, token)
+    test_runner.install_cancel_handler()
+    test_runner.reload_tests()
+    print(f"[remoteworker] {name} pulling from {client.server}, shard {shard}/{shards}")
+
+    while True:
+        try:
+            status, job = client.post("/api/worker/claim", {"shard": shard, "shards": shards})
+        except OSError as e:
+            print(f"[remoteworker] claim failed: {e}")
+            status, job = None, None
+
+        if status == 200 and job:
+            try:
+                run_job(client, job)
+            except OSError as e:
+                print(f"[remoteworker] run {job['run_id']}: lost the server: {e}")
+            continue
+        if status == 403:
+            print(f"[remoteworker] claim refused: {(job or {}).get('message')}")
+            return
+        if status not in (204, None):
+            print(f"[remoteworker] claim: http {status} {job}")
+        if once:
+            return
+        time.sleep(poll_interval)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="test_runner.py")
+    parser.add_argument("--worker", action="store_true", help="run queued testlists for a server")
+    parser.add_argument("--server", default=SERVER, help="url of the web app (default %(default)s)")
+    parser.add_argument("--name", default=f"{socket.gethostname()}-{os.getpid()}")
+    parser.add_argument("--shard", type=int, default=0, help="this worker's shard, 0 based")
+    parser.add_argument("--shards", type=int, default=1, help="number of shards the workers split the queue in")
+    parser.add_argument("--poll", type=float, default=POLL_INTERVAL, help="seconds between claims when idle")
+    parser.add_argument("--once", action="store_true", help="exit once the queue is empty")
+    parser.add_argument("--token", default=TOKEN, help="the server's worker token (default $TESTRUNNER_WORKER_TOKEN)")
+    args = parser.parse_args(argv)
+
+    if not args.worker:
+        parser.error("only --worker mode is supported from the command line")
+    if not 0 <= args.shard < max(1, args.shards):
+        parser.error("--shard must be below --shards")
+    sys.stdout.reconfigure(line_buffering=True)
+    try:
+        serve(args.server, args.name, args.shard, args.shards, args.once, args.poll, args.token)
+    except KeyboardInterrupt:
+        print(f"[remoteworker] {args.name} stopped")
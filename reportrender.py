@@ -0,0 +1,156 @@
+import os
+import json
+
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+
+from imagepipeline import thumb_name
+from artifacts import is_image
+
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+TEMPLATE_DIR = os.path.join(BASE_DIR, "templates")
+# "file" writes the report html when a run finishes, "db" only records the run
+# and renders the page from the db when it is opened
+REPORT_MODE = os.environ.get("TESTRUNNER_REPORT_MODE", "file")
+# step logs longer than this (chars) only show their tail in the page, the rest is linked
+REPORT_LOG_PREVIEW = int(os.environ.get("TESTRUNNER_REPORT_LOG_PREVIEW", "20000"))
+
+_env = Environment(
+    loader=FileSystemLoader(TEMPLATE_DIR),
+    autoescape=select_autoescape(["html"]),
+    trim_blocks=True,
+    lstrip_blocks=True,
+)
+
+
+def _log_view(text, link):
+    # link is where the full text lives, only used when the text gets cut
+    text = text or ""
+    if len(text) <= REPORT_LOG_PREVIEW and link is None:
+        return {"text": text, "truncated": False, "size": len(text), "link": None}
+    if len(text) <= REPORT_LOG_PREVIEW and link is not None:
+        return {"text": text, "truncated": True, "size": None, "link": link}
+    return {"text": text[-REPORT_LOG_PREVIEW:], "truncated": True, "size": len(text), "link": link}
+
+
+def _split_artifacts(rows):
+    # {test_index: [file]} for everything not shown as an image, run level files under None.
+    # rows are shaped like db.get_artifacts
+    files = {}
+    for row in rows:
+        if row["kind"] == "screenshot" and is_image(row["name"]):
+            continue
+        files.setdefault(row["test_index"], []).append(
+            {"name": row["name"], "kind": row["kind"], "size": row["size"]})
+    return files
+
+
+def _cache_view(metrics):
+    # set for steps answered from stepcache
+    if "cache" not in metrics:
+        return None
+    return {"kind": metrics["cache"], "saved": metrics.get("saved_s") or 0.0}
+
+
+def _step_view(index, name, status, color, duration, output, stdout, images, files=(),
+               metrics=None, start=None, stop=None):
+    # metrics is the step's dict or its json from the db
+    if isinstance(metrics, str):
+        metrics = json.loads(metrics or "{}")
+    metrics = metrics or {}
+    return {
+        "index": index,
+        "name": name,
+        "status": status,
+        "color": color,
+        "duration": duration or 0.0,
+        "output": output,
+        "stdout": stdout,
+        # thumbnails appear once imagepipeline has been over the dir, until then the page falls back
+        "images": [{"src": img, "thumb": thumb_name(img)} for img in images],
+        "files": list(files),
+        "cache": _cache_view(metrics),
+        "start": start,
+        "stop": stop,
+        # set when the steps ran as a graph, see test_runner.run_step_graph
+        "depends_on": metrics.get("depends_on"),
+        "critical": metrics.get("critical_path", False),
+    }
+
+
+def _schedule_view(views):
+    # wall time against the steps run back to back, None unless the steps ran as a graph
+    if not any(v["depends_on"] is not None for v in views):
+        return None
+    ran = [v for v in views if v["duration"] > 0 and v["start"] is not None]
+    serial = sum(v["duration"] for v in ran)
+    wall = max((v["stop"] for v in ran), default=0.0) - min((v["start"] for v in ran), default=0.0)
+    path = [v for v in views if v["critical"]]
+    return {
+        "serial": serial,
+        "wall": wall,
+        "saved": max(serial - wall, 0.0),
+        "critical_path": path,
+        "critical_duration": sum(v["duration"] for v in path),
+    }
+
+
+def write_report(steps, report_path, testlist_name="", artifacts=()):
+    # steps are results.StepResult, artifacts the run's artifacts.Artifact manifest. logs over
+    # REPORT_LOG_PREVIEW are written next to the report as <report>.step<N>.<field>.log
+    # and linked, the page is streamed to disk
+    subdir_path = os.path.dirname(report_path)
+    if subdir_path and not os.path.exists(subdir_path):
+        os.makedirs(subdir_path, exist_ok=True)
+    base = os.path.splitext(os.path.basename(report_path))[0]
+    files = _split_artifacts([dict(a.as_dict(), test_index=a.step_index) for a in artifacts])
+
+    views = []
+    for idx, step in enumerate(steps, start=1):
+        logs = {}
+        for field in ("output", "stdout"):
+            text = getattr(step, field)
+            link = None
+            if len(text) > REPORT_LOG_PREVIEW:
+                link = f"{base}.step{idx}.{field}.log"
+                with open(os.path.join(subdir_path, link), "w", encoding="utf-8", errors="replace") as f:
+                    f.write(text)
+            logs[field] = _log_view(text, link)
+        views.append(_step_view(idx, step.name, step.status, step.color, step.duration,
+                                logs["output"], logs["stdout"], step.artifacts, files.get(idx, ()),
+                                step.metrics, step.start_time, step.stop_time))
+
+    template = _env.get_template("report.html")
+    with open(report_path, "w", encoding="utf-8", errors="replace") as f:
+        template.stream(testlist_name=testlist_name, steps=views, run_files=files.get(None, ()),
+                        schedule=_schedule_view(views)).dump(f)
+
+
+def render_from_db(db, report):
+    # generator of html chunks for a report row that has no html file, full logs
+    # come from /api/results. report is a dict from db.get_report_by_path
+    artifacts = db.get_artifacts(report["id"])
+    files = _split_artifacts(artifacts)
+    images = {}
+    for a in artifacts:
+        if a["kind"] == "screenshot" and is_image(a["name"]) and a["test_index"] is not None:
+            images.setdefault(a["test_index"], []).append(a["name"])
+
+    views = []
+    for row in db.fetch_results_for_report(report["id"]):
+        logs = {}
+        for field in ("output", "stdout"):
+            # a blob means the inline text is already only the tail
+            link = f"/api/results/{row['id']}/{field}"
+            if row[f"{field}_blob"] is not None:
+                logs[field] = _log_view(row[field], link)
+            else:
+                logs[field] = _log_view(row[field], link if len(row[field] or "") > REPORT_LOG_PREVIEW else None)
+        views.append(_step_view(row["test_index"], row["name"], row["status"], row["color"],
+                                row["duration"], logs["output"], logs["stdout"],
+                                images.get(row["test_index"], ()), files.get(row["test_index"], ()),
+                                row["metrics"], row["start_time"], row["stop_time"]))
+
+    template = _env.get_template("report.html")
+    return template.generate(testlist_name=report["test_id"] or "", steps=views, run_files=files.get(None, ()),
+                             schedule=_schedule_view(views))
@@ -0,0 +1,175 @@
+import time
+import resource
+from enum import Enum
+
+
+class Status(str, Enum):
+    # str mixin so statuses still compare, json encode and bind into sqlite as plain strings
+    PASS = "PASS"
+    FAIL = "FAIL"
+    ERROR = "ERROR"
+    TIMEOUT = "TIMEOUT"
+    CANCELLED = "CANCELLED"
+    SKIPPED = "SKIPPED"
+    NOT_FOUND = "NOT FOUND"
+    # passed earlier with the same inputs, see stepcache.py
+    CACHED = "CACHED"
+
+    def __str__(self):
+        return self.value
+
+    def __format__(self, spec):
+        return format(self.value, spec)
+
+    @property
+    def failed(self):
+        return self in FAILED_STATUSES
+
+    @property
+    def color(self):
+        return STATUS_COLORS[self]
+
+
+FAILED_STATUSES = frozenset((Status.FAIL, Status.ERROR, Status.TIMEOUT, Status.CANCELLED))
+
+STATUS_COLORS = {
+    Status.PASS: "green",
+    Status.FAIL: "red",
+    Status.TIMEOUT: "red",
+    Status.ERROR: "gray",
+    Status.CANCELLED: "gray",
+    Status.SKIPPED: "gray",
+    Status.NOT_FOUND: "gray",
+    Status.CACHED: "green",
+}
+
+
+def usage_snapshot():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (own.ru_utime + own.ru_stime, children.ru_utime + children.ru_stime,
+            own.ru_maxrss, children.ru_maxrss)
+
+
+def usage_delta(before, after=None):
+    # per-step resource use; cpu is a delta, rss is the high-water mark so far (KiB)
+    after = after or usage_snapshot()
+    return {
+        "cpu_s": round(after[0] - before[0], 3),
+        "child_cpu_s": round(after[1] - before[1], 3),
+        "max_rss_kb": after[2],
+        "child_max_rss_kb": after[3],
+    }
+
+
+class StepResult:
+    # one executed (or skipped) step. output and stdout are passed by reference
+    # from the step to the report and db writers, never rebuilt on the way
+    __slots__ = ("name", "status", "output", "stdout", "duration",
+                 "start_time", "stop_time", "artifacts", "metrics")
+
+    def __init__(self, name, status, output="", stdout="", duration=0.0,
+                 start_time=None, stop_time=None, artifacts=None, metrics=None):
+        self.name = name
+        self.status = Status(status)
+        self.output = output or ""
+        self.stdout = stdout or ""
+        self.duration = duration
+        self.start_time = time.time() if start_time is None else start_time
+        self.stop_time = self.start_time + duration if stop_time is None else stop_time
+        self.artifacts = artifacts if artifacts is not None else []
+        self.metrics = metrics if metrics is not None else {}
+
+    @classmethod
+    def not_run(cls, name, status, message):
+        # skipped, cancelled or timed out before it started
+        return cls(name, status, message)
+
+    @property
+    def color(self):
+        return self.status.color
+
+    @property
+    def failed(self):
+        return self.status.failed
+
+    def as_dict(self, with_output=False):
+        data = {
+            "name": self.name,
+            "status": self.status.value,
+            "duration": self.duration,
+            "start_time": self.start_time,
+            "stop_time": self.stop_time,
+            "artifacts": self.artifacts,
+            "metrics": self.metrics,
+        }
+        if with_output:
+            data["output"] = self.output
+            data["stdout"] = self.stdout
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        # inverse of as_dict(with_output=True), results sent by remote workers
+        return cls(data["name"], data["status"], data.get("output", ""), data.get("stdout", ""),
+                   data.get("duration") or 0.0, data.get("start_time"), data.get("stop_time"),
+                   data.get("artifacts"), data.get("metrics"))
+
+    def __repr__(self):
+        return f"StepResult({self.name!r}, {self.status.value}, {self.duration:.2f}s)"
+
+
+class RunResult:
+    # all steps of one testlist run plus what the report and db need to file it
+    __slots__ = ("module_name", "testparentname", "test_types", "steps", "started_at", "finished_at",
+                 "artifacts")
+
+    def __init__(self, module_name, testparentname=None, test_types="", steps=None,
+                 started_at=None, finished_at=None, artifacts=None):
+        self.module_name = module_name
+        self.testparentname = testparentname or module_name
+        self.test_types = test_types
+        self.steps = steps if steps is not None else []
+        self.started_at = started_at
+        self.finished_at = finished_at
+        # artifacts.Artifact manifest, filled in when the run's files are collected
+        self.artifacts = artifacts if artifacts is not None else []
+
+    @property
+    def duration(self):
+        return round(sum(s.duration for s in self.steps), 2)
+
+    @property
+    def failed(self):
+        return sum(1 for s in self.steps if s.failed)
+
+    @property
+    def status(self):
+        return Status.FAIL if self.failed else Status.PASS
+
+    def summary(self):
+        return {
+            "steps": len(self.steps),
+            "failed": self.failed,
+            "status": "FAIL" if self.failed or not self.steps else "PASS",
+        }
+
+    def as_dict(self):
+        # what a remote worker uploads, artifacts are collected again on the server
+        return {
+            "module_name": self.module_name,
+            "testparentname": self.testparentname,
+            "test_types": self.test_types,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "steps": [s.as_dict(with_output=True) for s in self.steps],
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["module_name"], data.get("testparentname"), data.get("test_types", ""),
+                   [StepResult.from_dict(s) for s in data.get("steps", [])],
+                   data.get("started_at"), data.get("finished_at"))
+
+    def __repr__(self):
+        return f"RunResult({self.module_name!r}, {len(self.steps)} steps, {self.status.value})"
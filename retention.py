@@ -0,0 +1,306 @@
+import os
+import time
+import shutil
+import threading
+
+import artifacts
+import imagepipeline
+from dbhelper import REPORT_DIR
+
+
+# retention rules, 0 disables a rule
+# newest reports kept per test/type, whatever their age
+KEEP_LAST = int(os.environ.get("TESTRUNNER_KEEP_LAST", "20"))
+# failed reports younger than this are kept even past KEEP_LAST
+KEEP_FAILED_DAYS = float(os.environ.get("TESTRUNNER_KEEP_FAILED_DAYS", "30"))
+# anything older goes, except the latest report of each test/type
+MAX_AGE_DAYS = float(os.environ.get("TESTRUNNER_MAX_AGE_DAYS", "90"))
+# kept reports older than this lose the output of their passing steps
+COMPACT_AFTER_DAYS = float(os.environ.get("TESTRUNNER_COMPACT_AFTER_DAYS", "14"))
+
+# seconds between background passes. 0 (the default) starts no background thread, passes
+# only run through POST /retention/run, so upgrading never prunes history on its own
+RETENTION_INTERVAL = float(os.environ.get("TESTRUNNER_RETENTION_INTERVAL", "0"))
+# reports handled per db transaction, with a pause between batches so runs can still write
+RETENTION_BATCH = 100
+BATCH_PAUSE = 0.2
+# report dirs without a db row are only swept once this old, a running testlist has one too
+ORPHAN_GRACE = 6 * 3600
+
+DAY = 86400
+
+
+class RetentionPolicy:
+    def __init__(self, keep_last=KEEP_LAST, keep_failed_days=KEEP_FAILED_DAYS,
+                 max_age_days=MAX_AGE_DAYS, compact_after_days=COMPACT_AFTER_DAYS):
+        self.keep_last = keep_last
+        self.keep_failed_days = keep_failed_days
+        self.max_age_days = max_age_days
+        self.compact_after_days = compact_after_days
+
+    def as_dict(self):
+        return {
+            "keep_last": self.keep_last,
+            "keep_failed_days": self.keep_failed_days,
+            "max_age_days": self.max_age_days,
+            "compact_after_days": self.compact_after_days,
+        }
+
+    def decide(self, report, rank, age):
+        # ("keep" | "delete", reason) for one report, rank 0 is the newest of its test/type
+        if rank == 0:
+            return "keep", "latest"
+        if self.max_age_days and age > self.max_age_days * DAY:
+            return "delete", f"older than {self.max_age_days:g} days"
+        if not self.keep_last or rank < self.keep_last:
+            return "keep", "recent"
+        if self.keep_failed_days and report["status"] == "FAIL" and age < self.keep_failed_days * DAY:
+            return "keep", "recent failure"
+        return "delete", f"beyond last {self.keep_last}"
+
+    def should_compact(self, report, age):
+        return bool(self.compact_after_days and not report["compacted"]
+                    and age > self.compact_after_days * DAY)
+
+
+def _report_age(report, now):
+    started = report["started_at"]
+    if started is None:
+        try:
+            started = os.path.getmtime(os.path.join(REPORT_DIR, report["path"]))
+        except OSError:
+            return 0
+    return now - started
+
+
+def _dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for fname in files:
+            try:
+                total += os.path.getsize(os.path.join(root, fname))
+            except OSError:
+                continue
+    return total
+
+
+def _report_dir(rel_path):
+    # first path component, the per-run timestamp dir
+    return rel_path.split("/", 1)[0] if "/" in rel_path else None
+
+
+def _orphan_dirs(referenced, now):
+    orphans = []
+    if not os.path.isdir(REPORT_DIR):
+        return orphans
+    for name in os.listdir(REPORT_DIR):
+        path = os.path.join(REPORT_DIR, name)
+        # _live and friends belong to the app, not to a report
+        if name.startswith("_") or name in referenced or not os.path.isdir(path):
+            continue
+        if now - os.path.getmtime(path) > ORPHAN_GRACE:
+            orphans.append(name)
+    return orphans
+
+
+def plan(db, policy=None, now=None):
+    # works out what a pass would do without touching anything
+    policy = policy or RetentionPolicy()
+    now = now or time.time()
+
+    ranks = {}
+    delete = []
+    compact = []
+    kept = 0
+    referenced = set()
+    for report in db.get_report_index():
+        key = (report["testparentname"], report["test_types"])
+        rank = ranks.get(key, 0)
+        ranks[key] = rank + 1
+
+        age = _report_age(report, now)
+        action, reason = policy.decide(report, rank, age)
+        if action == "delete":
+            delete.append((report, reason))
+            continue
+        kept += 1
+        referenced.add(_report_dir(report["path"]))
+        if policy.should_compact(report, age):
+            compact.append(report)
+
+    # a dir goes once nothing that is kept still points into it
+    dirs = sorted({_report_dir(r["path"]) for r, _ in delete} - referenced - {None})
+    return {
+        "policy": policy.as_dict(),
+        "delete": delete,
+        "compact": compact,
+        "kept": kept,
+        "dirs": dirs,
+        "orphans": _orphan_dirs(referenced | set(dirs), now),
+    }
+
+
+def summarize(result, limit=200, sizes=True):
+    # json friendly view of a plan, sizes walks the dirs so only the dry run asks for it
+    dirs = result["dirs"] + result["orphans"]
+    return {
+        "policy": result["policy"],
+        "kept": result["kept"],
+        "delete_count": len(result["delete"]),
+        "compact_count": len(result["compact"]),
+        "dir_count": len(result["dirs"]),
+        "orphan_count": len(result["orphans"]),
+        "reclaim_bytes": sum(_dir_size(os.path.join(REPORT_DIR, d)) for d in dirs) if sizes else None,
+        "delete": [
+            {"id": r["id"], "path": r["path"], "test_id": r["testparentname"],
+             "types": r["test_types"], "status": r["status"], "reason": reason}
+            for r, reason in result["delete"][:limit]
+        ],
+        "orphans": result["orphans"][:limit],
+    }
+
+
+def _remove_dir(name):
+    path = os.path.join(REPORT_DIR, name)
+    # never follow a path out of the reports dir
+    if os.path.dirname(os.path.abspath(path)) != os.path.abspath(REPORT_DIR):
+        return False
+    shutil.rmtree(path, ignore_errors=True)
+    return not os.path.exists(path)
+
+
+def apply(db, result, stop_event=None):
+    # db rows go first, a crash in between leaves orphan dirs the next pass sweeps up
+    stats = {"deleted": 0, "compacted": 0, "stripped_steps": 0, "dirs_removed": 0}
+    deleted_ids = [r["id"] for r, _ in result["delete"]]
+    doomed_dirs = set(result["dirs"])
+
+    for i in range(0, len(deleted_ids), RETENTION_BATCH):
+        if stop_event is not None and stop_event.is_set():
+            return stats
+        paths = db.delete_reports(deleted_ids[i:i + RETENTION_BATCH])
+        stats["deleted"] += len(paths)
+        for rel_path in paths:
+            # reports sharing a dir with a kept one lose only their own html
+            if _report_dir(rel_path) not in doomed_dirs:
+                try:
+                    os.remove(os.path.join(REPORT_DIR, rel_path))
+                except OSError:
+                    pass
+        time.sleep(BATCH_PAUSE)
+
+    for name in result["dirs"] + result["orphans"]:
+        if _remove_dir(name):
+            stats["dirs_removed"] += 1
+    if stats["dirs_removed"]:
+        stats["images_released"] = imagepipeline.gc_store()
+    # scratch dirs of runs that died before collecting their files
+    stats["scratch_removed"] = artifacts.sweep_scratch(ORPHAN_GRACE)
+
+    compact_ids = [r["id"] for r in result["compact"]]
+    for i in range(0, len(compact_ids), RETENTION_BATCH):
+        if stop_event is not None and stop_event.is_set():
+            return stats
+        batch = compact_ids[i:i + RETENTION_BATCH]
+        stats["stripped_steps"] += db.compact_reports(batch)
+        stats["compacted"] += len(batch)
+        time.sleep(BATCH_PAUSE)
+
+    return stats
+
+
+class Pruner:
+    # runs retention passes in the background every interval seconds,
+    # and on demand through run_now
+    def __init__(self, db, policy=None, interval=RETENTION_INTERVAL):
+        self.db = db
+        self.policy = policy or RetentionPolicy()
+        self.interval = interval
+        self.last_run = None
+        self._pass_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="retention", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    @property
+    def running(self):
+        return self._pass_lock.locked()
+
+    def run_now(self):
+        # False when a pass is already in progress
+        if self.running:
+            return False
+        if self._thread is None:
+            threading.Thread(target=self.run_pass, name="retention-once", daemon=True).start()
+        else:
+            self._wake.set()
+        return True
+
+    def run_pass(self):
+        if not self._pass_lock.acquire(blocking=False):
+            return None
+        try:
+            started = time.time()
+            result = plan(self.db, self.policy)
+            stats = apply(self.db, result, self._stop)
+            if stats["deleted"] or stats["stripped_steps"]:
+                stats["vacuum"] = self.db.vacuum()["freed_bytes"]
+            stats["started_at"] = started
+            stats["seconds"] = round(time.time() - started, 2)
+            self.last_run = stats
+            print(f"[retention] {stats}")
+            return stats
+        except Exception as e:
+            self.last_run = {"error": f"{type(e).__name__}: {e}", "started_at": started}
+            print(f"[retention] pass failed: {e}")
+            return None
+        finally:
+            self._pass_lock.release()
+
+    def _loop(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.interval if self.interval > 0 else None)
+            self._wake.clear()
+            if self._stop.is_set():
+                return
+            self.run_pass()
+
+
+_pruner = None
+
+
+def get_pruner(db):
+    global _pruner
+    if _pruner is None:
+        _pruner = Pruner(db)
+    return _pruner
+
+
+def start(db, interval=RETENTION_INTERVAL):
+    # opt in, nothing runs in the background unless interval is set
+    pruner = get_pruner(db)
+    pruner.interval = interval
+    if interval <= 0:
+        print("[retention] background passes off, set TESTRUNNER_RETENTION_INTERVAL to enable")
+        return pruner
+    return pruner.start()
+
+
+def stop():
+    global _pruner
+    if _pruner is not None:
+        _pruner.stop()
+        _pruner = None
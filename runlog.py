@@ -0,0 +1,100 @@
+import os
+import shutil
+import threading
+from collections import deque, OrderedDict
+
+
+#######################################
+### config stuff #####################
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+REPORT_DIR = os.path.join(BASE_DIR, "reports")
+LIVE_LOG_DIR = os.path.join(REPORT_DIR, "_live")
+# in-memory tail kept per run, the full log goes to disk
+RUNLOG_MAX_BYTES = int(os.environ.get("TESTRUNNER_RUNLOG_MAX_BYTES", str(256 * 1024)))
+MAX_CLOSED_LOGS = 50
+#######################################
+
+
+class RunLog:
+    # live output of one run: a bounded ring buffer of chunks for tailing,
+    # plus the complete log spilled to a file that ends up in the report dir
+    def __init__(self, run_id, max_bytes=RUNLOG_MAX_BYTES):
+        self.run_id = run_id
+        self.max_bytes = max_bytes
+        self.path = os.path.join(LIVE_LOG_DIR, f"run_{run_id}.log")
+        self.seq = 0
+        self.closed = False
+        self._chunks = deque()
+        self._size = 0
+        self._cond = threading.Condition()
+        os.makedirs(LIVE_LOG_DIR, exist_ok=True)
+        self._file = open(self.path, "a", encoding="utf-8", errors="replace")
+
+    def append(self, text):
+        if not text:
+            return
+        with self._cond:
+            if self.closed:
+                return
+            self._file.write(text)
+            self.seq += 1
+            # a single chunk bigger than the whole buffer only keeps its end
+            tail = text[-self.max_bytes:]
+            self._chunks.append((self.seq, tail))
+            self._size += len(tail)
+            while self._size > self.max_bytes and len(self._chunks) > 1:
+                _, dropped = self._chunks.popleft()
+                self._size -= len(dropped)
+            self._file.flush()
+            self._cond.notify_all()
+
+    def tail(self):
+        with self._cond:
+            return "".join(text for _, text in self._chunks)
+
+    def read_since(self, seq, timeout=None):
+        # chunks newer than seq; waits up to timeout for new output.
+        # if the ring buffer already dropped some of them the reader just skips ahead
+        with self._cond:
+            if self.seq <= seq and not self.closed:
+                self._cond.wait(timeout)
+            return [(s, text) for s, text in self._chunks if s > seq], self.closed
+
+    def close(self, report_dir=None):
+        with self._cond:
+            if self.closed:
+                return
+            self.closed = True
+            self._file.close()
+            if report_dir and os.path.isdir(report_dir):
+                dest = os.path.join(report_dir, os.path.basename(self.path))
+                shutil.move(self.path, dest)
+                self.path = dest
+            else:
+                # no report to keep it with, only the in-memory tail stays around
+                try:
+                    os.remove(self.path)
+                except OSError:
+                    pass
+            self._cond.notify_all()
+
+
+_logs = OrderedDict()
+_logs_lock = threading.Lock()
+
+
+def open_log(run_id):
+    with _logs_lock:
+        log = _logs.get(run_id)
+        if log is None:
+            log = _logs[run_id] = RunLog(run_id)
+
+        closed = [rid for rid, l in _logs.items() if l.closed]
+        for rid in closed[:max(0, len(closed) - MAX_CLOSED_LOGS)]:
+            _logs.pop(rid, None)
+        return log
+
+
+def get_log(run_id):
+    with _logs_lock:
+        return _logs.get(run_id)
@@ -0,0 +1,403 @@
+import os
+import sys
+import time
+import signal
+import select
+import threading
+import multiprocessing
+
+import apphelpers
+
+
+# worker recycling and limits, 0 disables a limit
+WORKER_START_METHOD = os.environ.get("TESTRUNNER_WORKER_START", "fork")
+WORKER_MAX_RUNS = int(os.environ.get("TESTRUNNER_WORKER_MAX_RUNS", "20"))
+WORKER_MAX_RSS_MB = int(os.environ.get("TESTRUNNER_WORKER_MAX_RSS_MB", "1024"))
+STEP_WALL_LIMIT = float(os.environ.get("TESTRUNNER_STEP_WALL_LIMIT", "0"))
+STEP_MAX_RSS_MB = int(os.environ.get("TESTRUNNER_STEP_MAX_RSS_MB", "0"))
+
+SUPERVISE_INTERVAL = 0.5
+# how long a worker gets to stop a step on its own before the whole process group is killed
+HARD_KILL_GRACE = float(os.environ.get("TESTRUNNER_HARD_KILL_GRACE", "15"))
+
+
+def _list_processes():
+    # (pid, ppid, pgrp) for every process, read from /proc
+    procs = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # comm can contain spaces, ppid and pgrp follow the state after the closing paren
+        fields = stat.rsplit(")", 1)[1].split()
+        procs.append((int(entry), int(fields[1]), int(fields[2])))
+    return procs
+
+
+def process_tree(pid):
+    # pid plus all of its descendants
+    children = {}
+    for child, ppid, _ in _list_processes():
+        children.setdefault(ppid, []).append(child)
+
+    tree = []
+    pending = [pid]
+    while pending:
+        p = pending.pop()
+        tree.append(p)
+        pending.extend(children.get(p, []))
+    return tree
+
+
+def process_group(pgid):
+    # also catches orphans whose parent shell was already killed
+    return [pid for pid, _, pgrp in _list_processes() if pgrp == pgid]
+
+
+def rss_bytes(pids):
+    total = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+                        break
+        except OSError:
+            continue
+    return total
+
+
+class _LockedConn:
+    # the output capture thread and the runner thread share the pipe to the parent
+    def __init__(self, conn):
+        self._conn = conn
+        self._lock = threading.Lock()
+
+    def send(self, msg):
+        with self._lock:
+            self._conn.send(msg)
+
+    def recv(self):
+        return self._conn.recv()
+
+
+class OutputCapture:
+    # redirects fd 1/2 of the worker, and so of every process it starts, into a pipe
+    # and streams it to the parent as "log" messages while still echoing to the console
+    def __init__(self, conn, run_id):
+        self._conn = conn
+        self._run_id = run_id
+        self._saved = None
+        self._reader = None
+        self._stop_fd = None
+
+    def start(self):
+        sys.stdout.flush()
+        sys.stderr.flush()
+        read_fd, write_fd = os.pipe()
+        stop_read, self._stop_fd = os.pipe()
+        self._saved = (os.dup(1), os.dup(2))
+        os.dup2(write_fd, 1)
+        os.dup2(write_fd, 2)
+        os.close(write_fd)
+        # the reader owns its fds and closes them when it exits, a reader that outlives
+        # stop() never sees an fd number the next run got back from os.pipe()
+        self._reader = threading.Thread(target=self._pump, args=(read_fd, stop_read, os.dup(self._saved[0])),
+                                        name="output-capture", daemon=True)
+        self._reader.start()
+
+    def _pump(self, read_fd, stop_read, console):
+        try:
+            while True:
+                try:
+                    ready, _, _ = select.select([read_fd, stop_read], [], [])
+                except InterruptedError:
+                    continue
+                # pending output first, stop once nothing is left to read
+                if read_fd not in ready:
+                    return
+                try:
+                    data = os.read(read_fd, 64 * 1024)
+                except OSError:
+                    return
+                if not data:
+                    return
+                try:
+                    os.write(console, data)
+                except OSError:
+                    pass
+                try:
+                    self._conn.send(("log", self._run_id, data.decode("utf-8", errors="replace")))
+                except (OSError, BrokenPipeError):
+                    return
+        finally:
+            for fd in (read_fd, stop_read, console):
+                os.close(fd)
+
+    def stop(self):
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(self._saved[0], 1)
+        os.dup2(self._saved[1], 2)
+        # children that outlived the run may still hold the write end open, the stop pipe
+        # wakes the reader anyway. without them it has usually seen eof and gone already
+        try:
+            os.write(self._stop_fd, b"x")
+        except BrokenPipeError:
+            pass
+        self._reader.join(timeout=2)
+        os.close(self._stop_fd)
+        for fd in self._saved:
+            os.close(fd)
+
+
+class PipeReporter:
+    # stands in for an appstate.ProgressState inside a worker,
+    # attribute writes and finished steps are streamed to the parent over the pipe
+    def __init__(self, run_id, conn):
+        object.__setattr__(self, "_run_id", run_id)
+        object.__setattr__(self, "_conn", conn)
+        object.__setattr__(self, "_values", {})
+
+    def __setattr__(self, name, value):
+        self._values[name] = value
+        self._conn.send(("progress", self._run_id, name, value))
+
+    def __getattr__(self, name):
+        try:
+            return self._values[name]
+        except KeyError:
+            return ""
+
+    def step_started(self, index, total, name):
+        self._values["step"] = f"{index}/{total}"
+        self._values["step_name"] = name
+        self._conn.send(("step_start", self._run_id, index, total, name))
+
+    def step_finished(self, index, result):
+        self._conn.send(("step", self._run_id, index, result))
+
+    def steps_done(self):
+        self._values["step_deadline"] = None
+        self._conn.send(("steps_done", self._run_id))
+
+
+def _worker_main(conn):
+    # own process group so a hard kill also takes down emulators and compilers
+    os.setsid()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # stdout is a pipe during a run, flush per line so output streams
+    sys.stdout.reconfigure(line_buffering=True)
+    conn = _LockedConn(conn)
+    import test_runner
+    test_runner.install_cancel_handler()
+
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            return
+        if job is None:
+            return
+
+        _, run_id, module_name, meta = job
+        test_runner.cancel_requested = False
+        capture = OutputCapture(conn, run_id)
+        capture.start()
+        try:
+            apphelpers.testfile_registry[module_name] = meta
+            run = test_runner.run_testfile(module_name, PipeReporter(run_id, conn))
+            summary = run.summary()
+            error = None
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        finally:
+            capture.stop()
+
+        if error is None:
+            conn.send(("done", run_id, summary))
+        else:
+            conn.send(("error", run_id, error))
+
+
+class RunnerWorker:
+    def __init__(self, ctx):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_main, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.runs = 0
+        self.cancel_deadline = None
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    def rss(self):
+        return rss_bytes(process_tree(self.pid))
+
+    def cancel(self):
+        # soft cancel, the worker marks the current step CANCELLED and kills its children
+        self.cancel_deadline = time.time() + HARD_KILL_GRACE
+        try:
+            os.kill(self.pid, signal.SIGUSR1)
+        except ProcessLookupError:
+            pass
+
+    def kill(self):
+        # steps running in parallel (test_runner.run_step_graph) lead their own groups
+        tree = set(process_tree(self.pid))
+        groups = {pgrp for pid, _, pgrp in _list_processes() if pid in tree}
+        for pgid in groups | {self.pid}:
+            try:
+                os.killpg(pgid, signal.SIGKILL)
+            except (ProcessLookupError, PermissionError):
+                pass
+        self.process.join(timeout=5)
+        self.conn.close()
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except (OSError, BrokenPipeError):
+            pass
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.kill()
+        else:
+            self.conn.close()
+
+
+class WorkerPool:
+    # reusable runner processes; each run_testfile executes in a worker and streams
+    # progress and step results back over a pipe. workers are recycled after
+    # max_runs runs or once their rss passes max_rss_mb
+    def __init__(self, start_method=WORKER_START_METHOD, max_runs=WORKER_MAX_RUNS,
+                 max_rss_mb=WORKER_MAX_RSS_MB, step_wall_limit=STEP_WALL_LIMIT,
+                 step_max_rss_mb=STEP_MAX_RSS_MB):
+        self._ctx = multiprocessing.get_context(start_method)
+        self.max_runs = max_runs
+        self.max_rss = max_rss_mb * 1024 * 1024
+        self.step_wall_limit = step_wall_limit
+        self.step_max_rss = step_max_rss_mb * 1024 * 1024
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def submit(self, run_id, module_name, meta, on_message, on_done):
+        # on_message(kind, *payload) for "progress", "step_start", "step" and "log" messages,
+        # on_done(summary, error, steps) once the run ends, steps being the StepResults streamed so far
+        with self._lock:
+            worker = self._idle.pop() if self._idle else RunnerWorker(self._ctx)
+
+        thread = threading.Thread(
+            target=self._supervise,
+            args=(worker, run_id, module_name, meta, on_message, on_done),
+            name=f"runner-{run_id}",
+            daemon=True,
+        )
+        thread.start()
+        return worker
+
+    def _supervise(self, worker, run_id, module_name, meta, on_message, on_done):
+        summary = None
+        error = None
+        results = []
+        healthy = True
+        step_started = time.time()
+        step_deadline = None
+        # False once the worker is only writing the report, step limits no longer apply
+        in_steps = True
+        worker.cancel_deadline = None
+
+        try:
+            worker.conn.send(("run", run_id, module_name, meta))
+        except (OSError, BrokenPipeError) as e:
+            worker.kill()
+            on_done(None, f"worker unavailable: {e}", results)
+            return
+
+        while True:
+            if worker.conn.poll(SUPERVISE_INTERVAL):
+                try:
+                    msg = worker.conn.recv()
+                except (EOFError, OSError):
+                    error = f"worker {worker.pid} exited during the run"
+                    healthy = False
+                    break
+
+                kind = msg[0]
+                if kind == "progress":
+                    if msg[2] == "step_deadline":
+                        step_deadline = msg[3]
+                    on_message(*msg)
+                elif kind == "step_start":
+                    step_started = time.time()
+                    in_steps = True
+                    on_message(*msg)
+                elif kind == "steps_done":
+                    step_deadline = None
+                    in_steps = False
+                elif kind == "log":
+                    on_message(*msg)
+                elif kind == "step":
+                    results.append(msg[3])
+                    on_message(*msg)
+                elif kind == "done":
+                    summary = msg[2]
+                    break
+                elif kind == "error":
+                    error = msg[2]
+                    break
+                continue
+
+            if not worker.process.is_alive():
+                error = f"worker {worker.pid} exited with code {worker.process.exitcode}"
+                healthy = False
+                break
+
+            limit_error = self._check_step_limits(worker, step_started, step_deadline, in_steps)
+            if limit_error:
+                error = limit_error
+                healthy = False
+                break
+
+        worker.runs += 1
+        if not healthy:
+            worker.kill()
+        elif self.max_runs and worker.runs >= self.max_runs:
+            worker.stop()
+        elif self.max_rss and worker.rss() > self.max_rss:
+            print(f"runnerpool: recycling worker {worker.pid}, rss over {self.max_rss // (1024 * 1024)}MB")
+            worker.stop()
+        else:
+            with self._lock:
+                self._idle.append(worker)
+
+        on_done(summary, error, results)
+
+    def _check_step_limits(self, worker, step_started, step_deadline, in_steps=True):
+        now = time.time()
+        if worker.cancel_deadline and now > worker.cancel_deadline:
+            return "cancelled, worker did not stop in time"
+        if not in_steps:
+            return None
+        if step_deadline and now > step_deadline + HARD_KILL_GRACE:
+            return "step timed out, worker did not stop in time"
+        if self.step_wall_limit and time.time() - step_started > self.step_wall_limit:
+            return f"step exceeded wall-clock limit of {self.step_wall_limit:.0f}s"
+        if self.step_max_rss:
+            rss = worker.rss()
+            if rss > self.step_max_rss:
+                return f"step exceeded memory limit ({rss // (1024 * 1024)}MB > {self.step_max_rss // (1024 * 1024)}MB)"
+        return None
+
+    def shutdown(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for worker in idle:
+            worker.stop()
@@ -0,0 +1,436 @@
+import os
+import time
+import threading
+
+import apphelpers
+import appstate
+import runlog
+import artifacts
+import sharding
+import imagepipeline
+from eventbus import bus
+from runnerpool import WorkerPool
+from results import Status, StepResult, RunResult
+
+
+DEFAULT_WORKERS = int(os.environ.get("TESTRUNNER_WORKERS", "4"))
+# a remote worker that hasn't sent a heartbeat for this long has its run requeued
+REMOTE_TIMEOUT = float(os.environ.get("TESTRUNNER_REMOTE_TIMEOUT", "60"))
+# registry fields sent to remote workers with a claimed run
+REMOTE_META_KEYS = ("id", "types", "description", "system", "platform", "__full_path__")
+# progress fields a remote worker may set on the run's ProgressState, paths and results
+# (scratch_dir, report_path, result, steps) are the server's own and never come off the wire
+REMOTE_PROGRESS_FIELDS = ("step", "step_name", "test_name", "testname", "testid", "testtype")
+
+
+class RunQueue:
+    # runs testlists concurrently on a bounded runnerpool.WorkerPool. the queue itself lives in
+    # the run_queue table so batches survive a restart; each run gets its own
+    # appstate.ProgressState keyed by the run_queue row id. remote workers (remoteworker.py)
+    # claim runs over http through the claim_remote/remote_* methods, max_workers=0 leaves
+    # every run to them
+    def __init__(self, db, max_workers=DEFAULT_WORKERS, poll_interval=2.0):
+        self.db = db
+        self.max_workers = max(0, int(max_workers))
+        self.poll_interval = poll_interval
+        self.pool = WorkerPool()
+        self._running = {}
+        self._wakeup = threading.Condition()
+        self._stale_checked = 0.0
+        # remote worker name -> when it last claimed or sent a heartbeat
+        self._remote_seen = {}
+
+        resumed = self.db.requeue_interrupted_runs()
+        if resumed:
+            print(f"runqueue: resuming {resumed} interrupted run(s)")
+
+        self._dispatcher = threading.Thread(target=self._dispatch, name="runqueue-dispatch", daemon=True)
+        self._dispatcher.start()
+
+    def submit(self, module_names, request=None):
+        # each run is queued with its estimated duration, the batch with when it should be done
+        estimates = sharding.estimate_durations(self.db, module_names)
+        workers = self.worker_count()
+        finishes = self._forecast([estimates[m] for m in module_names], workers)
+        predicted_finish = max(finishes, default=time.time())
+        batch_id, run_ids = self.db.create_run_batch(module_names, request=request, estimates=estimates,
+                                                     predicted_finish=predicted_finish, workers=workers)
+        for run_id, module_name in zip(run_ids, module_names):
+            state = appstate.new_run_state(module_name, run_id=run_id)
+            state.batch_id = batch_id
+            state.estimate = estimates[module_name]
+            state.batch_eta = predicted_finish
+            state.set_status("queued", step="Queued")
+            print(f"run {module_name} queued as run {run_id}, estimated {estimates[module_name]:.1f}s")
+        print(f"runqueue: batch {batch_id} predicted to take {predicted_finish - time.time():.1f}s on {workers} worker(s)")
+        self._notify()
+        return batch_id, run_ids
+
+    def worker_count(self):
+        # local slots plus the remote workers heard from lately, at least one
+        cutoff = time.time() - REMOTE_TIMEOUT
+        remote = sum(1 for seen in list(self._remote_seen.values()) if seen >= cutoff)
+        return max(1, self.max_workers + remote)
+
+    def _forecast(self, durations=(), workers=None, batch_id=None):
+        # lpt simulation of the queue: running runs finish after what is left of their estimate,
+        # queued runs follow batch by batch, then durations, a batch about to be queued.
+        # returns the finish times of durations, or of batch_id's unfinished runs without them
+        now = time.time()
+        running = self.db.get_runs(status="running", limit=100000)
+        queued = self.db.get_runs(status="queued", limit=100000)
+        busy = [max((r["estimate"] or 0.0) - (now - (r["started_at"] or now)), 0.0) for r in running]
+        loads = sorted(busy) + [0.0] * max(0, (workers or self.worker_count()) - len(busy))
+
+        finishes = [now + left for r, left in zip(running, busy) if r["batch_id"] == batch_id]
+        by_batch = {}
+        for r in queued:
+            by_batch.setdefault(r["batch_id"], []).append(r)
+        for queued_batch in sorted(by_batch, key=lambda b: b or 0):
+            done = sharding.pack([r["estimate"] or 0.0 for r in by_batch[queued_batch]], loads)
+            if queued_batch == batch_id:
+                finishes.extend(now + f for f in done)
+        if durations:
+            return [now + f for f in sharding.pack(list(durations), loads)]
+        return finishes
+
+    def batch_status(self, batch_id):
+        # predicted against actual completion of a batch, eta while it is still going
+        batch = self.db.get_batch(batch_id)
+        if batch is None:
+            return None
+        created, predicted, finished = batch["created_at"], batch["predicted_finish"], batch["finished_at"]
+        runs = self.db.get_runs(batch_id=batch_id, limit=100000)
+        batch.update({
+            "batch_id": batch_id,
+            "predicted_duration": round(predicted - created, 2) if predicted else None,
+            "actual_duration": round(finished - created, 2) if finished else None,
+            "error_s": round(finished - predicted, 2) if finished and predicted else None,
+            "eta": None,
+            "runs": [{
+                "id": r["id"],
+                "module_name": r["module_name"],
+                "status": r["status"],
+                "worker": r["worker"],
+                "estimate": r["estimate"],
+                "duration": round(r["finished_at"] - r["started_at"], 2)
+                            if r["finished_at"] and r["started_at"] else None,
+            } for r in reversed(runs)],
+        })
+        if finished is None:
+            batch["eta"] = max(self._forecast(batch_id=batch_id), default=None)
+        return batch
+
+    def cancel(self, run_id):
+        status = self.db.cancel_run(run_id)
+        state = appstate.get_run_state(run_id)
+        if state is not None and status == "cancelled":
+            state.set_status("cancelled", step="Cancelled")
+        elif status == "running":
+            with self._wakeup:
+                worker = self._running.get(run_id)
+            if worker is not None:
+                worker.cancel()
+        return status
+
+    def _notify(self):
+        with self._wakeup:
+            self._wakeup.notify()
+
+    def _dispatch(self):
+        while True:
+            self._requeue_stale()
+            with self._wakeup:
+                if len(self._running) >= self.max_workers:
+                    self._wakeup.wait(self.poll_interval)
+                    continue
+
+            try:
+                claimed = self.db.claim_next_run(choose=sharding.chooser(self.db))
+            except Exception as e:
+                print(f"runqueue: claim failed: {e}")
+                claimed = None
+
+            if claimed is None:
+                with self._wakeup:
+                    self._wakeup.wait(self.poll_interval)
+                continue
+
+            self._start(claimed)
+
+    def _requeue_stale(self):
+        now = time.time()
+        if now - self._stale_checked < self.poll_interval:
+            return
+        self._stale_checked = now
+        try:
+            run_ids = self.db.requeue_stale_runs(now - REMOTE_TIMEOUT)
+        except Exception as e:
+            print(f"runqueue: stale check failed: {e}")
+            return
+        for run_id in run_ids:
+            print(f"runqueue: remote worker of run {run_id} went quiet, requeued")
+            log = runlog.get_log(run_id)
+            if log is not None and not log.closed:
+                log.append("\n===== remote worker went quiet, run requeued =====\n")
+            state = appstate.get_run_state(run_id)
+            if state is not None:
+                artifacts.remove_scratch_dir(state.scratch_dir)
+                state.scratch_dir = None
+                state.steps = []
+                state.started_at = None
+                state.set_status("queued", step="Queued")
+
+    def _start(self, claimed):
+        import test_runner
+
+        run_id = claimed["id"]
+        module_name = claimed["module_name"]
+        state = appstate.get_run_state(run_id) or appstate.new_run_state(module_name, run_id=run_id)
+
+        meta = apphelpers.testfile_registry.get(module_name)
+        if not meta:
+            test_runner.reload_tests()
+            meta = apphelpers.testfile_registry.get(module_name)
+        if not meta:
+            state.step_name = "No registry entry"
+            self._record(state, "failed", {"error": f"{module_name} not found in testfile_registry"})
+            return
+
+        state.set_status("running")
+        runlog.open_log(run_id)
+        with self._wakeup:
+            self._running[run_id] = self.pool.submit(
+                run_id, module_name, dict(meta),
+                on_message=self._on_message,
+                on_done=lambda summary, error, results, s=state, m=meta: self._finished(s, m, summary, error, results),
+            )
+
+    def _on_message(self, kind, run_id, *payload):
+        state = appstate.get_run_state(run_id)
+        if state is None or state.status != "running":
+            return
+        if kind == "progress":
+            name, value = payload
+            if name != "status":
+                setattr(state, name, value)
+        elif kind == "step_start":
+            state.step_started(*payload)
+        elif kind == "step":
+            state.step_finished(*payload)
+            self._log_step(run_id, payload[1])
+        elif kind == "log":
+            log = runlog.get_log(run_id)
+            if log is not None:
+                log.append(payload[0])
+
+    def _log_step(self, run_id, result):
+        # the step's own log_output / stdout only arrive once it returns
+        log = runlog.get_log(run_id)
+        if log is None:
+            return
+        text = f"\n===== {result.name}: {result.status} ({result.duration:.2f}s) =====\n"
+        if result.output:
+            text += f"OUTPUT:\n{result.output}\n"
+        if result.stdout:
+            text += f"STDOUT:\n{result.stdout}\n"
+        log.append(text)
+
+    def _finished(self, state, meta, summary, error, results):
+        with self._wakeup:
+            self._running.pop(state.run_id, None)
+            self._wakeup.notify()
+
+        if error is None:
+            result = summary
+            status = "done"
+        else:
+            result = {"error": error, "steps": len(results)}
+            status = "failed"
+            print(f"Run {state.run_id} failed for {state.testname}: {error}")
+            if results or state.step_name:
+                # the worker died before writing its report, keep what it streamed
+                self._record_partial(state, meta, error, results)
+
+        run = self.db.get_run(state.run_id)
+        if run and run["cancel_requested"]:
+            status = "cancelled"
+        self._record(state, status, result)
+        print(f"Run {state.run_id} finished for {state.testname}: {status} {result}")
+
+    def _record_partial(self, state, meta, error, results):
+        import test_runner
+
+        name = state.step_name or f"{len(results) + 1}_unknown"
+        if not any(r.name == name for r in results):
+            started = state.started_at or time.time()
+            elapsed = max(round(time.time() - started - sum(r.duration for r in results), 2), 0.0)
+            status = Status.CANCELLED if error.startswith("cancelled") else Status.TIMEOUT if "timed out" in error else Status.ERROR
+            results = results + [StepResult(name, status, f"Runner worker killed: {error}", duration=elapsed,
+                                            start_time=time.time() - elapsed, stop_time=time.time())]
+        run = RunResult(state.testname, meta.get("id") or state.testname, test_runner.meta_test_types(meta),
+                        results, started_at=state.started_at, finished_at=time.time())
+        try:
+            state.report_path = test_runner.record_results(run, state.scratch_dir)
+        except Exception as e:
+            print(f"Run {state.run_id}: could not record partial results: {e}")
+
+    def _record(self, state, status, result):
+        report_dir = os.path.dirname(state.report_path) if state.report_path else None
+        log = runlog.get_log(state.run_id)
+        if log is not None:
+            log.close(report_dir)
+        imagepipeline.submit(report_dir)
+        self.db.finish_run(state.run_id, status, result)
+        state.result = result
+        state.set_status(status, step={"done": "Done", "cancelled": "Cancelled"}.get(status, "Error"))
+        self._check_batch_done(state.run_id)
+
+    def _check_batch_done(self, run_id):
+        run = self.db.get_run(run_id)
+        batch = self.db.get_batch(run["batch_id"]) if run else None
+        if batch is None or batch["finished_at"] is None:
+            return
+        actual = batch["finished_at"] - batch["created_at"]
+        predicted = (batch["predicted_finish"] or batch["created_at"]) - batch["created_at"]
+        print(f"runqueue: batch {batch['id']} finished in {actual:.1f}s, predicted {predicted:.1f}s")
+        bus.publish("batch", {"batch_id": batch["id"], "actual_duration": round(actual, 2),
+                              "predicted_duration": round(predicted, 2)})
+
+    def claim_remote(self, worker, shard=0, shards=1):
+        # hands the next run of the worker's shard to a remote worker, None when nothing is queued
+        self._remote_seen[worker] = time.time()
+        claimed = self.db.claim_next_run(worker=worker, choose=sharding.chooser(self.db, shard, shards))
+        if claimed is None:
+            return None
+
+        import test_runner
+
+        run_id = claimed["id"]
+        module_name = claimed["module_name"]
+        state = appstate.get_run_state(run_id) or appstate.new_run_state(module_name, run_id=run_id)
+        meta = apphelpers.testfile_registry.get(module_name)
+        if not meta:
+            test_runner.reload_tests()
+            meta = apphelpers.testfile_registry.get(module_name) or {}
+
+        state.set_status("running", step=f"Sent to {worker}")
+        runlog.open_log(run_id)
+        print(f"runqueue: run {run_id} ({module_name}) claimed by {worker}, shard {shard}/{shards}")
+        return {
+            "run_id": run_id,
+            "batch_id": claimed["batch_id"],
+            "module_name": module_name,
+            "meta": {k: meta[k] for k in REMOTE_META_KEYS if k in meta},
+        }
+
+    def remote_progress(self, run_id, worker, messages=()):
+        # heartbeat with what the worker's reporter saw since the last one, same messages as
+        # the runnerpool pipe. returns cancel_requested, None if the run isn't the worker's anymore
+        cancel = self.db.touch_remote_run(run_id, worker)
+        if cancel is None:
+            return None
+        self._remote_seen[worker] = time.time()
+        self._remote_state(run_id)
+        for message in messages:
+            try:
+                kind, *payload = message
+                if kind == "progress":
+                    name, value = payload
+                    if name not in REMOTE_PROGRESS_FIELDS or not isinstance(value, (str, int, float, type(None))):
+                        continue
+                elif kind == "step_start":
+                    index, total, name = payload
+                elif kind == "step":
+                    payload = [int(payload[0]), StepResult.from_dict(payload[1])]
+                elif kind == "log":
+                    if not isinstance(payload[0], str):
+                        continue
+                else:
+                    continue
+            except (TypeError, ValueError, KeyError, IndexError):
+                print(f"runqueue: run {run_id}: bad message from {worker}: {message!r:.200}")
+                continue
+            self._on_message(kind, run_id, *payload)
+        return cancel
+
+    def remote_artifacts(self, run_id, worker, fileobj, max_bytes=None):
+        # the worker's scratch dir, collected into the report by remote_finish
+        if self.db.touch_remote_run(run_id, worker) is None:
+            return None
+        state = self._remote_state(run_id)
+        scratch_dir = artifacts.open_scratch_dir()
+        try:
+            count = artifacts.unpack(fileobj, scratch_dir, max_bytes)
+        except Exception:
+            artifacts.remove_scratch_dir(scratch_dir)
+            raise
+        artifacts.remove_scratch_dir(state.scratch_dir)
+        state.scratch_dir = scratch_dir
+        return count
+
+    def remote_finish(self, run_id, worker, run_data=None, error=None):
+        # run_data is RunResult.as_dict() from the worker, error set if run_testfile raised.
+        # returns the run_queue status, None if the run isn't the worker's anymore
+        if self.db.touch_remote_run(run_id, worker) is None:
+            return None
+
+        import test_runner
+
+        row = self.db.get_run(run_id)
+        state = self._remote_state(run_id, row)
+        try:
+            run = RunResult.from_dict(run_data) if run_data else None
+        except (TypeError, ValueError, KeyError) as e:
+            run, error = None, f"bad result from {worker}: {type(e).__name__}: {e}"
+        if run is not None:
+            # names the report file, the queue's own record is the one to trust
+            run.module_name = row["module_name"]
+        if run is not None and run.started_at is not None:
+            try:
+                state.report_path = test_runner.record_results(run, state.scratch_dir)
+            except Exception as e:
+                print(f"Run {run_id}: could not record results from {worker}: {e}")
+                error = error or f"{type(e).__name__}: {e}"
+        else:
+            artifacts.remove_scratch_dir(state.scratch_dir)
+
+        if error is None:
+            result = run.summary() if run is not None else None
+            status = "done"
+        else:
+            result = {"error": error, "steps": len(run.steps) if run else 0}
+            status = "failed"
+        if row["cancel_requested"]:
+            status = "cancelled"
+        self._record(state, status, result)
+        print(f"Run {run_id} finished on {worker} for {state.testname}: {status} {result}")
+        return status
+
+    def _remote_state(self, run_id, row=None):
+        state = appstate.get_run_state(run_id)
+        if state is None:
+            # claimed before this process started
+            row = row or self.db.get_run(run_id)
+            state = appstate.new_run_state(row["module_name"], run_id=run_id)
+            state.set_status("running")
+            runlog.open_log(run_id)
+        return state
+
+    def shutdown(self):
+        self.pool.shutdown()
+
+
+_run_queue = None
+_run_queue_lock = threading.Lock()
+
+
+def get_run_queue(db=None, max_workers=None):
+    global _run_queue
+    with _run_queue_lock:
+        if _run_queue is None:
+            if db is None:
+                from dbhelper import ReportDB
+                db = ReportDB()
+            _run_queue = RunQueue(db, DEFAULT_WORKERS if max_workers is None else max_workers)
+        return _run_queue
@@ -0,0 +1,88 @@
+import os
+import heapq
+
+
+# duration-aware scheduling of the run queue. each testlist's duration is estimated from
+# its recent reports, runs of the oldest batch are handed out longest first (lpt), which
+# keeps the batch's makespan short on a pool. remote workers started with --shard i --shards n
+# split the batch: its queued runs are packed longest first onto the n shards, worker i
+# takes the longest run of its own shard and steals the longest one left once it is empty
+ESTIMATE_RUNS = int(os.environ.get("TESTRUNNER_ESTIMATE_RUNS", "10"))
+# weight of the newest run in the moving average, older runs fade by (1 - alpha) each
+ESTIMATE_ALPHA = float(os.environ.get("TESTRUNNER_ESTIMATE_ALPHA", "0.5"))
+# seconds assumed for a testlist that never ran and nothing else to go by
+DEFAULT_ESTIMATE = float(os.environ.get("TESTRUNNER_DEFAULT_ESTIMATE", "60"))
+
+
+def ewma(durations, alpha=ESTIMATE_ALPHA):
+    # durations newest first
+    estimate = None
+    for value in reversed(durations):
+        estimate = value if estimate is None else alpha * value + (1 - alpha) * estimate
+    return estimate
+
+
+def estimate_durations(db, module_names):
+    # {module_name: seconds}, an ewma over its last ESTIMATE_RUNS reports (test_result durations).
+    # testlists without history get the mean of the others
+    history = db.get_duration_history(module_names, ESTIMATE_RUNS)
+    estimates = {name: ewma(runs) for name, runs in history.items() if runs}
+    fallback = sum(estimates.values()) / len(estimates) if estimates else DEFAULT_ESTIMATE
+    return {name: estimates.get(name, fallback) for name in module_names}
+
+
+def pack(durations, loads):
+    # places durations longest first, each on the least loaded worker. loads is how long each
+    # worker is busy already and is updated in place. returns the finish times, in input order
+    heap = [(load, i) for i, load in enumerate(loads)]
+    heapq.heapify(heap)
+    finishes = [0.0] * len(durations)
+    for pos in sorted(range(len(durations)), key=lambda p: -durations[p]):
+        load, i = heapq.heappop(heap)
+        load += durations[pos]
+        finishes[pos] = loads[i] = load
+        heapq.heappush(heap, (load, i))
+    return finishes
+
+
+def partition(runs, estimates, shards):
+    # longest processing time first: each run goes to the shard with the least work so far.
+    # runs are run_queue rows, ties keep queue order
+    shards = max(1, int(shards))
+    ordered = sorted(runs, key=lambda r: (-estimates.get(r["module_name"], 0.0), r["id"]))
+    buckets = [[] for _ in range(shards)]
+    loads = [0.0] * shards
+    for run in ordered:
+        target = min(range(shards), key=lambda i: (loads[i], i))
+        buckets[target].append(run)
+        loads[target] += estimates.get(run["module_name"], 0.0)
+    return buckets
+
+
+def choose(runs, estimates, shard=0, shards=1, steal=True):
+    # the run worker shard of shards should take next, None when there is nothing for it.
+    # batches go in order, a new batch never overtakes one that is still queued
+    if not runs:
+        return None
+    oldest = min(r["batch_id"] or 0 for r in runs)
+    runs = [r for r in runs if (r["batch_id"] or 0) == oldest]
+    buckets = partition(runs, estimates, shards)
+    own = buckets[int(shard) % len(buckets)]
+    if own:
+        return own[0]
+    if not steal:
+        return None
+    rest = [b[0] for b in buckets if b]
+    return max(rest, key=lambda r: estimates.get(r["module_name"], 0.0)) if rest else None
+
+
+def chooser(db, shard=0, shards=1, steal=True):
+    # for ReportDB.claim_next_run(choose=...). runs keep the estimate they were queued with,
+    # only rows queued without one are estimated here
+    def pick(runs):
+        estimates = {r["module_name"]: r["estimate"] for r in runs if r.get("estimate") is not None}
+        missing = [r["module_name"] for r in runs if r["module_name"] not in estimates]
+        if missing:
+            estimates.update(estimate_durations(db, missing))
+        return choose(runs, estimates, shard, shards, steal)
+    return pick
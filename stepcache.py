@@ -0,0 +1,234 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import inspect
+import tempfile
+
+from dbhelper import BASE_DIR
+from results import Status, StepResult
+
+
+# build steps that opt in with "cache": true are skipped when their inputs hash to a key
+# that already has a passing result, the outputs they wrote to paths["out"] are restored
+CACHE_DIR = os.environ.get("TESTRUNNER_BUILD_CACHE_DIR", os.path.join(BASE_DIR, "build_cache"))
+# least recently used entries go once the cache grows past this, 0 = no limit
+CACHE_MAX_MB = int(os.environ.get("TESTRUNNER_BUILD_CACHE_MB", "2048"))
+# results of dispatch functions marked dispatchhelper.cacheable, no output files
+MEMO_DIR = os.environ.get("TESTRUNNER_MEMO_DIR", os.path.join(BASE_DIR, "build_cache", "_memo"))
+MEMO_MAX_MB = int(os.environ.get("TESTRUNNER_MEMO_MB", "256"))
+# CONFIG fields that change what a build produces
+CONFIG_KEYS = ("cmainfile", "archtype", "linkerconf")
+META_NAME = "result.json"
+OUT_DIR_NAME = "out"
+
+
+def _file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _hash_path(h, path):
+    # a file, or every file under a dir, names relative to path
+    if os.path.isfile(path):
+        h.update(_file_digest(path).encode())
+        return
+    if not os.path.isdir(path):
+        raise FileNotFoundError(path)
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for fname in sorted(files):
+            fpath = os.path.join(root, fname)
+            h.update(os.path.relpath(fpath, path).encode() + b"\0" + _file_digest(fpath).encode())
+
+
+def _func_source(func):
+    try:
+        return inspect.getsource(func)
+    except (OSError, TypeError):
+        return getattr(func, "__qualname__", repr(func))
+
+
+def step_key(paths, config, func, params):
+    # sha256 over the project sources, the linker cfg, the CONFIG fields in CONFIG_KEYS,
+    # the step function and its params. None when the inputs can't be read
+    h = hashlib.sha256()
+    h.update(_func_source(func).encode())
+    h.update(json.dumps(params, sort_keys=True, default=str).encode())
+    h.update(json.dumps({k: config.get(k) for k in CONFIG_KEYS}, sort_keys=True).encode())
+    try:
+        _hash_path(h, paths["src"])
+        linker = paths.get("linker")
+        if linker and os.path.isfile(linker):
+            h.update(b"linker\0" + _file_digest(linker).encode())
+    except (KeyError, OSError) as e:
+        print(f"[stepcache] no key: {e}")
+        return None
+    return h.hexdigest()
+
+
+def memo_key(func, params, inputs):
+    # sha256 over the function source, its params and the declared input files.
+    # None when an input is missing, the step then just runs
+    h = hashlib.sha256()
+    h.update(f"{func.__module__}.{func.__qualname__}\0".encode())
+    h.update(_func_source(func).encode())
+    h.update(json.dumps(params, sort_keys=True, default=str).encode())
+    try:
+        for path in inputs:
+            h.update(b"\0" + path.encode() + b"\0")
+            _hash_path(h, path)
+    except OSError as e:
+        print(f"[stepcache] no memo key: {e}")
+        return None
+    return h.hexdigest()
+
+
+def snapshot(out_dir):
+    # {path relative to out_dir: (size, mtime_ns)}, taken before a step so store() can tell
+    # the files it wrote from the ones earlier steps or runs left there
+    files = {}
+    if not out_dir or not os.path.isdir(out_dir):
+        return files
+    for root, _, names in os.walk(out_dir):
+        for fname in names:
+            path = os.path.join(root, fname)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            files[os.path.relpath(path, out_dir)] = (st.st_size, st.st_mtime_ns)
+    return files
+
+
+class StepCache:
+    # on-disk store of passing step results, one dir per key with result.json and the
+    # step's output files, lru evicted by size. entries are written to a temp dir and
+    # renamed into place so concurrent workers never see half an entry
+    def __init__(self, root, max_mb, label):
+        self.root = root
+        self.max_bytes = max_mb * 1024 * 1024
+        self.label = label
+
+    def _entry_dir(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def lookup(self, key, name, out_dir=None):
+        # a CACHED StepResult, with the outputs copied back into out_dir, None on a miss
+        entry = self._entry_dir(key)
+        started = time.time()
+        try:
+            with open(os.path.join(entry, META_NAME)) as f:
+                meta = json.load(f)
+            cached_out = os.path.join(entry, OUT_DIR_NAME)
+            if out_dir and os.path.isdir(cached_out):
+                shutil.copytree(cached_out, out_dir, dirs_exist_ok=True)
+            # mtime is the lru clock
+            os.utime(entry)
+        except (OSError, ValueError):
+            return None
+
+        note = (f"[{self.label}] unchanged inputs, result of the run at "
+                f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(meta['stop_time']))} "
+                f"(saved {meta['duration']:.2f}s)\n")
+        return StepResult(name, Status.CACHED, note + meta["output"], meta["stdout"],
+                          time.time() - started, start_time=started,
+                          metrics={"cache": self.label, "cache_key": key[:16],
+                                   "saved_s": round(meta["duration"], 3)})
+
+    def store(self, key, result, out_dir=None, before=None):
+        # keeps a passing result plus the files in out_dir that are new or changed since the
+        # snapshot() in before, first writer wins
+        entry = self._entry_dir(key)
+        if os.path.exists(entry):
+            return False
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        tmp = tempfile.mkdtemp(prefix=".tmp-", dir=os.path.dirname(entry))
+        try:
+            size = 0
+            before = before or {}
+            for rel, stamp in snapshot(out_dir).items():
+                if before.get(rel) == stamp:
+                    continue
+                dest = os.path.join(tmp, OUT_DIR_NAME, rel)
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                shutil.copy2(os.path.join(out_dir, rel), dest)
+                size += os.path.getsize(dest)
+            meta = {
+                "name": result.name,
+                "output": result.output,
+                "stdout": result.stdout,
+                "duration": result.duration,
+                "stop_time": result.stop_time,
+            }
+            meta["size"] = size + len(json.dumps(meta))
+            with open(os.path.join(tmp, META_NAME), "w") as f:
+                json.dump(meta, f)
+            os.rename(tmp, entry)
+        except OSError as e:
+            # another worker stored the same key first, or the disk is full
+            shutil.rmtree(tmp, ignore_errors=True)
+            if not os.path.exists(entry):
+                print(f"[stepcache] could not store {key[:16]}: {e}")
+            return False
+        self.evict()
+        return True
+
+    def _entries(self):
+        # (mtime, size, path) per entry
+        entries = []
+        if not os.path.isdir(self.root):
+            return entries
+        for prefix in os.listdir(self.root):
+            prefix_dir = os.path.join(self.root, prefix)
+            # two hex chars, anything else is another store nested in this one
+            if len(prefix) != 2 or not os.path.isdir(prefix_dir):
+                continue
+            for name in os.listdir(prefix_dir):
+                entry = os.path.join(prefix_dir, name)
+                if name.startswith(".tmp-"):
+                    continue
+                try:
+                    with open(os.path.join(entry, META_NAME)) as f:
+                        size = json.load(f).get("size", 0)
+                    entries.append((os.path.getmtime(entry), size, entry))
+                except (OSError, ValueError):
+                    continue
+        return entries
+
+    def evict(self, max_bytes=None):
+        # drops least recently used entries until the store fits, returns how many went
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        if not max_bytes:
+            return 0
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, entry in entries:
+            if total <= max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+            removed += 1
+        return removed
+
+    def stats(self):
+        entries = self._entries()
+        return {
+            "dir": self.root,
+            "entries": len(entries),
+            "bytes": sum(size for _, size, _ in entries),
+            "max_bytes": self.max_bytes,
+        }
+
+
+build_cache = StepCache(CACHE_DIR, CACHE_MAX_MB, "build cache")
+memo_cache = StepCache(MEMO_DIR, MEMO_MAX_MB, "memo")
+
+
+def stats():
+    return {"build": build_cache.stats(), "memo": memo_cache.stats()}
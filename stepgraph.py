@@ -0,0 +1,82 @@
+# dependency graph of the steps in one testlist, steps are 0-based positions here.
+# a step lists the ids it needs in "depends_on". a step without an id gets "#" and its
+# 1-based step number, a plain number in depends_on names that step unless a step has it as id.
+# once any step has "depends_on", a step without it waits for the step before it,
+# so plain lists keep their order and "depends_on": [] marks a step that can start at once
+
+
+def implicit_id(number):
+    return f"#{number}"
+
+
+def build(step_ids, depends_on):
+    # step_ids[i] is the id of step i, depends_on[i] its list or None.
+    # returns deps[i], the positions step i waits for. ValueError on unknown ids and cycles
+    positions = {}
+    for i, step_id in enumerate(step_ids):
+        if step_id in positions:
+            raise ValueError(f"duplicate step id {step_id!r}")
+        positions[step_id] = i
+
+    deps = []
+    for i, wanted in enumerate(depends_on):
+        if wanted is None:
+            deps.append([i - 1] if i else [])
+            continue
+        if isinstance(wanted, (str, int)):
+            wanted = [wanted]
+        current = []
+        for dep in wanted:
+            key = str(dep)
+            if key not in positions and key.isdigit():
+                key = implicit_id(int(key))
+            if key not in positions:
+                raise ValueError(f"step {step_ids[i]!r} depends on unknown step {str(dep)!r}")
+            if positions[key] not in current:
+                current.append(positions[key])
+        deps.append(current)
+
+    order = topo_order(deps)
+    if order is None:
+        raise ValueError("depends_on has a cycle")
+    return deps
+
+
+def topo_order(deps):
+    # positions with every step after the ones it depends on, None on a cycle
+    waiting = [len(d) for d in deps]
+    dependents = [[] for _ in deps]
+    for i, d in enumerate(deps):
+        for dep in d:
+            dependents[dep].append(i)
+    ready = [i for i, n in enumerate(waiting) if n == 0]
+    order = []
+    while ready:
+        i = ready.pop(0)
+        order.append(i)
+        for nxt in dependents[i]:
+            waiting[nxt] -= 1
+            if waiting[nxt] == 0:
+                ready.append(nxt)
+    return order if len(order) == len(deps) else None
+
+
+def critical_path(deps, durations):
+    # (positions on the longest chain of dependent steps, its total duration)
+    finish = [0.0] * len(deps)
+    previous = [None] * len(deps)
+    for i in topo_order(deps) or []:
+        start = 0.0
+        for dep in deps[i]:
+            if previous[i] is None or finish[dep] > start:
+                start, previous[i] = finish[dep], dep
+        finish[i] = start + (durations[i] or 0.0)
+    if not deps:
+        return [], 0.0
+    last = max(range(len(deps)), key=lambda i: finish[i])
+    path = []
+    node = last
+    while node is not None:
+        path.append(node)
+        node = previous[node]
+    return path[::-1], finish[last]
@@ -1,29 +1,42 @@
 import os
 import sys
+if __name__ == "__main__":
+    # python test_runner.py --worker --server URL, see remoteworker.py. handed off before the
+    # imports below, app imports this module again and the __main__ copy would be half loaded
+    import remoteworker
+    sys.exit(remoteworker.main())
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.pycache_prefix = os.path.join(BASE_DIR, "pycache")
 import time
-import re
-import shutil
+import signal
+import threading
 import datetime
 import glob
 import importlib
-from collections import defaultdict
+import pickle
+import queue
 
-from appstate import progress_state
-from app import db
+from appstate import ProgressState
+from results import Status, StepResult, RunResult, usage_snapshot, usage_delta
 import apphelpers
 import dispatchhelper
+import runnerpool
+import reportrender
+import artifacts
+import stepcache
+import stepgraph
 
 TESTSRC_HELPERDIR = "/testsrc/helpers"
 TESTSRC_BASEDIR = "/testsrc/"
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 REPORT_DIR = os.path.join(BASE_DIR, "reports")
-compile_logs_dir = os.path.join(BASE_DIR, "compile_logs")
 DB_PATH = os.path.join(BASE_DIR, "report.sqlite")
 TESTSRC_ROOT = "/testsrc/sourcedir"
 
 failed_loads = []
+# the web app's ReportDB, handed over by app.py. a remote worker never records and never
+# imports app, so it doesn't create or migrate a report.sqlite of its own
+db = None
 import importlib.util
 
 root_parent = os.path.dirname(TESTSRC_ROOT)
@@ -37,28 +50,67 @@ context = {
 
 TESTLIST_PREFIXES = ("__testlist__")
 
+CHILD_KILL_GRACE = 3.0
+# steps of a testlist with depends_on that may run at once, CONFIG "parallel" overrides it
+STEP_PARALLEL = int(os.environ.get("TESTRUNNER_STEP_PARALLEL", "4"))
+# context entries a graph step keeps to itself, a failure only skips the steps that depend on it
+GRAPH_LOCAL_CONTEXT = ("abort",)
 
-class TestrunnerTimer:
-    start_times = {}
-    stop_times = {}
+# set by the cancel signal handler, checked between steps
+cancel_requested = False
+_in_step = False
 
-    @classmethod
-    def set_start(cls, test_name, ts):
-        cls.start_times[test_name] = ts
 
-    @classmethod
-    def set_stop(cls, test_name, ts):
-        cls.stop_times[test_name] = ts
+class StepInterrupted(BaseException):
+    # raised inside a running step by the timeout / cancel signal handlers,
+    # BaseException so "except Exception" in dispatch functions can't swallow it
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
 
-    @classmethod
-    def get_start(cls, test_name):
-        return cls.start_times.get(test_name)
 
-    @classmethod
-    def get_stop(cls, test_name):
-        return cls.stop_times.get(test_name)
+def _on_step_alarm(signum, frame):
+    if _in_step:
+        raise StepInterrupted("TIMEOUT", "Step timed out")
 
 
+def _on_cancel_signal(signum, frame):
+    global cancel_requested
+    cancel_requested = True
+    if _in_step:
+        raise StepInterrupted("CANCELLED", "Run cancelled")
+
+
+def install_cancel_handler():
+    # called once in each runner worker, SIGUSR1 cancels the current run
+    global cancel_requested
+    cancel_requested = False
+    signal.signal(signal.SIGUSR1, _on_cancel_signal)
+    signal.signal(signal.SIGALRM, _on_step_alarm)
+
+
+def _kill_child_processes():
+    # emulators and compilers started by the step, everything below this process
+    me = os.getpid()
+    found = set(runnerpool.process_tree(me))
+    # runner workers lead their own process group, orphaned grandchildren stay in it
+    if os.getpgid(0) == me:
+        found.update(runnerpool.process_group(me))
+    found.discard(me)
+    children = list(found)
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        for pid in children:
+            try:
+                os.kill(pid, sig)
+            except (ProcessLookupError, PermissionError):
+                pass
+        deadline = time.time() + CHILD_KILL_GRACE
+        while children and time.time() < deadline:
+            children = [p for p in children if os.path.exists(f"/proc/{p}")]
+            if children:
+                time.sleep(0.1)
+        if not children:
+            return
 
 
 def load_testfile_from_path(fpath):
@@ -79,49 +131,196 @@ def load_testfile_from_path(fpath):
         return None
 
 
-def reload_tests():
-    global failed_loads
-    failed_loads.clear()
-    apphelpers.clear_registries()
+# discovery index, keyed by absolute testlist path
+# each entry: {"sig": (mtime_ns, size), "modname": str, "entry": registry dict or None, "failed": bool}
+_discovery_index = {}
+_discovery_lock = threading.Lock()
+# set by registrywatcher while a background watcher owns the index
+discovery_watched = False
 
-    if TESTSRC_ROOT not in sys.path:
-        sys.path.insert(0, TESTSRC_ROOT)
 
-    seen_modules = set()
+def _stat_signature(fpath):
+    try:
+        st = os.stat(fpath)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+def _is_testlist_path(fpath):
+    fname = os.path.basename(fpath)
+    return fname.endswith(".py") and fname != "__init__.py" and fname.startswith(TESTLIST_PREFIXES)
+
+
+def _scan_testlist_paths():
+    found = []
     search_path = os.path.join(TESTSRC_ROOT, "**", "*.py")
     for fpath in glob.glob(search_path, recursive=True):
-        fname = os.path.basename(fpath)
-        if fname == "__init__.py":
-            continue
-        if not fname.startswith(TESTLIST_PREFIXES):
-            continue
+        if _is_testlist_path(fpath):
+            found.append(os.path.abspath(fpath))
+    return found
+
+
+def _rebuild_registry_from_index():
+    # testfile_registry and failed_loads are views of the index,
+    # run_testfile clears them so they are rebuilt on every call
+    apphelpers.testfile_registry.clear()
+    failed_loads.clear()
+    for fpath in sorted(_discovery_index):
+        info = _discovery_index[fpath]
+        if info["entry"] is not None:
+            apphelpers.testfile_registry[info["modname"]] = info["entry"]
+        if info["failed"]:
+            failed_loads.append(info["modname"])
+
+
+def _update_index(changed, deleted):
+    for fpath in deleted:
+        info = _discovery_index.pop(fpath, None)
+        if info:
+            sys.modules.pop(info["modname"], None)
+
+    if not changed:
+        return
+
+    # registry_map only matters while a testlist is running, drop stale steps
+    for r in list(apphelpers.registry_map.values()):
+        r[:] = []
 
-        # module name from relative path
+    for fpath in changed:
         rel_path = os.path.relpath(fpath, TESTSRC_ROOT)
         modname = rel_path.replace(os.sep, ".")[:-3]
+        sig = _stat_signature(fpath)
 
-        if modname not in seen_modules:
-            # Load the module first so decorators populate the registry
-            load_testfile_from_path(fpath)
+        apphelpers.testfile_registry.pop(modname, None)
+        before = len(failed_loads)
+        # Load the module first so decorators populate the registry
+        mod = load_testfile_from_path(fpath)
+        del failed_loads[before:]
 
-            # Only set __full_path__ if the module registered itself
-            if modname in apphelpers.testfile_registry:
-                apphelpers.testfile_registry[modname]["__full_path__"] = os.path.abspath(fpath)
+        # Only set __full_path__ if the module registered itself
+        entry = apphelpers.testfile_registry.get(modname)
+        if entry is not None:
+            entry["__full_path__"] = fpath
 
-            seen_modules.add(modname)
+        _discovery_index[fpath] = {
+            "sig": sig,
+            "modname": modname,
+            "entry": entry,
+            "failed": mod is None,
+        }
 
 
-def run_registered_test(name, registry, context):
+def refresh_testlist_paths(fpaths):
+    # targeted refresh used by registrywatcher, no tree walk
+    if TESTSRC_ROOT not in sys.path:
+        sys.path.insert(0, TESTSRC_ROOT)
+
+    with _discovery_lock:
+        changed = []
+        deleted = []
+        for fpath in set(os.path.abspath(p) for p in fpaths):
+            if not _is_testlist_path(fpath):
+                continue
+            sig = _stat_signature(fpath)
+            if sig is None:
+                if fpath in _discovery_index:
+                    deleted.append(fpath)
+            elif fpath not in _discovery_index or _discovery_index[fpath]["sig"] != sig:
+                changed.append(fpath)
+
+        if changed or deleted:
+            print(f"refresh_testlist_paths: {len(changed)} changed, {len(deleted)} deleted")
+            _update_index(changed, deleted)
+            apphelpers.bump_registry_version()
+
+        _rebuild_registry_from_index()
+        return bool(changed or deleted)
+
+
+def reload_tests(force=False):
+    # only re-imports testlists that were added, changed or deleted since the last scan
+    with _discovery_lock:
+        # registrywatcher keeps the index current, skip the tree walk
+        if discovery_watched and _discovery_index and not force:
+            _rebuild_registry_from_index()
+            return
+        _rescan_locked(force)
+
+
+def rescan_tests():
+    # full walk even while watched, used by the watcher's polling fallback
+    with _discovery_lock:
+        return _rescan_locked(False)
+
+
+def _rescan_locked(force):
+    if TESTSRC_ROOT not in sys.path:
+        sys.path.insert(0, TESTSRC_ROOT)
+
+    if force:
+        _discovery_index.clear()
+
+    current = {}
+    seen_modules = set()
+    for fpath in _scan_testlist_paths():
+        modname = os.path.relpath(fpath, TESTSRC_ROOT).replace(os.sep, ".")[:-3]
+        if modname in seen_modules:
+            continue
+        seen_modules.add(modname)
+        current[fpath] = _stat_signature(fpath)
+
+    deleted = [p for p in _discovery_index if p not in current]
+    changed = [p for p, sig in current.items()
+               if p not in _discovery_index or _discovery_index[p]["sig"] != sig]
+
+    if changed or deleted:
+        print(f"reload_tests: {len(changed)} changed, {len(deleted)} deleted")
+        _update_index(changed, deleted)
+        apphelpers.bump_registry_version()
+
+    _rebuild_registry_from_index()
+    return bool(changed or deleted)
+
+
+def run_registered_test(name, registry, context, timeout=None):
     # this runs each individual decorated test step
+    global _in_step
     for test_func in registry:
         if test_func.test_description == name:
+            log_output = ""
+            stdout_output = ""
+            start_time = time.time()
+            usage_before = usage_snapshot()
+            # timeouts need SIGALRM, only available on the main thread
+            use_alarm = bool(timeout) and threading.current_thread() is threading.main_thread()
+            # (stepcache.StepCache, key function, output dir) set by run_testfile for cached steps
+            cache_spec = getattr(test_func, "cache_spec", None)
+            cache_key = None
+            out_before = None
             try:
                 if context.get("abort"):
-                    return (name, "FAIL", "red", "Aborted due to previous failure", "", 0.00)
+                    return StepResult(name, Status.FAIL, "Aborted due to previous failure", start_time=start_time)
+
+                if cache_spec:
+                    cache_key = cache_spec[1]()
+                    cached = cache_spec[0].lookup(cache_key, name, cache_spec[2]) if cache_key else None
+                    if cached:
+                        print(f"Cached {name}")
+                        return cached
+                    if cache_key:
+                        out_before = stepcache.snapshot(cache_spec[2])
 
                 print(f"Running {name}")
-                start_time = time.time()
-                result = test_func(context)
+                try:
+                    if use_alarm:
+                        signal.setitimer(signal.ITIMER_REAL, timeout)
+                    _in_step = True
+                    result = test_func(context)
+                finally:
+                    _in_step = False
+                    if use_alarm:
+                        signal.setitimer(signal.ITIMER_REAL, 0)
                 duration = time.time() - start_time
                 
                 if isinstance(result, tuple):
@@ -132,47 +331,96 @@ def run_registered_test(name, registry, context):
                     success = result # Fallback if test returns a single value
 
                 if context.get("abort") is True:
-                    status = "FAIL"
-                    color = "red"
+                    status = Status.FAIL
+                else:
+                    status = Status.PASS if success else Status.FAIL
+
+            except StepInterrupted as e:
+                duration = time.time() - start_time
+                _kill_child_processes()
+                context["abort"] = True
+                status = Status(e.status)
+                if status == Status.TIMEOUT:
+                    log_output = f"{e} after {duration:.2f}s (limit {timeout}s)"
                 else:
-                    if success:
-                        status = "PASS"
-                        color = "green"
-                    else:
-                        status = "FAIL"
-                        color = "red"
+                    log_output = f"{e} after {duration:.2f}s"
 
             except Exception as e:
-                status = "ERROR"
+                status = Status.ERROR
                 log_output = str(e)
                 stdout_output = ""
-                color = "gray"
                 duration = 0.00
 
-            return (name, status, color, log_output, stdout_output, duration)
+            result = StepResult(name, status, log_output, stdout_output, duration,
+                                start_time=start_time, stop_time=time.time(),
+                                metrics=usage_delta(usage_before))
+            if cache_key and status == Status.PASS:
+                cache_spec[0].store(cache_key, result, cache_spec[2], out_before)
+            return result
+
+    return StepResult(name, Status.NOT_FOUND, "No matching test found")
 
-    return (name, "NOT FOUND", "gray", "No matching test found", "", 0.00)
+
+def _as_timeout(value):
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return value if value > 0 else None
 
 
-def run_testfile(module_name, state=None):
+def run_testfile(module_name, state=None, record=True):
+    # record=False leaves the report to the caller, remote workers upload the RunResult
+    # and state.scratch_dir to the server instead (remoteworker.py)
     global failed_loads
     failed_loads.clear()
     
-    all_tests = []
-    test_descriptions = []
-    context = {"sock": None, "abort": False}
-
     meta = apphelpers.testfile_registry.get(module_name)
     if not meta:
         print(f"ERROR: {module_name} not found in testfile_registry")
         if state:
             state.step, state.test_name = "Error", "No registry entry"
-        return []
+        return RunResult(module_name)
 
     full_path = meta.get("__full_path__")
     if not full_path:
         print(f"ERROR: no __full_path__ for {module_name}")
-        return []
+        return RunResult(module_name)
+
+    # the run works in its own scratch dir, cwd included, so runs can share the machine.
+    # the testlist is loaded inside it too, init_test_env hands it out as paths["scratch"]
+    scratch_dir = artifacts.open_scratch_dir()
+    if state:
+        # lets the run queue collect the files if this worker gets killed
+        state.scratch_dir = scratch_dir
+    with artifacts.scratch_env(scratch_dir):
+        run = _load_and_run(module_name, meta, full_path, scratch_dir, state)
+    if state:
+        # recording isn't a step, the pool stops applying step limits to it
+        state.steps_done()
+
+    if run.started_at is None:
+        # nothing ran, nothing to collect
+        artifacts.remove_scratch_dir(scratch_dir)
+        return run
+    if not record:
+        return run
+
+    report_path = record_results(run, scratch_dir)
+    if state:
+        state.report_path = report_path
+
+    if state:
+        state.step = "Done"
+        state.test_name = ""
+
+    return run
+
+
+def _load_and_run(module_name, meta, full_path, scratch_dir, state=None):
+    all_tests = []
+    test_descriptions = []
+    context = {"sock": None, "abort": False, "scratch_dir": scratch_dir}
 
     apphelpers.clear_registries()
     mod = load_testfile_from_path(full_path)
@@ -184,6 +432,9 @@ def run_testfile(module_name, state=None):
             
             for i, step in enumerate(config["steps"], 1):
                 action = step.get('action', 'unknown')
+                # optional, see stepgraph.py
+                step_id = str(step["id"]) if "id" in step else stepgraph.implicit_id(i)
+                depends_on = step.get("depends_on")
                 subaction = step.get('subaction', 'unknown')
                 #func_name = f"{action}_{subaction}"
                 func_name = f"{action}"
@@ -193,8 +444,16 @@ def run_testfile(module_name, state=None):
                 # list steps names must be unique or will get errors like test with 4 steps but only 3 run
                 unique_name = f"{i}_{func_name}"
                 
+                # param "step_timeout" overrides CONFIG "step_timeout", it is not passed to the function
+                step_timeout = _as_timeout(step.get("param", {}).get("step_timeout", config.get("step_timeout")))
+                # same for "cache", opts the step into the build cache (stepcache.py)
+                cacheable = bool(step.get("param", {}).get("cache", config.get("cache", False)))
+
                 if func:
                     kwargs = step.get("param", {}).copy()
+                    kwargs.pop("step_timeout", None)
+                    kwargs.pop("cache", None)
+                    func_params = dict(kwargs)
                     kwargs['context'] = context
                     kwargs['config'] = config
                     
@@ -211,6 +470,26 @@ def run_testfile(module_name, state=None):
                     
                     step_wrapper.test_description = unique_name
                     step_wrapper.my_test_type = config.get("testtype", "dispatchtest")
+                    step_wrapper.step_timeout = step_timeout
+                    step_wrapper.step_id = step_id
+                    step_wrapper.depends_on = depends_on
+                    paths = getattr(mod, "paths", None)
+                    paths = paths if isinstance(paths, dict) else None
+                    if cacheable and paths and "src" in paths and "out" in paths:
+                        step_wrapper.cache_spec = (
+                            stepcache.build_cache,
+                            lambda f=func, p=paths, c=config, kw=dict(func_params, action=action, subaction=subaction):
+                                stepcache.step_key(p, c, f, kw),
+                            paths["out"],
+                        )
+                    elif getattr(func, "_cacheable", None):
+                        # declared pure by dispatchhelper.cacheable
+                        step_wrapper.cache_spec = (
+                            stepcache.memo_cache,
+                            lambda f=func, p=paths, kw=func_params:
+                                stepcache.memo_key(f, kw, dispatchhelper.memo_inputs(f, kw, p)),
+                            None,
+                        )
                     
                     all_tests.append(step_wrapper)
                     test_descriptions.append(step_wrapper.test_description)
@@ -222,6 +501,8 @@ def run_testfile(module_name, state=None):
                     
                     fail_wrapper.test_description = f"{unique_name} (Missing)"
                     fail_wrapper.my_test_type = config.get("testtype", "dispatchtest")
+                    fail_wrapper.step_id = step_id
+                    fail_wrapper.depends_on = depends_on
                     
                     all_tests.append(fail_wrapper)
                     test_descriptions.append(fail_wrapper.test_description)
@@ -234,8 +515,12 @@ def run_testfile(module_name, state=None):
                     all_tests.append(f)
                     test_descriptions.append(desc)
 
+    testlist_timeout = None
+    parallel = None
     if mod and hasattr(mod, "CONFIG"):
         config = mod.CONFIG
+        testlist_timeout = _as_timeout(config.get("timeout"))
+        parallel = config.get("parallel")
         if state:
             state.testid = config.get("testname", "")
             state.testtype = config.get("testtype", "")
@@ -246,59 +531,64 @@ def run_testfile(module_name, state=None):
         if state:
             state.step = "Done"
             state.test_name = "No tests found"
-        return []
+        return RunResult(module_name)
 
     print(f"Found {len(all_tests)} tests to run for {module_name}.")
-    results = run_tests(test_descriptions, all_tests, context, module_name)
-
-    def get_start(name):
-        ts = TestrunnerTimer.get_start(name)
-        return ts if ts is not None else time.time()
-
-    def get_stop(name):
-        ts = TestrunnerTimer.get_stop(name)
-        if ts is not None:
-            return ts
-        dur = next((d for n, s, c, o, out, d in results if n == name), 0.0)
-        return get_start(name) + dur
+    config_testparentname = mod.CONFIG.get("testname") if hasattr(mod, "CONFIG") else module_name
+    run = RunResult(module_name, config_testparentname, meta_test_types(meta), started_at=time.time())
+    run.steps = run_tests(test_descriptions, all_tests, context, module_name, state,
+                          timeout=testlist_timeout, parallel=parallel)
+    run.finished_at = time.time()
 
-    total_suite_duration = round(sum(r[5] for r in results), 2)
-    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-    subdir_path = os.path.join(REPORT_DIR, timestamp)
-    os.makedirs(subdir_path, exist_ok=True)
+    return run
 
-    report_path = os.path.join(subdir_path, f"{module_name}.html")
-    generate_report(results, report_path, testlist_name=module_name)
 
+def meta_test_types(meta):
     raw_types = meta.get("types", {})
     if isinstance(raw_types, dict):
-        test_types = ", ".join(raw_types.keys())
+        return ", ".join(raw_types.keys())
     elif isinstance(raw_types, list):
-        test_types = ", ".join(raw_types)
-    else:
-        test_types = str(raw_types)
+        return ", ".join(raw_types)
+    return str(raw_types)
 
-    config_testparentname = mod.CONFIG.get("testname") if hasattr(mod, "CONFIG") else module_name
 
-    db.populate_sqlite(
-        test_id=module_name,
-        testparentname=config_testparentname,
-        test_types=test_types,
-        results=[(n, s, c, o, out, d) for n, s, c, o, out, d in results],
-        html_report_path=report_path,
-        total_duration=total_suite_duration,
-        get_start=get_start,
-        get_stop=get_stop
-    )
+def record_results(run, scratch_dir=None):
+    # writes the html report and the db rows for a finished (or killed) RunResult,
+    # scratch_dir is the run's dir from artifacts.open_scratch_dir
+    global db
+    if db is None:
+        from app import db
+    subdir_path = make_report_subdir()
+    artifacts.collect(run, subdir_path, scratch_dir)
 
-    if state:
-        state.step = "Done"
-        state.test_name = ""
+    report_path = os.path.join(subdir_path, f"{run.module_name}.html")
+    # in "db" mode the path is still recorded, /reports renders it from the db when opened
+    if reportrender.REPORT_MODE != "db":
+        generate_report(run.steps, report_path, testlist_name=run.module_name, artifacts=run.artifacts)
+    db.populate_sqlite(run, report_path)
+    return report_path
 
-    return results
 
+def make_report_subdir():
+    # runs can finish in the same second, suffix the timestamp dir instead of sharing it
+    timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+    subdir_path = os.path.join(REPORT_DIR, timestamp)
+    suffix = 1
+    while True:
+        try:
+            os.makedirs(subdir_path)
+            return subdir_path
+        except FileExistsError:
+            suffix += 1
+            subdir_path = os.path.join(REPORT_DIR, f"{timestamp}_{suffix}")
+
+
+def run_tests(test_descriptions, registry, context, module_name, state=None, timeout=None, parallel=None):
+    if state is None:
+        state = ProgressState(testname=module_name)
+    # whole-testlist deadline, each step gets at most the time that is left
+    deadline = time.time() + timeout if timeout else None
 
-def run_tests(test_descriptions, registry, context, module_name):
     results = []
     seen_names = set()
     unique_tests = []
@@ -313,152 +603,255 @@ def run_tests(test_descriptions, registry, context, module_name):
 
     total = len(unique_tests)
     if total == 0:
-        # reset only these vars at start to explicity set zero/none vals
-        progress_state.step = "0/0"
-        progress_state.testname = ""
-        progress_state.step_name = "No tests found"
+        state.step = "0/0"
+        state.step_name = "No tests found"
         return []
 
+    if any(getattr(f, "depends_on", None) is not None for f in unique_tests):
+        return run_step_graph(unique_tests, context, module_name, state, timeout, parallel)
+
     # append steps during testrun
     for index, test_func in enumerate(unique_tests, start=1):
         test_name = getattr(test_func, "test_description", test_func.__name__)
-        progress_state.step = f"{index}/{total}"
-        progress_state.step_name = test_name
-        progress_state.testname = module_name        # dot path
-        progress_state.testid = progress_state.testid or test_name  # human-friendly name
-        progress_state.testtype = progress_state.testtype or getattr(test_func, "testtype", "")
+        state.step_started(index, total, test_name)
+        state.testname = module_name        # dot path
+        state.testid = state.testid or test_name  # human-friendly name
+        state.testtype = state.testtype or getattr(test_func, "testtype", "")
+
+        if cancel_requested and not context.get("abort"):
+            context["abort"] = True
+            result = StepResult.not_run(test_name, Status.CANCELLED, "Run cancelled")
+            results.append(result)
+            state.step_finished(index, result)
+            continue
+
+        step_timeout = getattr(test_func, "step_timeout", None)
+        if deadline is not None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                context["abort"] = True
+                result = StepResult.not_run(test_name, Status.TIMEOUT, f"Testlist timeout of {timeout}s reached")
+                results.append(result)
+                state.step_finished(index, result)
+                continue
+            step_timeout = min(step_timeout, remaining) if step_timeout else remaining
 
         if context.get("abort"):
-            results.append((test_name, "SKIPPED", "gray", "Skipped", "", 0.00))
+            result = StepResult.not_run(test_name, Status.SKIPPED, "Skipped")
+            results.append(result)
+            state.step_finished(index, result)
             continue
 
-        result = run_registered_test(test_name, [test_func], context)
+        # lets the runner pool hard-kill the worker if the step ignores the signal
+        state.step_deadline = time.time() + step_timeout if step_timeout else None
+        result = run_registered_test(test_name, [test_func], context, timeout=step_timeout)
+        state.step_deadline = None
         if result:
             results.append(result)
+            state.step_finished(index, result)
 
-    # reset to null after test run completes
-    # progress_state.step = f"{total}/{total}"
-    progress_state.step = "Idle"
-    progress_state.testname = ""
-    progress_state.step_name = ""
-    progress_state.testname = ""
-    progress_state.testtype = ""
-    progress_state.testid = ""
+    state.step = f"{total}/{total}"
+    state.step_name = ""
     return results
 
 
-def generate_report(results, report_path, testlist_name=""):
-    subdir_path = os.path.dirname(report_path)
-   # print(f"Creating directory: '{subdir_path}'")
-    if subdir_path and not os.path.exists(subdir_path):
-        os.makedirs(subdir_path, exist_ok=True)
-
-    if os.path.exists(compile_logs_dir):
-        for filename in os.listdir(compile_logs_dir):
-            shutil.move(os.path.join(compile_logs_dir, filename), subdir_path)
-
-    for filename in os.listdir(REPORT_DIR):
-        if (re.match(r"test\d+\.(png|ppm|gif)$", filename) or
-            filename.startswith("screenshot-")):
-            shutil.move(os.path.join(REPORT_DIR, filename), subdir_path)
-
-    screenshot_map = defaultdict(list)
-    for fname in os.listdir(subdir_path):
-        if fname.endswith((".png", ".gif")):
-            # Match filenames like screenshot-vice1-6-1.png or screenshot-vice2-6.png
-            m = re.match(r"screenshot-[^-]+-(\d+)(?:-\d+)?\.(png|gif)$", fname)
-            if m:
-                step_num = int(m.group(1))
-                screenshot_map[step_num].append(fname)
-
-    # Write HTML report
-    with open(report_path, "w") as f:
-        f.write(f"""<html>
-        <head>
-        <title>Test Report - {testlist_name}</title>
-        <style>
-        body {{ font-family: sans-serif; }}
-        table {{ border-collapse: collapse; width: 100%; }}
-        th, td {{ border: 1px solid #ccc; padding: 8px; text-align: left; }}
-        .green {{ background-color: #c8f7c5; }}
-        .red {{ background-color: #f7c5c5; }}
-        .gray {{ background-color: #eeeeee; }}
-
-        .flex-container {{
-            display: flex;
-            gap: 20px;
-            flex-wrap: nowrap;
-            max-width: 100%;
-        }}
-
-        .output-column {{
-            flex: 1;
-            min-width: 0;
-            max-width: 50%;
-            overflow: hidden;
-            background-color: #f0f0f0;
-            padding: 10px;
-        }}
-
-        .image-column {{
-            flex: 1;
-            max-width: 50%;
-        }}
-
-        pre {{
-            background-color: #eee;
-            padding: 10px;
-            white-space: pre-wrap;
-            word-wrap: break-word;
-            overflow-wrap: break-word;
-            max-width: 100%;
-            overflow-x: auto;
-        }}
-        hr {{ margin: 40px 0; }}
-        </style>
-        </head>
-        <body>
-        <h1>Test Report: {testlist_name}</h1>
-        <table>
-        <tr><th>Test Name</th><th>Duration (s)</th><th>Result</th></tr>
-        """)
-
-
-        # Summary table
-        for name, status, color, _, _, duration in results:
-            f.write(f'<tr><td>{name}</td><td>{duration:.2f}</td><td class="{color}">{status}</td></tr>\n')
-
-        f.write("</table><h2>Detailed Output</h2>\n")
-
-        # Detailed sections with screenshots linked by index (starting at 1)
-        for idx, (name, status, color, output, stdout, duration) in enumerate(results, start=1):
-            matching_images = screenshot_map.get(idx, [])
-            if matching_images:
-                img_tags = "\n".join(
-                    f'<img src="{img}" alt="{img}" style="max-width: 100%; border: 1px solid #ccc;">'
-                    for img in matching_images
-                )
-            else:
-                img_tags = "<p>No screenshot available.</p>"
-
-            f.write(f"""<hr>
-    <div class="flex-container">
-    <div class="output-column">
-        <h3>{name}</h3>
-        <p><strong>Duration:</strong> {duration:.2f} seconds</p>
-        <pre>OUTPUT:
-        {output}
-
-    STDOUT:
-    {stdout}</pre>
-        </div>
-        <div class="image-column">
-            <h4>Screenshot</h4>
-            {img_tags}
-        </div>
-        </div>
-        """)
-
-        f.write("</body></html>")
+def _pickled_context(context):
+    # {key: pickled value} of the entries that can cross a process boundary
+    pickled = {}
+    for key, value in context.items():
+        if key in GRAPH_LOCAL_CONTEXT:
+            continue
+        try:
+            pickled[key] = pickle.dumps(value)
+        except Exception:
+            pickled[key] = None
+    return pickled
+
+
+def _context_changes(test_name, before, context):
+    # the entries a step added or changed, to be merged into the context of the steps after it
+    changes = {}
+    lost = []
+    for key, data in _pickled_context(context).items():
+        if data is None:
+            if key not in before or before[key] is not None:
+                lost.append(key)
+        elif before.get(key) != data:
+            changes[key] = context[key]
+    if lost:
+        print(f"{test_name}: context {', '.join(map(repr, lost))} can't be pickled, later steps won't see it")
+    return changes
+
+
+def _fork_step(test_name, test_func, context, timeout, finished, index):
+    # runs one step in a forked child that leads its own process group, so a timeout or
+    # cancel takes down exactly that step's emulators and compilers, orphans included.
+    # it works on a copy of context, the entries it adds or changes come back with the result
+    # if they can be pickled. the StepResult comes back pickled over a pipe and lands in
+    # finished as (index, result, context changes)
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        changes = {}
+        try:
+            os.setpgid(0, 0)
+            before = _pickled_context(context)
+            result = run_registered_test(test_name, [test_func], context, timeout=timeout)
+            changes = _context_changes(test_name, before, context)
+        except BaseException as e:
+            result = StepResult(test_name, Status.ERROR, f"{type(e).__name__}: {e}")
+        try:
+            data = pickle.dumps((result, changes))
+        except Exception as e:
+            data = pickle.dumps((StepResult(test_name, Status.ERROR, f"Step result not picklable: {e}"), {}))
+        with os.fdopen(write_fd, "wb") as f:
+            f.write(data)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(0)
+
+    os.close(write_fd)
+    try:
+        # same call as in the child, whichever runs first closes the race with _kill_step
+        os.setpgid(pid, pid)
+    except OSError:
+        pass
+
+    def collect():
+        with os.fdopen(read_fd, "rb") as f:
+            data = f.read()
+        os.waitpid(pid, 0)
+        try:
+            result, changes = pickle.loads(data)
+        except Exception:
+            result, changes = None, {}
+        finished.put((index, result, changes))
+
+    threading.Thread(target=collect, name=f"step-{index}", daemon=True).start()
+    return pid
+
+
+def _kill_step(pid):
+    # the step's process group, everything it started
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def run_step_graph(tests, context, module_name, state, timeout=None, parallel=None):
+    # runs the steps as a dependency graph (stepgraph.py), up to parallel at once. a step
+    # whose dependencies did not all pass is skipped, independent steps keep going
+    total = len(tests)
+    names = [getattr(f, "test_description", f.__name__) for f in tests]
+    try:
+        deps = stepgraph.build([getattr(f, "step_id", stepgraph.implicit_id(i)) for i, f in enumerate(tests, start=1)],
+                               [getattr(f, "depends_on", None) for f in tests])
+    except ValueError as e:
+        results = [StepResult.not_run(name, Status.ERROR, f"Invalid depends_on: {e}") for name in names]
+        for index, result in enumerate(results, start=1):
+            state.step_finished(index, result)
+        return results
+
+    try:
+        parallel = max(1, int(parallel or STEP_PARALLEL))
+    except (TypeError, ValueError):
+        parallel = STEP_PARALLEL
+    deadline = time.time() + timeout if timeout else None
+    finished = queue.Queue()
+    results = [None] * total
+    pending = list(range(total))
+    running = {}  # position -> [pid, step deadline, killed]
+    stopping = None  # why nothing new starts any more, with the status pending steps get
+    # the pool's hard kill can't tell the parallel steps apart, the timeouts are enforced here
+    state.step_deadline = None
+    print(f"Running {total} steps as a graph, up to {parallel} at once")
+
+    def finish(i, result):
+        results[i] = result
+        state.step_finished(i + 1, result)
+
+    while pending or running:
+        now = time.time()
+        if stopping is None and cancel_requested:
+            stopping = (Status.SKIPPED, "Skipped, run cancelled")
+            for pid, _, _ in running.values():
+                try:
+                    # lets the step mark itself CANCELLED and stop its children
+                    os.kill(pid, signal.SIGUSR1)
+                except ProcessLookupError:
+                    pass
+            for entry in running.values():
+                entry[1] = now + CHILD_KILL_GRACE * 2
+        elif stopping is None and deadline is not None and now >= deadline:
+            stopping = (Status.TIMEOUT, f"Testlist timeout of {timeout}s reached")
+
+        # start whatever is ready, a skip can make the next one ready
+        progress = True
+        while progress:
+            progress = False
+            for i in list(pending):
+                if any(results[d] is None for d in deps[i]):
+                    continue
+                if stopping is not None:
+                    pending.remove(i)
+                    finish(i, StepResult.not_run(names[i], *stopping))
+                    progress = True
+                    continue
+                failed = [names[d] for d in deps[i] if results[d].status not in (Status.PASS, Status.CACHED)]
+                if failed:
+                    pending.remove(i)
+                    finish(i, StepResult.not_run(names[i], Status.SKIPPED, f"Skipped, depends on {', '.join(failed)}"))
+                    progress = True
+                    continue
+                if len(running) >= parallel:
+                    break
+                step_timeout = getattr(tests[i], "step_timeout", None)
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    step_timeout = min(step_timeout, remaining) if step_timeout else remaining
+                pending.remove(i)
+                state.step_started(i + 1, total, names[i])
+                state.testname = module_name
+                state.testid = state.testid or names[i]
+                pid = _fork_step(names[i], tests[i], context, step_timeout, finished, i)
+                # the step times out on its own, this is the backstop for one that ignores it
+                running[i] = [pid, time.time() + step_timeout + CHILD_KILL_GRACE * 2 if step_timeout else None, False]
+                progress = True
+
+        if not running:
+            continue
+        try:
+            i, result, changes = finished.get(timeout=0.2)
+        except queue.Empty:
+            now = time.time()
+            for i, entry in running.items():
+                if entry[1] is not None and now > entry[1] and not entry[2]:
+                    _kill_step(entry[0])
+                    entry[2] = True
+            continue
+
+        pid, _, killed = running.pop(i)
+        if result is None:
+            status = Status.CANCELLED if cancel_requested else Status.TIMEOUT if killed else Status.ERROR
+            result = StepResult.not_run(names[i], status, "Step killed" if killed else "Step process died")
+        # steps started from here on see it, parallel steps that change the same entry: last one wins
+        context.update(changes)
+        finish(i, result)
+
+    # where the wall time went: the longest chain of dependent steps
+    durations = [r.duration for r in results]
+    path, _ = stepgraph.critical_path(deps, durations)
+    on_path = set(path)
+    for i, result in enumerate(results):
+        result.metrics = dict(result.metrics, depends_on=[d + 1 for d in deps[i]], critical_path=i in on_path)
+
+    state.step = f"{total}/{total}"
+    state.step_name = ""
+    return results
+
 
+def generate_report(steps, report_path, testlist_name="", artifacts=()):
+    reportrender.write_report(steps, report_path, testlist_name, artifacts)
     print(f"Wrote report to {report_path}")